@@ -1,15 +1,46 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, session, redirect, url_for
 import os
 import json
 import sqlite3
 import subprocess
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.http import parse_range_header, parse_date
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import ClientDisconnected
 from werkzeug.security import generate_password_hash, check_password_hash
 import mimetypes
+from urllib.parse import quote
 import base64
 from datetime import datetime
 import hashlib
-from datetime import time
+import re
+import select
+import errno
+import struct
+import ctypes
+import ctypes.util
+import threading
+from stat import S_ISREG
+import time
+import tempfile
+import shutil
+import secrets
+import tarfile
+import zlib
+from functools import wraps
+import heapq
+import itertools
+from collections import OrderedDict
+from concurrent.futures import Future, CancelledError, TimeoutError as FutureTimeoutError
+try:
+    import fcntl
+except ImportError:  # Windows: no lock file, every process may watch
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:  # waveform peaks are unavailable without NumPy
+    np = None
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
@@ -22,8 +53,168 @@ DEFAULT_ADMIN_PASSWORD = 'admin123'
 UPLOAD_FOLDER = 'static/videos'
 THUMBNAILS_FOLDER = 'static/thumbnails'
 SUBTITLES_FOLDER = 'static/subtitles'
+SPRITES_FOLDER = 'static/thumbnails/sprites'
+WAVEFORMS_FOLDER = 'static/thumbnails/waveforms'
 DATABASE_FILE = 'xplayer.db'
 
+# SQLite connection pool and pragmas
+DB_POOL_SIZE = 16  # idle connections kept between requests
+DB_BUSY_TIMEOUT = 30  # seconds to wait on a locked database
+DB_STATEMENT_CACHE_SIZE = 256
+DB_CACHE_SIZE_KB = 20000
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+# Authorization: each user's permissions and access window are cached for this many
+# seconds; admin changes to a user invalidate the entry immediately
+AUTH_CACHE_TTL = 30
+
+# Library index: directories are re-listed only when their mtime changes,
+# and at most once per LIBRARY_INDEX_TTL seconds
+LIBRARY_INDEX_TTL = 30
+
+# Optional filesystem watcher for UPLOAD_FOLDER and SUBTITLES_FOLDER: inotify on
+# Linux, a full rescan every LIBRARY_WATCHER_POLL_INTERVAL seconds elsewhere.
+# It starts with the first request a process serves, so it also runs under
+# gunicorn/uWSGI; the lock file keeps it to one worker process
+LIBRARY_WATCHER_ENABLED = False
+LIBRARY_WATCHER_LOCK = 'cache/library-watcher.lock'
+LIBRARY_WATCHER_DEBOUNCE = 2  # seconds without events before a batch is applied
+LIBRARY_WATCHER_MAX_DELAY = 30  # apply a batch after this long even if events keep arriving
+LIBRARY_WATCHER_POLL_INTERVAL = 60
+
+# Page sizes for shallow /api/browse
+BROWSE_PAGE_SIZE = 200
+BROWSE_MAX_PAGE_SIZE = 1000
+
+# Playlist items are ordered by sparse positions, so inserts and moves write one row;
+# a playlist is renumbered only when two neighbours run out of room between them
+PLAYLIST_POSITION_STEP = 1024
+
+# Response cache for browse/search/videos JSON: LRU bounded by body size, keyed
+# to a version counter that triggers bump on every library_index/video_metadata write
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+# Full-text search (SQLite FTS5 over names, folders and probed metadata)
+SEARCH_PAGE_SIZE = 100
+SEARCH_MAX_PAGE_SIZE = 500
+SEARCH_WEIGHTS = (10.0, 2.0, 5.0, 1.0, 1.0)  # bm25 weights: name, folder, title, codecs, resolution
+
+# Media job scheduler: ffmpeg/ffprobe jobs share MEDIA_JOB_WORKERS threads and run
+# interactive playback first, then thumbnails/previews, then background scans
+MEDIA_JOB_WORKERS = 3
+MEDIA_JOB_RESERVED_INTERACTIVE = 1  # workers that only interactive jobs may use
+MEDIA_PRIORITY_INTERACTIVE = 0
+MEDIA_PRIORITY_THUMBNAIL = 1
+MEDIA_PRIORITY_BACKGROUND = 2
+MEDIA_PRIORITY_NAMES = ('interactive', 'thumbnail', 'background')
+MEDIA_JOB_NICE = (0, 5, 15)  # nice increment of ffmpeg/ffprobe per priority class
+MEDIA_JOB_CPUS = None  # optional set of CPU ids ffmpeg/ffprobe are pinned to (Linux)
+
+# Background metadata/thumbnail workers
+METADATA_MAX_ATTEMPTS = 3
+METADATA_RETRY_BACKOFF = 30  # seconds, doubled after each failed attempt
+
+# Thumbnails and probe data are cached per file fingerprint (size, mtime and a hash
+# of head, middle and tail blocks), so moved files and copies that keep their mtime
+# (mv, cp -p, rsync -a) reuse them, while a file rewritten in place is regenerated
+# even when the sampled blocks did not change
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+ARTIFACT_RETENTION = 7 * 24 * 3600  # seconds unreferenced artifacts are kept for moved files
+
+# Thumbnail extraction: 'fast' (input seek, keyframes only), 'scene' or 'accurate'
+THUMBNAIL_MODE = 'fast'
+THUMBNAIL_SCENE_THRESHOLD = 0.3
+THUMBNAIL_SCENE_WINDOW = 60  # seconds after the seek point searched for a scene change
+THUMBNAIL_FILTER = 'scale=320:180:force_original_aspect_ratio=decrease,pad=320:180:(ow-iw)/2:(oh-ih)/2'
+
+# Seek-bar preview sprites (one tiled JPEG plus a WebVTT thumbnails track per video)
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+SPRITE_TILE_WIDTH = 160
+SPRITE_TILE_HEIGHT = 90
+SPRITE_MIN_INTERVAL = 2  # seconds between preview frames
+SPRITE_TIMEOUT = 300
+
+# Audio waveform peaks (min/max per bucket of mono PCM, needs NumPy), stored with
+# several zoom levels in one binary file per audio file
+WAVEFORM_SAMPLE_RATE = 8000  # audio is decoded to mono at this rate
+WAVEFORM_LEVELS = (64, 256, 1024, 4096)  # samples per bucket, each a multiple of the first
+WAVEFORM_BITS = 8  # 8 (int8) or 16 (int16) bits per peak value
+WAVEFORM_TIMEOUT = 300
+
+# Video streaming
+STREAM_CHUNK_SIZE = 256 * 1024
+VIDEO_CACHE_MAX_AGE = 7 * 24 * 3600
+MAX_MULTIPART_RANGES = 16
+
+# HLS adaptive streaming: segments are transcoded just in time and kept in a
+# size-bounded cache outside static/ (least recently served segments go first)
+HLS_CACHE_FOLDER = 'cache/hls'
+HLS_CACHE_MAX_BYTES = 10 * 1024 ** 3
+HLS_SEGMENT_DURATION = 6  # seconds
+HLS_PREFETCH_SEGMENTS = 2  # segments transcoded ahead of the one requested
+HLS_SEGMENT_TIMEOUT = 120
+HLS_RENDITIONS = [
+    # (name, height, video kbps, audio kbps), tallest first
+    ('1080p', 1080, 5000, 192),
+    ('720p', 720, 2800, 128),
+    ('480p', 480, 1400, 128),
+    ('360p', 360, 800, 96)
+]
+
+# Remux browser-incompatible containers (MKV, AVI, FLV, ...) to fragmented MP4
+# without re-encoding video; finished remuxes are cached for Range playback
+REMUX_CACHE_FOLDER = 'cache/remux'
+REMUX_CACHE_MAX_BYTES = 50 * 1024 ** 3
+REMUX_VIDEO_CODECS = {'h264'}
+REMUX_AUDIO_CODECS = {'aac', 'mp3'}  # anything else is re-encoded to AAC (cheap next to video)
+
+# Subtitles: files in SUBTITLES_FOLDER and sidecars next to videos are indexed by
+# video name and language ("Movie.en.forced.srt"); SRT/ASS/SSA are converted to
+# WebVTT on first request and kept in SUBTITLE_CACHE_FOLDER. Embedded text streams
+# (bitmap formats such as PGS are skipped) are extracted by ffmpeg on first request
+# and cached per file fingerprint and stream index
+SUBTITLE_CACHE_FOLDER = 'cache/subtitles'
+SUBTITLE_LANGUAGES = {
+    # code: (name, ISO 639-2 codes)
+    'ar': ('Arabic', 'ara'), 'cs': ('Czech', 'cze', 'ces'), 'da': ('Danish', 'dan'),
+    'de': ('German', 'ger', 'deu'), 'el': ('Greek', 'gre', 'ell'), 'en': ('English', 'eng'),
+    'es': ('Spanish', 'spa'), 'fi': ('Finnish', 'fin'), 'fr': ('French', 'fre', 'fra'),
+    'he': ('Hebrew', 'heb'), 'hi': ('Hindi', 'hin'), 'hu': ('Hungarian', 'hun'),
+    'id': ('Indonesian', 'ind'), 'it': ('Italian', 'ita'), 'ja': ('Japanese', 'jpn'),
+    'ko': ('Korean', 'kor'), 'nl': ('Dutch', 'dut', 'nld'), 'no': ('Norwegian', 'nor', 'nob'),
+    'pl': ('Polish', 'pol'), 'pt': ('Portuguese', 'por'), 'ro': ('Romanian', 'rum', 'ron'),
+    'ru': ('Russian', 'rus'), 'sv': ('Swedish', 'swe'), 'th': ('Thai', 'tha'),
+    'tr': ('Turkish', 'tur'), 'uk': ('Ukrainian', 'ukr'), 'vi': ('Vietnamese', 'vie'),
+    'zh': ('Chinese', 'chi', 'zho')
+}
+SUBTITLE_FLAGS = {'forced', 'sdh', 'cc', 'hi', 'default'}
+SUBTITLE_EMBEDDED_CODECS = {'subrip', 'srt', 'ass', 'ssa', 'mov_text', 'webvtt', 'text'}
+SUBTITLE_EXTRACT_TIMEOUT = 600
+SUBTITLE_EXTRACT_WAIT = 30  # seconds a request waits for an extraction before answering 202
+
+# Folder and playlist downloads are streamed as store-only ZIP or tar archives built
+# on the fly; the layout is computed up front, so Content-Length and Range resume work
+ARCHIVE_FORMATS = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+ARCHIVE_MAX_FILES = 10000
+ARCHIVE_CRC_CACHE_SIZE = 4096  # CRC-32s of streamed files kept for resumed ZIP downloads
+
+# Resumable chunked uploads (admins): each chunk is streamed to a partial file in
+# UPLOAD_TEMP_FOLDER and checked against its Upload-Checksum before the offset
+# advances; finished files are moved into UPLOAD_FOLDER without replacing anything
+UPLOAD_TEMP_FOLDER = 'cache/uploads'
+UPLOAD_CHUNK_MAX_BYTES = 64 * 1024 * 1024  # must stay below MAX_CONTENT_LENGTH
+UPLOAD_MAX_BYTES = 200 * 1024 ** 3
+UPLOAD_EXPIRY = 24 * 3600  # seconds an unfinished upload is kept without new chunks
+
+# Offload video/download transfers to the front-end server after authorization:
+# None (stream from Flask), 'x-accel' (nginx) or 'x-sendfile' (lighttpd/Apache).
+# For nginx, X_ACCEL_REDIRECT_PREFIX must be an internal location, e.g.
+#   location /protected-videos/ { internal; alias /path/to/static/videos/; }
+FILE_OFFLOAD_MODE = None
+X_ACCEL_REDIRECT_PREFIX = '/protected-videos/'
+
 # Extended list of supported media formats
 ALLOWED_EXTENSIONS = {
     # Video formats
@@ -37,7 +228,7 @@ ALLOWED_EXTENSIONS = {
 }
 
 SUBTITLE_EXTENSIONS = {'srt', 'vtt', 'ass', 'ssa'}
-MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB max file size
+MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB max request body (larger files use chunked uploads)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['THUMBNAILS_FOLDER'] = THUMBNAILS_FOLDER
@@ -45,12 +236,95 @@ app.config['SUBTITLES_FOLDER'] = SUBTITLES_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
 # Ensure directories exist
-for folder in [UPLOAD_FOLDER, THUMBNAILS_FOLDER, SUBTITLES_FOLDER]:
+for folder in [UPLOAD_FOLDER, THUMBNAILS_FOLDER, SUBTITLES_FOLDER, SPRITES_FOLDER, WAVEFORMS_FOLDER,
+               HLS_CACHE_FOLDER, REMUX_CACHE_FOLDER, SUBTITLE_CACHE_FOLDER, UPLOAD_TEMP_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
+# Database connections
+_db_local = threading.local()
+_db_idle = []  # (database file, connection) pairs released by finished requests
+_db_idle_lock = threading.Lock()
+
+def _connect_db():
+    """Open a connection with WAL journaling and the tuned pragmas"""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=DB_STATEMENT_CACHE_SIZE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    # REPLACE conflicts fire delete triggers, which keep library_search in step
+    conn.execute('PRAGMA recursive_triggers=ON')
+    return conn
+
+def get_db():
+    """Return the calling thread's pooled connection, reusing an idle one if possible.
+    
+    Connections are never closed by callers; request threads hand theirs back to
+    the pool in release_db(), so sqlite3's statement cache survives between requests.
+    """
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and _db_local.path == DATABASE_FILE:
+        return conn
+    
+    conn = None
+    with _db_idle_lock:
+        for index, (path, _) in enumerate(_db_idle):
+            if path == DATABASE_FILE:
+                conn = _db_idle.pop(index)[1]
+                break
+    
+    _db_local.conn = conn or _connect_db()
+    _db_local.path = DATABASE_FILE
+    return _db_local.conn
+
+def release_db():
+    """Give the calling thread's connection back to the idle pool"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        return
+    
+    # Never hand out a connection holding a half-finished transaction
+    if conn.in_transaction:
+        conn.rollback()
+    
+    _db_local.conn = None
+    with _db_idle_lock:
+        if len(_db_idle) < DB_POOL_SIZE:
+            _db_idle.append((_db_local.path, conn))
+            return
+    conn.close()
+
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    release_db()
+
+# Columns filled from the single ffprobe pass, appended to the original schema
+VIDEO_METADATA_PROBE_COLUMNS = [
+    ('video_codec', 'TEXT'),
+    ('audio_codec', 'TEXT'),
+    ('bitrate', 'INTEGER'),
+    ('frame_rate', 'REAL'),
+    ('audio_channels', 'INTEGER'),
+    ('stream_count', 'INTEGER'),
+    ('title', 'TEXT'),
+    ('subtitle_streams', 'TEXT')  # JSON list of embedded text subtitle streams
+]
+# Stat and fingerprint of the file the row was generated from, used to detect replaced files
+VIDEO_METADATA_STAT_COLUMNS = [
+    ('file_mtime', 'REAL'),
+    ('fingerprint', 'TEXT')
+]
+VIDEO_METADATA_COLUMNS = [
+    'file_path', 'thumbnail_path', 'file_size', 'duration', 'resolution'
+] + [column for column, _ in VIDEO_METADATA_PROBE_COLUMNS + VIDEO_METADATA_STAT_COLUMNS]
+# Content-derived columns shared by every file with the same fingerprint
+MEDIA_ARTIFACT_COLUMNS = VIDEO_METADATA_COLUMNS[1:-len(VIDEO_METADATA_STAT_COLUMNS)]
+
 def init_database():
     """Initialize SQLite database for users and playlists"""
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Users table
@@ -85,6 +359,35 @@ def init_database():
         )
     ''')
     
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS playlist_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            playlist_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            video_path TEXT NOT NULL,
+            FOREIGN KEY (playlist_id) REFERENCES playlists (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_playlist_items_position
+        ON playlist_items (playlist_id, position)
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS playlists_delete_items AFTER DELETE ON playlists BEGIN
+            DELETE FROM playlist_items WHERE playlist_id = OLD.id;
+        END
+    ''')
+    
+    # Playlists created before playlist_items kept their videos as a JSON list
+    cursor.execute("SELECT id, videos FROM playlists WHERE videos IS NOT NULL")
+    for playlist_id, videos in cursor.fetchall():
+        try:
+            video_paths = json.loads(videos) or []
+        except ValueError:
+            video_paths = []
+        set_playlist_items(cursor, playlist_id, video_paths)
+        cursor.execute('UPDATE playlists SET videos = NULL WHERE id = ?', (playlist_id,))
+    
     # Video metadata table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS video_metadata (
@@ -94,10 +397,120 @@ def init_database():
             duration REAL,
             resolution TEXT,
             file_size INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            video_codec TEXT,
+            audio_codec TEXT,
+            bitrate INTEGER,
+            frame_rate REAL,
+            audio_channels INTEGER,
+            stream_count INTEGER,
+            title TEXT,
+            subtitle_streams TEXT,
+            file_mtime REAL,
+            fingerprint TEXT
+        )
+    ''')
+    
+    # Add the probe and stat columns to video_metadata tables created by older versions
+    cursor.execute('PRAGMA table_info(video_metadata)')
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    for column, column_type in VIDEO_METADATA_PROBE_COLUMNS + VIDEO_METADATA_STAT_COLUMNS:
+        if column not in existing_columns:
+            cursor.execute(f'ALTER TABLE video_metadata ADD COLUMN {column} {column_type}')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_video_metadata_fingerprint ON video_metadata (fingerprint)')
+    
+    # Fingerprint-keyed artifact cache (outlives the video_metadata rows of moved files)
+    probe_column_defs = ''.join(f',\n            {column} {column_type}'
+                                for column, column_type in VIDEO_METADATA_PROBE_COLUMNS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS media_artifacts (
+            fingerprint TEXT PRIMARY KEY,
+            thumbnail_path TEXT,
+            file_size INTEGER,
+            duration REAL,
+            resolution TEXT{probe_column_defs},
+            last_used REAL
+        )
+    ''')
+    cursor.execute('PRAGMA table_info(media_artifacts)')
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    for column, column_type in VIDEO_METADATA_PROBE_COLUMNS:
+        if column not in existing_columns:
+            cursor.execute(f'ALTER TABLE media_artifacts ADD COLUMN {column} {column_type}')
+    
+    # Library index tables (directory tree and file stats under UPLOAD_FOLDER)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS library_index (
+            path TEXT PRIMARY KEY,
+            parent TEXT NOT NULL,
+            name TEXT NOT NULL,
+            item_type TEXT NOT NULL,
+            size INTEGER DEFAULT 0,
+            modified REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_library_index_parent ON library_index (parent)')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS library_dirs (
+            path TEXT PRIMARY KEY,
+            mtime REAL
         )
     ''')
     
+    # Subtitle files by the video they belong to: 'folder' entries (SUBTITLES_FOLDER) match
+    # any video with that file name, 'sidecar' entries only the video in their directory
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'subtitle_index'")
+    if not cursor.fetchone():
+        # Directories indexed before sidecars were tracked have to be listed once more
+        cursor.execute('DELETE FROM library_dirs')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subtitle_index (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            path TEXT NOT NULL,
+            parent TEXT NOT NULL,
+            video_key TEXT NOT NULL,
+            language TEXT NOT NULL,
+            label TEXT NOT NULL,
+            modified REAL,
+            UNIQUE (source, path)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_subtitle_index_video_key ON subtitle_index (video_key)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_subtitle_index_parent ON subtitle_index (source, parent)')
+    
+    # Unfinished resumable uploads; the data received so far is in UPLOAD_TEMP_FOLDER/<id>.part
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            sha256 TEXT,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    
+    # Bumped on every library/metadata write; cached listings are only valid for one version
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS library_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO library_state (id, version) VALUES (1, 0)')
+    for table in ('library_index', 'video_metadata'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                    UPDATE library_state SET version = version + 1 WHERE id = 1;
+                END
+            ''')
+    
+    init_search_index(cursor)
+    
     # Create default admin user if not exists
     cursor.execute('SELECT id FROM users WHERE username = ?', (DEFAULT_ADMIN_USERNAME,))
     if not cursor.fetchone():
@@ -109,39 +522,175 @@ def init_database():
         print(f"✅ Default admin user created: {DEFAULT_ADMIN_USERNAME} / {DEFAULT_ADMIN_PASSWORD}")
     
     conn.commit()
-    conn.close()
 
-def check_user_permissions(user_id, permission_type):
-    """Check if user has specific permission"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+# Search index: library_search rows share the rowid of their library_index row
+# and are maintained by triggers on library_index and video_metadata
+_search_index_enabled = None  # unknown until init_search_index() or the first search
+
+SEARCH_METADATA_VALUES = '''
+    vm.title, trim(coalesce(vm.video_codec, '') || ' ' || coalesce(vm.audio_codec, '')), vm.resolution
+'''
+
+def init_search_index(cursor):
+    """Create the FTS5 table and its triggers, rebuilding it if it drifted from library_index"""
+    global _search_index_enabled
     
-    cursor.execute(f'SELECT {permission_type}, is_active FROM users WHERE id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS library_search USING fts5(
+                name, folder, title, codecs, resolution,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  FTS5 not available ({e}), search falls back to substring matching")
+        _search_index_enabled = False
+        return
     
-    if not result:
-        return False
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS library_search_index_insert AFTER INSERT ON library_index BEGIN
+            INSERT INTO library_search (rowid, name, folder, title, codecs, resolution)
+            SELECT NEW.rowid, NEW.name, NEW.parent, {SEARCH_METADATA_VALUES}
+            FROM (SELECT 1) LEFT JOIN video_metadata vm ON vm.file_path = NEW.path;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS library_search_index_delete AFTER DELETE ON library_index BEGIN
+            DELETE FROM library_search WHERE rowid = OLD.rowid;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS library_search_index_update AFTER UPDATE ON library_index BEGIN
+            DELETE FROM library_search WHERE rowid = OLD.rowid;
+            INSERT INTO library_search (rowid, name, folder, title, codecs, resolution)
+            SELECT NEW.rowid, NEW.name, NEW.parent, {SEARCH_METADATA_VALUES}
+            FROM (SELECT 1) LEFT JOIN video_metadata vm ON vm.file_path = NEW.path;
+        END
+    ''')
+    for event in ('INSERT', 'UPDATE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS library_search_metadata_{event.lower()} AFTER {event} ON video_metadata BEGIN
+                UPDATE library_search SET
+                    title = NEW.title,
+                    codecs = trim(coalesce(NEW.video_codec, '') || ' ' || coalesce(NEW.audio_codec, '')),
+                    resolution = NEW.resolution
+                WHERE rowid = (SELECT rowid FROM library_index WHERE path = NEW.file_path);
+            END
+        ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS library_search_metadata_delete AFTER DELETE ON video_metadata BEGIN
+            UPDATE library_search SET title = NULL, codecs = '', resolution = NULL
+            WHERE rowid = (SELECT rowid FROM library_index WHERE path = OLD.file_path);
+        END
+    ''')
+    
+    # Databases indexed before the search table existed (or after a VACUUM renumbered rowids)
+    cursor.execute('SELECT COUNT(*) FROM library_index')
+    indexed = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(*) FROM library_search')
+    searchable = cursor.fetchone()[0]
+    cursor.execute('SELECT MAX(rowid) FROM library_index')
+    max_rowid = cursor.fetchone()[0]
+    cursor.execute('SELECT MAX(rowid) FROM library_search')
+    if indexed != searchable or cursor.fetchone()[0] != max_rowid:
+        print("Rebuilding search index...")
+        cursor.execute('DELETE FROM library_search')
+        cursor.execute(f'''
+            INSERT INTO library_search (rowid, name, folder, title, codecs, resolution)
+            SELECT li.rowid, li.name, li.parent, {SEARCH_METADATA_VALUES}
+            FROM library_index li LEFT JOIN video_metadata vm ON vm.file_path = li.path
+        ''')
     
-    return bool(result[0]) and bool(result[1])
+    _search_index_enabled = True
+
+def search_index_enabled():
+    """Whether library_search can be queried, checked once per process.
+    
+    Servers that import the app without running init_database() still find
+    an index an earlier start built.
+    """
+    global _search_index_enabled
+    if _search_index_enabled is None:
+        cursor = get_db().cursor()
+        try:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'library_search'")
+            enabled = cursor.fetchone() is not None
+            if enabled:
+                cursor.execute('SELECT rowid FROM library_search LIMIT 0')
+        except sqlite3.OperationalError:
+            enabled = False
+        _search_index_enabled = enabled
+    return _search_index_enabled
+
+def build_search_match(query):
+    """Turn free text into an FTS5 query: every word must match as a prefix"""
+    words = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+# Authorization
+USER_PERMISSIONS = {
+    'can_use_playlists': 'Playlist access denied',
+    'can_download': 'Download access denied',
+    'can_use_subtitles': 'Subtitle access denied'
+}
+_auth_cache = {}  # user_id -> (loaded at, access dict or None for unknown users)
+_auth_lock = threading.Lock()
+_auth_invalidations = 0  # loads that overlap an invalidation are not cached
+
+def get_user_access(user_id):
+    """Return the cached is_admin/is_active/permission flags and access window of a user"""
+    now = time.time()
+    with _auth_lock:
+        entry = _auth_cache.get(user_id)
+        if entry and now - entry[0] < AUTH_CACHE_TTL:
+            return entry[1]
+        invalidations = _auth_invalidations
+    
+    cursor = get_db().cursor()
+    cursor.execute('''
+        SELECT is_admin, is_active, can_use_playlists, can_download, can_use_subtitles,
+               access_start_time, access_end_time
+        FROM users WHERE id = ?
+    ''', (user_id,))
+    row = cursor.fetchone()
+    access = None
+    if row:
+        access = {
+            'is_admin': bool(row[0]),
+            'is_active': bool(row[1]),
+            'permissions': {permission: bool(value) for permission, value in zip(USER_PERMISSIONS, row[2:5])},
+            'access_start_time': row[5],
+            'access_end_time': row[6]
+        }
+    
+    with _auth_lock:
+        if invalidations == _auth_invalidations:
+            _auth_cache[user_id] = (now, access)
+    return access
+
+def invalidate_user_access(user_id):
+    """Drop a user's cached access after an admin changed or deleted the account"""
+    global _auth_invalidations
+    with _auth_lock:
+        _auth_cache.pop(user_id, None)
+        _auth_invalidations += 1
+
+def check_user_permissions(user_id, permission_type):
+    """Check if user has specific permission"""
+    access = get_user_access(user_id)
+    return bool(access and access['is_active'] and access['permissions'].get(permission_type))
 
 def check_time_access(user_id):
     """Check if user can access during current time"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    access = get_user_access(user_id)
     
-    cursor.execute('SELECT access_start_time, access_end_time, is_active FROM users WHERE id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result or not result[2]:  # User not found or inactive
+    if not access or not access['is_active']:  # User not found or inactive
         return False
     
-    start_time_str, end_time_str = result[0], result[1]
-    
     try:
-        start_time = datetime.strptime(start_time_str, '%H:%M').time()
-        end_time = datetime.strptime(end_time_str, '%H:%M').time()
+        start_time = datetime.strptime(access['access_start_time'], '%H:%M').time()
+        end_time = datetime.strptime(access['access_end_time'], '%H:%M').time()
         current_time = datetime.now().time()
         
         if start_time <= end_time:
@@ -153,6 +702,30 @@ def check_time_access(user_id):
     except:
         return True  # If time parsing fails, allow access
 
+def requires_access(permission=None, admin=False):
+    """Route decorator: require a logged-in, active user and optionally a permission or admin rights.
+    
+    Sessions of deleted or deactivated accounts are cleared.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            access = get_user_access(session['user_id']) if 'user_id' in session else None
+            
+            if admin:
+                if not access or not access['is_active'] or not access['is_admin']:
+                    return jsonify({'error': 'Admin access required'}), 403
+            elif not access or not access['is_active']:
+                session.clear()
+                return jsonify({'error': 'Authentication required'}), 401
+            
+            if permission and not access['permissions'][permission]:
+                return jsonify({'error': USER_PERMISSIONS[permission]}), 403
+            
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def allowed_file(filename):
     """Check if file is allowed (video or audio)"""
     if not filename or '.' not in filename:
@@ -178,7 +751,27 @@ def get_file_type(filename):
     else:
         return 'unknown'
 
-def generate_thumbnail(video_path, thumbnail_path):
+def build_thumbnail_command(full_video_path, seek_time, thumbnail_path, mode=None):
+    """Build the ffmpeg command that grabs one thumbnail frame.
+    
+    'accurate' seeks after -i and decodes every frame up to seek_time.
+    'fast' seeks on the input to the nearest keyframe and decodes keyframes only.
+    'scene' fast-seeks, then picks the first keyframe that starts a new scene
+    within THUMBNAIL_SCENE_WINDOW seconds.
+    """
+    mode = mode or THUMBNAIL_MODE
+    output = ['-frames:v', '1', '-q:v', '2', '-y', thumbnail_path]
+    
+    if mode == 'accurate':
+        return ['ffmpeg', '-i', full_video_path, '-ss', seek_time, '-vf', THUMBNAIL_FILTER] + output
+    
+    cmd = ['ffmpeg', '-skip_frame', 'nokey', '-noaccurate_seek', '-ss', seek_time, '-i', full_video_path]
+    if mode == 'scene':
+        scene_filter = f"select='gt(scene,{THUMBNAIL_SCENE_THRESHOLD})',{THUMBNAIL_FILTER}"
+        return cmd + ['-t', str(THUMBNAIL_SCENE_WINDOW), '-vf', scene_filter, '-vsync', 'vfr'] + output
+    return cmd + ['-vf', THUMBNAIL_FILTER, '-vsync', 'vfr'] + output
+
+def generate_thumbnail(video_path, thumbnail_path, duration=None):
     """Generate thumbnail for video at 55 seconds using ffmpeg (if available)"""
     try:
         full_video_path = os.path.join(UPLOAD_FOLDER, video_path)
@@ -193,69 +786,53 @@ def generate_thumbnail(video_path, thumbnail_path):
         print(f"Generating thumbnail for: {full_video_path}")
         
         try:
-            # Get video duration first
-            duration_cmd = [
-                'ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-                '-of', 'csv=p=0', full_video_path
-            ]
+            # Probe once for the duration unless the caller already has it
+            if duration is None:
+                probe = probe_media(video_path)
+                duration = probe['duration'] if probe else None
             
-            duration_result = subprocess.run(duration_cmd, capture_output=True, text=True, timeout=15)
-            
-            if duration_result.returncode == 0:
-                try:
-                    duration = float(duration_result.stdout.strip())
-                    print(f"Video duration: {duration} seconds")
-                    
-                    # Choose appropriate time for thumbnail (prefer 55 seconds)
-                    if duration > 55:
-                        seek_time = '00:00:55'
-                    elif duration > 10:
-                        seek_time = '00:00:10'
-                    elif duration > 5:
-                        seek_time = '00:00:05'
-                    else:
-                        seek_time = '00:00:01'
-                except ValueError:
-                    print("Could not parse duration, using default")
+            if duration is not None:
+                print(f"Video duration: {duration} seconds")
+                
+                # Choose appropriate time for thumbnail (prefer 55 seconds)
+                if duration > 55:
+                    seek_time = '00:00:55'
+                elif duration > 10:
                     seek_time = '00:00:10'
+                elif duration > 5:
+                    seek_time = '00:00:05'
+                else:
+                    seek_time = '00:00:01'
             else:
                 print("Could not get duration, using default seek time")
                 seek_time = '00:00:10'
             
             print(f"Using seek time: {seek_time}")
             
-            # FFmpeg command to extract frame at specified time
-            cmd = [
-                'ffmpeg', '-i', full_video_path,
-                '-ss', seek_time,
-                '-vframes', '1',
-                '-q:v', '2',
-                '-vf', 'scale=320:180:force_original_aspect_ratio=decrease,pad=320:180:(ow-iw)/2:(oh-ih)/2',
-                '-y',
-                thumbnail_path
-            ]
+            # Scene mode falls back to a plain fast seek, then everything retries at 1 second
+            attempts = [(THUMBNAIL_MODE, seek_time)]
+            if THUMBNAIL_MODE == 'scene':
+                attempts.append(('fast', seek_time))
+            if seek_time != '00:00:01':
+                attempts.append((attempts[-1][0], '00:00:01'))
             
-            print(f"Running ffmpeg command: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=45)
+            # A stale thumbnail must not be mistaken for a fresh one
+            if os.path.exists(thumbnail_path):
+                os.remove(thumbnail_path)
             
-            if result.returncode == 0 and os.path.exists(thumbnail_path):
-                print(f"Thumbnail generated successfully: {thumbnail_path}")
-                return f"/static/thumbnails/{os.path.basename(thumbnail_path)}"
-            else:
-                print(f"FFmpeg failed with return code: {result.returncode}")
-                print(f"FFmpeg stderr: {result.stderr}")
+            for mode, attempt_seek in attempts:
+                cmd = build_thumbnail_command(full_video_path, attempt_seek, thumbnail_path, mode)
+                print(f"Running ffmpeg command: {' '.join(cmd)}")
+                result = run_media_command(cmd, timeout=45)
+                
+                if result.returncode == 0 and os.path.exists(thumbnail_path):
+                    print(f"Thumbnail generated successfully: {thumbnail_path}")
+                    return f"/static/thumbnails/{os.path.basename(thumbnail_path)}"
                 
-                # Try with a different seek time if first attempt failed
-                if seek_time != '00:00:01':
-                    print("Retrying with 1 second seek time")
-                    cmd[3] = '00:00:01'
-                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-                    
-                    if result.returncode == 0 and os.path.exists(thumbnail_path):
-                        print("Thumbnail generated on retry")
-                        return f"/static/thumbnails/{os.path.basename(thumbnail_path)}"
+                print(f"FFmpeg ({mode} at {attempt_seek}) failed with return code: {result.returncode}")
+                print(f"FFmpeg stderr: {result.stderr}")
                 
-                return create_placeholder_thumbnail(thumbnail_path)
+            return create_placeholder_thumbnail(thumbnail_path)
                 
         except (subprocess.TimeoutExpired, FileNotFoundError, subprocess.CalledProcessError) as e:
             print(f"FFmpeg error: {e}")
@@ -314,187 +891,2517 @@ def is_audio_file_detailed(filename):
     extension = filename.rsplit('.', 1)[1].lower()
     return extension in audio_extensions
 
-def get_video_duration(file_path):
-    """Get video duration using ffprobe"""
+def _parse_frame_rate(rate):
+    """Convert an ffprobe rate such as '30000/1001' to frames per second"""
     try:
-        full_path = os.path.join(UPLOAD_FOLDER, file_path)
-        cmd = [
-            'ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-            '-of', 'csv=p=0', full_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
-        if result.returncode == 0:
-            duration = float(result.stdout.strip())
-            print(f"Duration for {file_path}: {duration} seconds")
-            return duration
-    except Exception as e:
-        print(f"Error getting duration for {file_path}: {e}")
-        pass
-    return None
+        numerator, _, denominator = (rate or '').partition('/')
+        value = float(numerator) / float(denominator or 1)
+        return round(value, 3) if value > 0 else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def _to_number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+def probe_media(file_path):
+    """Run a single ffprobe over a file and return every field video_metadata stores"""
+    full_path = os.path.join(UPLOAD_FOLDER, file_path)
+    cmd = [
+        'ffprobe', '-v', 'quiet', '-print_format', 'json',
+        '-show_format', '-show_streams', full_path
+    ]
+    
+    try:
+        result = run_media_command(cmd, timeout=15)
+        if result.returncode != 0:
+            return None
+        data = json.loads(result.stdout or '{}')
+    except (subprocess.TimeoutExpired, FileNotFoundError, ValueError) as e:
+        print(f"Error probing {file_path}: {e}")
+        return None
+    
+    streams = data.get('streams', [])
+    media_format = data.get('format', {})
+    # Cover art in audio files shows up as a video stream flagged attached_pic
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'
+                  and not stream.get('disposition', {}).get('attached_pic')), None)
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    tags = {key.lower(): value for key, value in media_format.get('tags', {}).items()}
+    
+    subtitle_streams = []
+    for stream in streams:
+        if stream.get('codec_type') != 'subtitle' or stream.get('codec_name') not in SUBTITLE_EMBEDDED_CODECS:
+            continue
+        stream_tags = {key.lower(): value for key, value in stream.get('tags', {}).items()}
+        disposition = stream.get('disposition', {})
+        subtitle_streams.append({
+            'index': stream['index'],
+            'codec': stream['codec_name'],
+            'language': stream_tags.get('language'),
+            'title': stream_tags.get('title'),
+            'flags': [flag for flag in ('forced', 'default') if disposition.get(flag)]
+        })
+    
+    return {
+        'duration': _to_number(media_format.get('duration'), float),
+        'resolution': f"{video['width']}x{video['height']}" if video and video.get('width') else None,
+        'video_codec': video.get('codec_name') if video else None,
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'bitrate': _to_number(media_format.get('bit_rate'), int),
+        'frame_rate': _parse_frame_rate(video.get('avg_frame_rate') or video.get('r_frame_rate')) if video else None,
+        'audio_channels': audio.get('channels') if audio else None,
+        'stream_count': len(streams),
+        'title': tags.get('title'),
+        'subtitle_streams': subtitle_streams,
+        'has_video': video is not None
+    }
+
+_artifact_locks = [threading.Lock() for _ in range(64)]  # striped by fingerprint
+
+def generate_video_metadata(file_path, store_failures=True):
+    """Probe a file, generate its thumbnail and store the video_metadata row.
+    
+    Returns False when neither a thumbnail nor a duration could be produced;
+    the placeholder row is then only written if store_failures is set.
+    """
+    full_path = os.path.join(UPLOAD_FOLDER, file_path)
+    if not os.path.exists(full_path):
+        print(f"Skipping metadata for missing file: {file_path}")
+        return True
+    
+    fingerprint = get_file_fingerprint(file_path)
+    
+    # Identical files queued together wait for each other instead of sharing a thumbnail race
+    with _artifact_locks[int(fingerprint[:8], 16) % len(_artifact_locks) if fingerprint else 0]:
+        row = find_cached_metadata_row(file_path, fingerprint)
+        if row:
+            print(f"Reusing cached metadata for: {file_path}")
+            store_video_metadata([row])
+            return True
+        
+        row, success = build_video_metadata_row(file_path, fingerprint)
+        if not success and not store_failures:
+            return False
+        
+        store_video_metadata([row])
+        return success
+
+def file_fingerprint(full_path, stat):
+    """Hash the size and mtime plus the head, middle and tail blocks of a file"""
+    size = stat.st_size
+    digest = hashlib.blake2b(f'{size}:{stat.st_mtime_ns}'.encode(), digest_size=16)
+    with open(full_path, 'rb') as f:
+        if size <= 3 * FINGERPRINT_BLOCK_SIZE:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - FINGERPRINT_BLOCK_SIZE) // 2, size - FINGERPRINT_BLOCK_SIZE):
+                f.seek(offset)
+                digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return digest.hexdigest()
+
+def get_file_fingerprint(file_path):
+    """Fingerprint a library file, or None if it cannot be read"""
+    full_path = os.path.join(UPLOAD_FOLDER, file_path)
+    try:
+        return file_fingerprint(full_path, os.stat(full_path))
+    except OSError as e:
+        print(f"Could not fingerprint {file_path}: {e}")
+        return None
+
+def find_cached_metadata_row(file_path, fingerprint):
+    """Build a video_metadata row from the artifacts of an identical file, if any"""
+    if not fingerprint:
+        return None
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT {", ".join(MEDIA_ARTIFACT_COLUMNS)} FROM media_artifacts WHERE fingerprint = ?',
+                   (fingerprint,))
+    artifact = cursor.fetchone()
+    if not artifact:
+        return None
+    
+    thumbnail_url = artifact[0] or ''
+    if thumbnail_url.startswith('/static/thumbnails/') and \
+            not os.path.exists(os.path.join(THUMBNAILS_FOLDER, os.path.basename(thumbnail_url))):
+        return None
+    
+    try:
+        file_mtime = os.path.getmtime(os.path.join(UPLOAD_FOLDER, file_path))
+    except OSError:
+        return None
+    return (file_path,) + tuple(artifact) + (file_mtime, fingerprint)
+
+def build_video_metadata_row(file_path, fingerprint=None):
+    """Probe a file and generate its thumbnail without touching the database.
+    
+    Returns (row, success) where row is ready for store_video_metadata().
+    Thumbnails are named after the fingerprint so identical files share them.
+    """
+    full_path = os.path.join(UPLOAD_FOLDER, file_path)
+    
+    # Stat before probing so a file rewritten meanwhile shows up as changed
+    try:
+        stat = os.stat(full_path)
+        file_size, file_mtime = stat.st_size, stat.st_mtime
+    except OSError:
+        file_size, file_mtime = 0, None
+    
+    if fingerprint is None:
+        fingerprint = get_file_fingerprint(file_path)
+    thumbnail_filename = (fingerprint or hashlib.md5(file_path.encode()).hexdigest()) + '.jpg'
+    thumbnail_path = os.path.join(THUMBNAILS_FOLDER, thumbnail_filename)
+    
+    print(f"Processing metadata for: {file_path}")
+    
+    # One probe fills every metadata column; audio-only files skip ffmpeg entirely
+    probe = probe_media(file_path) or {}
+    if probe.get('has_video') or not probe:
+        thumbnail_url = generate_thumbnail(file_path, thumbnail_path, probe.get('duration'))
+    else:
+        thumbnail_url = create_placeholder_thumbnail(thumbnail_path)
+    
+    duration = probe.get('duration')
+    subtitle_streams = probe.get('subtitle_streams')
+    print(f"Metadata - Size: {file_size}, Duration: {duration}, Thumbnail: {thumbnail_url}")
+    
+    row = (
+        file_path, thumbnail_url, file_size, duration, probe.get('resolution'),
+        probe.get('video_codec'), probe.get('audio_codec'), probe.get('bitrate'),
+        probe.get('frame_rate'), probe.get('audio_channels'), probe.get('stream_count'),
+        probe.get('title'), None if subtitle_streams is None else json.dumps(subtitle_streams),
+        file_mtime, fingerprint
+    )
+    return row, bool(probe) or not (thumbnail_url or '').startswith('data:')
+
+def store_video_metadata(rows):
+    """Write video_metadata rows in a single transaction.
+    
+    Each row holds the columns in VIDEO_METADATA_COLUMNS order. Rows with a
+    fingerprint and real probe data or thumbnail also refresh media_artifacts.
+    """
+    if not rows:
+        return
+    
+    artifacts = [
+        (row[-1],) + tuple(row[1:-len(VIDEO_METADATA_STAT_COLUMNS)]) + (time.time(),)
+        for row in rows
+        if row[-1] and (row[3] is not None or not (row[1] or '').startswith('data:'))
+    ]
+    
+    conn = get_db()
+    with conn:
+        # An upsert keeps id and created_at of files that are merely refreshed
+        conn.executemany(f'''
+            INSERT INTO video_metadata ({', '.join(VIDEO_METADATA_COLUMNS)})
+            VALUES ({', '.join('?' * len(VIDEO_METADATA_COLUMNS))})
+            ON CONFLICT(file_path) DO UPDATE SET
+                {', '.join(f'{column} = excluded.{column}' for column in VIDEO_METADATA_COLUMNS[1:])}
+        ''', rows)
+        conn.executemany(f'''
+            INSERT OR REPLACE INTO media_artifacts (fingerprint, {', '.join(MEDIA_ARTIFACT_COLUMNS)}, last_used)
+            VALUES ({', '.join('?' * (len(MEDIA_ARTIFACT_COLUMNS) + 2))})
+        ''', artifacts)
+
+def prune_media_artifacts():
+    """Delete artifacts no file has referenced for ARTIFACT_RETENTION seconds"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT fingerprint, thumbnail_path FROM media_artifacts a
+        WHERE last_used < ? AND NOT EXISTS (SELECT 1 FROM video_metadata vm WHERE vm.fingerprint = a.fingerprint)
+    ''', (time.time() - ARTIFACT_RETENTION,))
+    expired = cursor.fetchall()
+    if not expired:
+        return
+    
+    with conn:
+        conn.executemany('DELETE FROM media_artifacts WHERE fingerprint = ?',
+                         [(fingerprint,) for fingerprint, _ in expired])
+    for _, thumbnail_url in expired:
+        if thumbnail_url and thumbnail_url.startswith('/static/thumbnails/'):
+            try:
+                os.remove(os.path.join(THUMBNAILS_FOLDER, os.path.basename(thumbnail_url)))
+            except OSError:
+                pass
+    
+    # Extracted embedded subtitles are named '<fingerprint>_<stream index>.vtt'
+    prefixes = tuple(f'{fingerprint}_' for fingerprint, _ in expired)
+    for filename in os.listdir(SUBTITLE_CACHE_FOLDER):
+        if filename.startswith(prefixes):
+            try:
+                os.remove(os.path.join(SUBTITLE_CACHE_FOLDER, filename))
+            except OSError:
+                pass
+    print(f"Pruned {len(expired)} unused media artifacts")
 
 def get_video_metadata(file_path):
-    """Get video metadata including thumbnail"""
-    conn = sqlite3.connect(DATABASE_FILE)
+    """Get video metadata including thumbnail.
+    
+    Files without a row are queued for background processing and a pending
+    placeholder (id None, no thumbnail or duration) is returned immediately.
+    """
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM video_metadata WHERE file_path = ?', (file_path,))
     metadata = cursor.fetchone()
     
     if not metadata:
-        # Generate new metadata
-        thumbnail_filename = hashlib.md5(file_path.encode()).hexdigest() + '.jpg'
-        thumbnail_path = os.path.join(THUMBNAILS_FOLDER, thumbnail_filename)
-        
-        print(f"Processing metadata for: {file_path}")
+        queue_metadata_job(file_path)
+        metadata = (None, file_path, None, None, None, None, None)
+    
+    return metadata
+
+# Media job scheduler
+_media_condition = threading.Condition()
+_media_queue = []  # heap of (priority, sequence, job)
+_media_running = []  # jobs currently executing
+_media_sequence = itertools.count()
+_media_workers = []
+_media_local = threading.local()  # .job of the worker thread
+_media_external = 0  # ffmpeg/ffprobe processes started outside a job, e.g. by request threads
+_media_stats = [{'started': 0, 'cancelled': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+                for _ in MEDIA_PRIORITY_NAMES]
+
+def submit_media_job(priority, fn, *args, owner=None, tag=None):
+    """Queue fn(*args) on the media workers and return a Future for its result.
+    
+    owner and tag identify the job for cancel_media_jobs(); further owners
+    sharing the job are added with add_media_job_owner().
+    """
+    job = {
+        'fn': fn, 'args': args, 'priority': priority, 'owners': set() if owner is None else {owner},
+        'tag': tag, 'future': Future(), 'process': None, 'killed': False, 'submitted': time.time()
+    }
+    with _media_condition:
+        while len(_media_workers) < MEDIA_JOB_WORKERS:
+            worker = threading.Thread(target=_media_worker, daemon=True,
+                                      name=f'media-{len(_media_workers)}')
+            worker.start()
+            _media_workers.append(worker)
         
-        # Generate thumbnail
-        thumbnail_url = generate_thumbnail(file_path, thumbnail_path)
+        heapq.heappush(_media_queue, (priority, next(_media_sequence), job))
+        _media_condition.notify_all()
+    return job['future']
+
+def _next_media_job_allowed():
+    """Whether the head of the queue may start now (called with _media_condition held)"""
+    if not _media_queue:
+        return False
+    # Processes started outside the scheduler count against the same limit
+    if len(_media_running) + _media_external >= MEDIA_JOB_WORKERS:
+        return False
+    if _media_queue[0][0] == MEDIA_PRIORITY_INTERACTIVE:
+        return True
+    # Keep reserved workers free so playback never waits behind a thumbnail backlog
+    busy = sum(1 for job in _media_running if job['priority'] != MEDIA_PRIORITY_INTERACTIVE)
+    return busy < MEDIA_JOB_WORKERS - MEDIA_JOB_RESERVED_INTERACTIVE
+
+def _media_worker():
+    while True:
+        with _media_condition:
+            while not _next_media_job_allowed():
+                _media_condition.wait()
+            
+            job = heapq.heappop(_media_queue)[2]
+            stats = _media_stats[job['priority']]
+            if not job['future'].set_running_or_notify_cancel():
+                stats['cancelled'] += 1
+                continue
+            
+            waited = time.time() - job['submitted']
+            stats['started'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            _media_running.append(job)
         
-        # Get file size and duration
+        _media_local.job = job
         try:
-            full_path = os.path.join(UPLOAD_FOLDER, file_path)
-            file_size = os.path.getsize(full_path)
-            duration = get_video_duration(file_path)
-        except:
-            file_size = 0
-            duration = None
-        
-        print(f"Metadata - Size: {file_size}, Duration: {duration}, Thumbnail: {thumbnail_url}")
+            result = job['fn'](*job['args'])
+            # A job whose process was killed by cancel_media_jobs() reports cancellation,
+            # not the failure that the kill caused
+            job['future'].set_exception(CancelledError()) if job['killed'] else job['future'].set_result(result)
+        except BaseException as e:
+            job['future'].set_exception(CancelledError() if job['killed'] else e)
+        finally:
+            _media_local.job = None
+            with _media_condition:
+                _media_running.remove(job)
+                _media_condition.notify_all()
+
+def add_media_job_owner(future, owner):
+    """Register another owner for a queued or running job; False if the job is gone or cancelled"""
+    with _media_condition:
+        for job in [entry[2] for entry in _media_queue] + _media_running:
+            if job['future'] is future:
+                if job['killed'] or future.cancelled():
+                    return False
+                if owner is not None:
+                    job['owners'].add(owner)
+                return True
+    return future.done() and not future.cancelled() and not isinstance(future.exception(), CancelledError)
+
+def cancel_media_jobs(owner, keep=(), tags=None):
+    """Withdraw owner from its jobs whose tag is not in keep (and is in tags, if given).
+    
+    Jobs that no other owner still waits for are cancelled: queued ones are
+    dropped, running ones have their ffmpeg/ffprobe killed.
+    """
+    cancelled = 0
+    with _media_condition:
+        for job in [entry[2] for entry in _media_queue] + _media_running:
+            if owner not in job['owners'] or job['tag'] in keep or (tags is not None and job['tag'] not in tags):
+                continue
+            job['owners'].discard(owner)
+            if job['owners']:
+                continue
+            
+            cancelled += 1
+            if not job['future'].cancel() and job['process'] is not None:
+                job['killed'] = True
+                try:
+                    job['process'].kill()
+                except OSError:
+                    pass
+    return cancelled
+
+def limit_media_process(pid, priority):
+    """Apply the nice level and CPU affinity of a priority class to a process"""
+    try:
+        if MEDIA_JOB_NICE[priority] and hasattr(os, 'setpriority'):
+            niceness = min(os.getpriority(os.PRIO_PROCESS, 0) + MEDIA_JOB_NICE[priority], 19)
+            os.setpriority(os.PRIO_PROCESS, pid, niceness)
+        if MEDIA_JOB_CPUS and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(pid, MEDIA_JOB_CPUS)
+    except OSError as e:  # the process already exited, or the limit is not permitted
+        print(f"Could not limit media process {pid}: {e}")
+
+def _acquire_media_slot():
+    global _media_external
+    with _media_condition:
+        while len(_media_running) + _media_external >= MEDIA_JOB_WORKERS:
+            _media_condition.wait()
+        _media_external += 1
+
+def release_media_slot():
+    """Give back the slot a process started outside a media job was holding"""
+    global _media_external
+    with _media_condition:
+        _media_external -= 1
+        _media_condition.notify_all()
+
+def start_media_process(cmd, **popen_args):
+    """subprocess.Popen for ffmpeg/ffprobe.
+    
+    The process gets the limits of the calling media job (interactive outside
+    the scheduler) and is killed if the job is cancelled while it runs.
+    Outside a job it waits for one of the MEDIA_JOB_WORKERS slots; the caller
+    must call release_media_slot() once the process has exited.
+    """
+    job = getattr(_media_local, 'job', None)
+    if job is None:
+        _acquire_media_slot()
+    try:
+        process = subprocess.Popen(cmd, **popen_args)
+    except BaseException:
+        if job is None:
+            release_media_slot()
+        raise
+    limit_media_process(process.pid, job['priority'] if job else MEDIA_PRIORITY_INTERACTIVE)
+    if job:
+        job['process'] = process
+    return process
+
+def run_media_command(cmd, timeout):
+    """subprocess.run(cmd, capture_output=True, text=True) under start_media_process()"""
+    job = getattr(_media_local, 'job', None)
+    process = start_media_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    finally:
+        if job:
+            job['process'] = None
+        else:
+            release_media_slot()
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def get_media_job_stats():
+    """Return queue depth, running jobs and wait times per priority class"""
+    now = time.time()
+    with _media_condition:
+        queued = [entry[2] for entry in _media_queue if not entry[2]['future'].cancelled()]
+        classes = {}
+        for priority, name in enumerate(MEDIA_PRIORITY_NAMES):
+            stats = _media_stats[priority]
+            waiting = [now - job['submitted'] for job in queued if job['priority'] == priority]
+            classes[name] = {
+                'queued': len(waiting),
+                'running': sum(1 for job in _media_running if job['priority'] == priority),
+                'started': stats['started'],
+                'cancelled': stats['cancelled'],
+                'avg_wait': round(stats['wait_total'] / stats['started'], 3) if stats['started'] else 0.0,
+                'max_wait': round(stats['wait_max'], 3),
+                'oldest_queued': round(max(waiting, default=0.0), 3)
+            }
+        return {'workers': MEDIA_JOB_WORKERS, 'outside_jobs': _media_external, 'classes': classes}
+
+# Background metadata jobs
+_metadata_lock = threading.Lock()
+_metadata_jobs = {}  # file_path -> Future of the in-flight job
+_metadata_failures = {}  # file_path -> (failed attempts, earliest retry time)
+
+def queue_metadata_job(file_path, retry=False, priority=MEDIA_PRIORITY_THUMBNAIL):
+    """Queue metadata generation for file_path unless it is already in flight.
+    
+    Returns False while the file is waiting out a retry backoff, unless this
+    call is the scheduled retry itself.
+    """
+    with _metadata_lock:
+        if file_path in _metadata_jobs:
+            return True
         
-        # Insert metadata
-        cursor.execute('''
-            INSERT INTO video_metadata (file_path, thumbnail_path, file_size, duration)
-            VALUES (?, ?, ?, ?)
-        ''', (file_path, thumbnail_url, file_size, duration))
+        if not retry and time.time() < _metadata_failures.get(file_path, (0, 0))[1]:
+            return False
         
-        conn.commit()
-        metadata = (cursor.lastrowid, file_path, thumbnail_url, duration, None, file_size, datetime.now())
+        _metadata_jobs[file_path] = submit_media_job(priority, _run_metadata_job, file_path)
+        return True
+
+def queue_metadata_jobs(file_paths, priority=MEDIA_PRIORITY_THUMBNAIL):
+    """Queue metadata generation for many files under a single lock acquisition"""
+    if not file_paths:
+        return
     
-    conn.close()
-    return metadata
+    now = time.time()
+    with _metadata_lock:
+        for file_path in file_paths:
+            if file_path in _metadata_jobs or now < _metadata_failures.get(file_path, (0, 0))[1]:
+                continue
+            _metadata_jobs[file_path] = submit_media_job(priority, _run_metadata_job, file_path)
 
-def scan_directory_recursive(directory_path, base_path='', sort_by='name', sort_order='asc'):
-    """Recursively scan directory for media files with metadata and sorting"""
-    items = []
+def _run_metadata_job(file_path):
+    """Worker body: generate metadata and schedule a retry with backoff on failure"""
+    attempts = _metadata_failures.get(file_path, (0, 0))[0] + 1
+    final_attempt = attempts >= METADATA_MAX_ATTEMPTS
     
     try:
-        if not os.path.exists(directory_path):
-            return items
-            
-        for item in os.listdir(directory_path):
-            item_path = os.path.join(directory_path, item)
-            relative_path = os.path.join(base_path, item) if base_path else item
-            
-            if os.path.isdir(item_path):
-                # It's a directory
-                folder_info = {
-                    'name': item,
-                    'type': 'folder',
-                    'path': relative_path,
-                    'full_path': item_path,
-                    'size': 0,
-                    'modified': os.path.getmtime(item_path),
-                    'children': scan_directory_recursive(item_path, relative_path, sort_by, sort_order)
-                }
-                items.append(folder_info)
-            elif allowed_file(item):
-                # It's a media file
-                print(f"Found media file: {item}")
-                file_size = os.path.getsize(item_path)
-                file_modified = os.path.getmtime(item_path)
-                metadata = get_video_metadata(relative_path)
-                
-                file_info = {
-                    'name': item,
-                    'type': get_file_type(item),
-                    'path': relative_path,
-                    'full_path': item_path,
-                    'url': f'/static/videos/{relative_path.replace(os.sep, "/").replace(chr(92), "/")}',
-                    'size': file_size,
-                    'modified': file_modified,
-                    'thumbnail': metadata[2] if metadata else None,
-                    'duration': metadata[3] if metadata else None,
-                    'resolution': metadata[4] if metadata else None
-                }
-                print(f"Added file info: {file_info['name']} - Type: {file_info['type']}")
-                items.append(file_info)
-            else:
-                print(f"File not allowed: {item}")
-    except PermissionError:
-        print(f"Permission denied for directory: {directory_path}")
-        pass
+        success = generate_video_metadata(file_path, store_failures=final_attempt)
     except Exception as e:
-        print(f"Error scanning directory {directory_path}: {e}")
+        print(f"Metadata job failed for {file_path}: {e}")
+        success = False
+    finally:
+        release_db()
+    
+    with _metadata_lock:
+        _metadata_jobs.pop(file_path, None)
+        
+        if success or final_attempt:
+            _metadata_failures.pop(file_path, None)
+            return
+        
+        delay = METADATA_RETRY_BACKOFF * 2 ** (attempts - 1)
+        print(f"Retrying metadata for {file_path} in {delay} seconds (attempt {attempts} failed)")
+        _metadata_failures[file_path] = (attempts, time.time() + delay)
     
-    # Sort items
-    return sort_items(items, sort_by, sort_order)
+    retry = threading.Timer(delay, queue_metadata_job, args=(file_path, True))
+    retry.daemon = True
+    retry.start()
 
-def sort_items(items, sort_by='name', sort_order='asc'):
-    """Sort items based on criteria"""
-    reverse = sort_order == 'desc'
+def get_metadata_queue_stats():
+    """Return counts of in-flight and backing-off metadata jobs"""
+    with _metadata_lock:
+        return {
+            'in_flight': len(_metadata_jobs),
+            'retrying': len(_metadata_failures),
+            'workers': MEDIA_JOB_WORKERS
+        }
+
+# Seek-bar preview sprites
+_preview_jobs = {}  # file_path -> Future of the in-flight sprite job
+_preview_failed = {}  # file_path -> mtime of the file when generation failed
+
+def format_vtt_timestamp(seconds):
+    """Format seconds as a WebVTT HH:MM:SS.mmm timestamp"""
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+def get_preview_paths(file_path):
+    """Return (sprite_path, vtt_path) for a video's seek-bar previews"""
+    key = hashlib.md5(file_path.encode()).hexdigest()
+    return os.path.join(SPRITES_FOLDER, key + '.jpg'), os.path.join(SPRITES_FOLDER, key + '.vtt')
+
+def generate_preview_sprite(file_path):
+    """Render one tiled sprite sheet in a single ffmpeg pass plus its WebVTT thumbnails track"""
+    full_path = os.path.join(UPLOAD_FOLDER, file_path)
+    sprite_path, vtt_path = get_preview_paths(file_path)
     
-    if sort_by == 'name':
-        items.sort(key=lambda x: x['name'].lower(), reverse=reverse)
-    elif sort_by == 'size':
-        items.sort(key=lambda x: x.get('size', 0), reverse=reverse)
-    elif sort_by == 'modified':
-        items.sort(key=lambda x: x.get('modified', 0), reverse=reverse)
+    metadata = get_video_metadata(file_path)
+    duration = metadata[3]
+    if duration is None:
+        probe = probe_media(file_path)
+        duration = probe['duration'] if probe else None
+    if not duration:
+        print(f"Cannot build previews without a duration: {file_path}")
+        return False
+    
+    max_tiles = SPRITE_COLUMNS * SPRITE_ROWS
+    interval = max(SPRITE_MIN_INTERVAL, duration / max_tiles)
+    tile_count = min(max_tiles, int(-(-duration // interval)))
+    rows = -(-tile_count // SPRITE_COLUMNS)
+    width, height = SPRITE_TILE_WIDTH, SPRITE_TILE_HEIGHT
+    
+    # Keyframe-only decode; the fps filter repeats the nearest keyframe for each slot
+    tile_filter = (f"fps=1/{interval:.3f},"
+                   f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                   f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,"
+                   f"tile={SPRITE_COLUMNS}x{rows}")
+    temp_sprite = sprite_path + '.tmp.jpg'
+    cmd = [
+        'ffmpeg', '-skip_frame', 'nokey', '-i', full_path,
+        '-vf', tile_filter, '-frames:v', '1', '-q:v', '5', '-y', temp_sprite
+    ]
+    
+    print(f"Generating preview sprite for: {file_path}")
+    try:
+        result = run_media_command(cmd, timeout=SPRITE_TIMEOUT)
+    except (subprocess.TimeoutExpired, FileNotFoundError) as e:
+        print(f"FFmpeg error while building sprite for {file_path}: {e}")
+        return False
+    
+    if result.returncode != 0 or not os.path.exists(temp_sprite):
+        print(f"Sprite generation failed for {file_path}: {result.stderr}")
+        return False
+    
+    sprite_url = f"/static/thumbnails/sprites/{os.path.basename(sprite_path)}"
+    cues = ['WEBVTT', '']
+    for index in range(tile_count):
+        start = index * interval
+        end = min((index + 1) * interval, duration)
+        x = (index % SPRITE_COLUMNS) * width
+        y = (index // SPRITE_COLUMNS) * height
+        cues.append(f"{format_vtt_timestamp(start)} --> {format_vtt_timestamp(end)}")
+        cues.append(f"{sprite_url}#xywh={x},{y},{width},{height}")
+        cues.append('')
+    
+    temp_vtt = vtt_path + '.tmp'
+    with open(temp_vtt, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(cues))
+    os.replace(temp_sprite, sprite_path)
+    os.replace(temp_vtt, vtt_path)
+    return True
+
+def _run_preview_job(file_path):
+    try:
+        success = generate_preview_sprite(file_path)
+    except Exception as e:
+        print(f"Preview job failed for {file_path}: {e}")
+        success = False
+    finally:
+        release_db()
+    
+    with _metadata_lock:
+        _preview_jobs.pop(file_path, None)
+        if not success:
+            try:
+                _preview_failed[file_path] = os.path.getmtime(os.path.join(UPLOAD_FOLDER, file_path))
+            except OSError:
+                pass
+
+def queue_preview_job(file_path):
+    """Queue sprite generation on the media workers unless already in flight"""
+    with _metadata_lock:
+        if file_path not in _preview_jobs:
+            _preview_failed.pop(file_path, None)
+            _preview_jobs[file_path] = submit_media_job(MEDIA_PRIORITY_THUMBNAIL, _run_preview_job, file_path)
+
+# Audio waveform peaks
+_waveform_jobs = {}  # file_path -> Future of the in-flight waveform job
+_waveform_failed = {}  # file_path -> mtime of the file when generation failed
+
+WAVEFORM_MAGIC = b'XPWF'
+WAVEFORM_VERSION = 1
+
+def get_waveform_path(file_path):
+    key = hashlib.md5(file_path.encode()).hexdigest()
+    return os.path.join(WAVEFORMS_FOLDER, key + '.wf')
+
+def reduce_peaks(mins, maxs, factor):
+    """Merge every factor consecutive buckets into one (the last one may be partial)"""
+    whole = len(mins) // factor * factor
+    reduced_min = mins[:whole].reshape(-1, factor).min(axis=1)
+    reduced_max = maxs[:whole].reshape(-1, factor).max(axis=1)
+    if whole < len(mins):
+        reduced_min = np.append(reduced_min, mins[whole:].min())
+        reduced_max = np.append(reduced_max, maxs[whole:].max())
+    return reduced_min, reduced_max
+
+def generate_waveform(file_path):
+    """Decode the audio once to 16-bit mono PCM and store min/max peaks for every zoom level.
+    
+    The PCM is read in chunks, so memory only grows with the number of peaks.
+    File layout (little endian): magic, version (u8), bits (u8), level count
+    (u16), sample rate (u32), then per level samples per bucket and bucket
+    count (u32 each), then each level's interleaved min/max values.
+    """
+    full_path = os.path.join(UPLOAD_FOLDER, file_path)
+    waveform_path = get_waveform_path(file_path)
+    bucket = WAVEFORM_LEVELS[0]
+    chunk_bytes = bucket * 2 * 4096
+    cmd = [
+        'ffmpeg', '-v', 'error', '-i', full_path, '-map', '0:a:0', '-ac', '1',
+        '-ar', str(WAVEFORM_SAMPLE_RATE), '-f', 's16le', 'pipe:1'
+    ]
+    
+    print(f"Generating waveform for: {file_path}")
+    try:
+        process = start_media_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except FileNotFoundError as e:
+        print(f"FFmpeg error while building waveform for {file_path}: {e}")
+        return False
+    
+    timer = threading.Timer(WAVEFORM_TIMEOUT, process.kill)
+    timer.start()
+    mins, maxs = [], []
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            samples = np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+            if len(samples):
+                chunk_min, chunk_max = reduce_peaks(samples, samples, bucket)
+                mins.append(chunk_min)
+                maxs.append(chunk_max)
+        returncode = process.wait()
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+    
+    if returncode != 0 or not mins:
+        print(f"Waveform generation failed for {file_path} (ffmpeg exit {returncode})")
+        return False
+    
+    levels = [(bucket, np.concatenate(mins), np.concatenate(maxs))]
+    for samples_per_bucket in WAVEFORM_LEVELS[1:]:
+        level_min, level_max = reduce_peaks(levels[0][1], levels[0][2], samples_per_bucket // bucket)
+        levels.append((samples_per_bucket, level_min, level_max))
+    
+    header = [WAVEFORM_MAGIC, struct.pack('<BBHI', WAVEFORM_VERSION, WAVEFORM_BITS, len(levels),
+                                          WAVEFORM_SAMPLE_RATE)]
+    body = []
+    for samples_per_bucket, level_min, level_max in levels:
+        header.append(struct.pack('<II', samples_per_bucket, len(level_min)))
+        peaks = np.column_stack((level_min, level_max))
+        if WAVEFORM_BITS == 8:
+            peaks = peaks >> 8
+        body.append(peaks.astype('<i1' if WAVEFORM_BITS == 8 else '<i2').tobytes())
+    
+    temp_path = waveform_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(b''.join(header + body))
+    os.replace(temp_path, waveform_path)
+    return True
+
+def _run_waveform_job(file_path):
+    try:
+        success = generate_waveform(file_path)
+    except Exception as e:
+        print(f"Waveform job failed for {file_path}: {e}")
+        success = False
+    
+    with _metadata_lock:
+        _waveform_jobs.pop(file_path, None)
+        if not success:
+            try:
+                _waveform_failed[file_path] = os.path.getmtime(os.path.join(UPLOAD_FOLDER, file_path))
+            except OSError:
+                pass
+
+def queue_waveform_job(file_path):
+    """Queue waveform generation on the media workers unless already in flight"""
+    with _metadata_lock:
+        if file_path not in _waveform_jobs:
+            _waveform_failed.pop(file_path, None)
+            _waveform_jobs[file_path] = submit_media_job(MEDIA_PRIORITY_THUMBNAIL, _run_waveform_job, file_path)
+
+# Library index
+_library_lock = threading.Lock()
+_library_checked = {}
+_library_refresh_lock = threading.Lock()
+_library_refresh_thread = None
+
+def _library_subtree_bounds(rel_dir):
+    """Return (low, high) so that low <= path < high selects everything below rel_dir"""
+    return rel_dir + os.sep, rel_dir + chr(ord(os.sep) + 1)
+
+def _remove_from_library(cursor, rel_dir):
+    """Drop a directory and everything below it from the index"""
+    low, high = _library_subtree_bounds(rel_dir)
+    cursor.execute('DELETE FROM library_index WHERE path = ? OR (path >= ? AND path < ?)', (rel_dir, low, high))
+    cursor.execute('DELETE FROM library_dirs WHERE path = ? OR (path >= ? AND path < ?)', (rel_dir, low, high))
+    delete_subtitle_rows(cursor, "source = 'sidecar' AND (parent = ? OR (parent >= ? AND parent < ?))",
+                         (rel_dir, low, high))
+
+def is_library_path(relative_path):
+    """True for a normalized relative path below UPLOAD_FOLDER (no '.', '..', empty or absolute parts)"""
+    if not relative_path:
+        return True
+    parts = relative_path.replace(os.sep, '/').split('/')
+    return safe_join(UPLOAD_FOLDER, *parts) is not None and all(part not in ('', '.', '..') for part in parts)
+
+def index_directory(cursor, rel_dir):
+    """List one directory into library_index, replacing its previous entries"""
+    if not is_library_path(rel_dir):
+        raise ValueError(f'Path outside the library: {rel_dir}')
+    full_dir = os.path.join(UPLOAD_FOLDER, rel_dir) if rel_dir else UPLOAD_FOLDER
+    dir_mtime = os.stat(full_dir).st_mtime
+    entries = []
+    sidecars = []
+    
+    with os.scandir(full_dir) as it:
+        for entry in it:
+            relative_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+            try:
+                if entry.is_dir():
+                    entries.append((relative_path, rel_dir, entry.name, 'folder', 0, entry.stat().st_mtime))
+                elif allowed_file(entry.name):
+                    stat = entry.stat()
+                    entries.append((relative_path, rel_dir, entry.name, get_file_type(entry.name),
+                                    stat.st_size, stat.st_mtime))
+                elif allowed_subtitle(entry.name):
+                    sidecars.append((relative_path, entry.stat().st_mtime))
+            except OSError as e:
+                print(f"Error indexing {relative_path}: {e}")
+    
+    sync_subtitle_rows(cursor, 'sidecar', rel_dir, sidecars)
+    
+    # Only rows that actually changed are written, so rescans leave the search index alone
+    cursor.execute('SELECT path, item_type, size, modified FROM library_index WHERE parent = ?', (rel_dir,))
+    existing = {row[0]: row[1:] for row in cursor.fetchall()}
+    current = {entry[0]: entry[3:] for entry in entries}
+    
+    for old_path, (old_type, _, _) in existing.items():
+        if old_type == 'folder' and current.get(old_path, (None,))[0] != 'folder':
+            # Subfolders that disappeared take their whole subtree with them
+            _remove_from_library(cursor, old_path)
+        elif old_path not in current:
+            cursor.execute('DELETE FROM library_index WHERE path = ?', (old_path,))
+    
+    cursor.executemany('''
+        INSERT OR REPLACE INTO library_index (path, parent, name, item_type, size, modified)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [entry for entry in entries if existing.get(entry[0]) != entry[3:]])
+    cursor.execute('INSERT OR REPLACE INTO library_dirs (path, mtime) VALUES (?, ?)', (rel_dir, dir_mtime))
+
+def refresh_library_index(rel_dir='', recursive=True, force=False):
+    """Bring the index for rel_dir (and optionally its subtree) up to date.
+    
+    Each directory is stat'ed at most once per LIBRARY_INDEX_TTL seconds and is
+    only re-listed when its mtime differs from the one recorded at the last scan.
+    """
+    if not is_library_path(rel_dir):
+        raise ValueError(f'Path outside the library: {rel_dir}')
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    now = time.time()
+    pending = [rel_dir]
+    
+    with _library_lock:
+        while pending:
+            current = pending.pop()
+            
+            if force or now - _library_checked.get(current, 0) >= LIBRARY_INDEX_TTL:
+                full_dir = os.path.join(UPLOAD_FOLDER, current) if current else UPLOAD_FOLDER
+                try:
+                    dir_mtime = os.stat(full_dir).st_mtime
+                    cursor.execute('SELECT mtime FROM library_dirs WHERE path = ?', (current,))
+                    row = cursor.fetchone()
+                    if force or not row or row[0] != dir_mtime:
+                        index_directory(cursor, current)
+                    _library_checked[current] = now
+                except FileNotFoundError:
+                    if current:
+                        _remove_from_library(cursor, current)
+                    continue
+                except PermissionError:
+                    print(f"Permission denied for directory: {full_dir}")
+                    continue
+            
+            if recursive:
+                cursor.execute("SELECT path FROM library_index WHERE parent = ? AND item_type = 'folder'", (current,))
+                pending.extend(row[0] for row in cursor.fetchall())
+        
+        conn.commit()
+
+def _refresh_library_in_background():
+    try:
+        refresh_library_index()
+    except Exception as e:
+        print(f"Background library refresh failed: {e}")
+    finally:
+        release_db()
+
+def schedule_library_refresh():
+    """Refresh the whole index on a background thread once LIBRARY_INDEX_TTL has passed.
+    
+    Requests answer from the persisted index meanwhile; only a library that was
+    never indexed is scanned on the request thread. Nothing is scheduled in the
+    process running the watcher, which applies changes as they happen.
+    """
+    global _library_refresh_thread
+    if _library_watcher is not None or time.time() - _library_checked.get('', 0) < LIBRARY_INDEX_TTL:
+        return
+    
+    cursor = get_db().cursor()
+    cursor.execute("SELECT 1 FROM library_dirs WHERE path = ''")
+    if cursor.fetchone() is None:
+        refresh_library_index()
+        return
+    
+    with _library_refresh_lock:
+        if _library_refresh_thread is None or not _library_refresh_thread.is_alive():
+            _library_refresh_thread = threading.Thread(target=_refresh_library_in_background,
+                                                       name='library-refresh', daemon=True)
+            _library_refresh_thread.start()
+
+LIBRARY_COLUMNS = '''
+    li.path, li.parent, li.name, li.item_type, li.size, li.modified,
+    vm.thumbnail_path, vm.duration, vm.resolution
+'''
+LIBRARY_JOIN = 'library_index li LEFT JOIN video_metadata vm ON vm.file_path = li.path'
+
+def library_item(row):
+    """Build the browse/search dict for a library_index row"""
+    path, parent, name, item_type, size, modified, thumbnail, duration, resolution = row
+    full_path = os.path.join(UPLOAD_FOLDER, path)
+    
+    if item_type == 'folder':
+        return {
+            'name': name,
+            'type': 'folder',
+            'path': path,
+            'full_path': full_path,
+            'size': 0,
+            'modified': modified
+        }
+    
+    # No joined video_metadata row yet; queue_missing_metadata() has queued it
+    metadata_status = 'pending' if thumbnail is None and duration is None else 'ready'
+    
+    return {
+        'name': name,
+        'type': item_type,
+        'path': path,
+        'full_path': full_path,
+        'url': f'/static/videos/{path.replace(os.sep, "/").replace(chr(92), "/")}',
+        'size': size,
+        'modified': modified,
+        'thumbnail': thumbnail,
+        'duration': duration,
+        'resolution': resolution,
+        'metadata_status': metadata_status
+    }
+
+def queue_missing_metadata(rows, priority=MEDIA_PRIORITY_THUMBNAIL):
+    """Queue metadata jobs for every file row whose LEFT JOIN found no metadata"""
+    queue_metadata_jobs([row[0] for row in rows
+                         if row[3] != 'folder' and row[6] is None and row[7] is None], priority)
+
+def get_library_tree(rel_dir='', sort_by='name', sort_order='asc'):
+    """Return the nested folder/file tree below rel_dir from the library index"""
+    refresh_library_index(rel_dir)
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    if rel_dir:
+        low, high = _library_subtree_bounds(rel_dir)
+        cursor.execute(f'SELECT {LIBRARY_COLUMNS} FROM {LIBRARY_JOIN} WHERE li.path >= ? AND li.path < ?',
+                       (low, high))
+    else:
+        cursor.execute(f'SELECT {LIBRARY_COLUMNS} FROM {LIBRARY_JOIN}')
+    rows = cursor.fetchall()
+    queue_missing_metadata(rows)
+    
+    children = {}
+    for row in rows:
+        children.setdefault(row[1], []).append(library_item(row))
+    
+    def attach(parent):
+        items = children.get(parent, [])
+        for item in items:
+            if item['type'] == 'folder':
+                item['children'] = attach(item['path'])
+        return sort_items(items, sort_by, sort_order)
+    
+    return attach(rel_dir)
+
+def get_library_folder_stats(folder_paths):
+    """Return {folder: (child_count, total_size)} for the given folders from the index"""
+    if not folder_paths:
+        return {}
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(folder_paths))
+    cursor.execute(f'''
+        SELECT parent, COUNT(*) FROM library_index
+        WHERE parent IN ({placeholders}) GROUP BY parent
+    ''', folder_paths)
+    child_counts = dict(cursor.fetchall())
+    
+    stats = {}
+    for folder_path in folder_paths:
+        low, high = _library_subtree_bounds(folder_path)
+        cursor.execute('''
+            SELECT SUM(size) FROM library_index
+            WHERE path >= ? AND path < ? AND item_type != 'folder'
+        ''', (low, high))
+        stats[folder_path] = (child_counts.get(folder_path, 0), cursor.fetchone()[0] or 0)
+    
+    return stats
+
+def get_library_page(rel_dir='', sort_by='name', sort_order='asc', limit=200, cursor=None):
+    """Return one sorted page of the immediate children of rel_dir.
+    
+    The cursor is the path of the last item of the previous page. Returns
+    (items, next_cursor, total); next_cursor is None on the last page.
+    """
+    refresh_library_index(rel_dir, recursive=False)
+    
+    conn = get_db()
+    db_cursor = conn.cursor()
+    db_cursor.execute(f'SELECT {LIBRARY_COLUMNS} FROM {LIBRARY_JOIN} WHERE li.parent = ?', (rel_dir,))
+    rows = db_cursor.fetchall()
+    
+    # Sort lightweight stand-ins so metadata is only resolved for the returned page
+    entries = sort_items([{
+        'name': row[2],
+        'type': row[3],
+        'size': row[4] if row[3] != 'folder' else 0,
+        'modified': row[5],
+        'duration': row[7],
+        'row': row
+    } for row in rows], sort_by, sort_order)
+    
+    start = 0
+    if cursor:
+        positions = {entry['row'][0]: index for index, entry in enumerate(entries)}
+        if cursor not in positions:
+            raise ValueError('Invalid cursor')
+        start = positions[cursor] + 1
+    
+    page = entries[start:start + limit]
+    queue_missing_metadata([entry['row'] for entry in page])
+    items = [library_item(entry['row']) for entry in page]
+    
+    folder_stats = get_library_folder_stats([item['path'] for item in items if item['type'] == 'folder'])
+    for item in items:
+        if item['type'] == 'folder':
+            item['child_count'], item['total_size'] = folder_stats[item['path']]
+    
+    next_cursor = page[-1]['row'][0] if page and start + limit < len(entries) else None
+    return items, next_cursor, len(entries)
+
+def sort_items(items, sort_by='name', sort_order='asc'):
+    """Sort items based on criteria"""
+    reverse = sort_order == 'desc'
+    
+    if sort_by == 'name':
+        items.sort(key=lambda x: x['name'].lower(), reverse=reverse)
+    elif sort_by == 'size':
+        items.sort(key=lambda x: x.get('size', 0), reverse=reverse)
+    elif sort_by == 'modified':
+        items.sort(key=lambda x: x.get('modified', 0), reverse=reverse)
     elif sort_by == 'duration':
         items.sort(key=lambda x: x.get('duration', 0) or 0, reverse=reverse)
     elif sort_by == 'type':
         # Sort by type: folders first, then by file type
         items.sort(key=lambda x: (x['type'] != 'folder', x['type'], x['name'].lower()), reverse=reverse)
     
-    return items
+    return items
+
+def search_library(query, search_type='file', limit=SEARCH_PAGE_SIZE, offset=0):
+    """Search files or folders by name, folder path, title, codec and resolution.
+    
+    Every word of query matches as a prefix and results are ranked with bm25.
+    Returns (results, total) for the requested page.
+    """
+    schedule_library_refresh()
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    type_clause = "li.item_type = 'folder'" if search_type == 'folder' else "li.item_type != 'folder'"
+    
+    if search_index_enabled():
+        match = build_search_match(query)
+        if not match:
+            return [], 0
+        
+        search_from = 'library_search JOIN library_index li ON li.rowid = library_search.rowid'
+        cursor.execute(f'''
+            SELECT COUNT(*) FROM {search_from}
+            WHERE library_search MATCH ? AND {type_clause}
+        ''', (match,))
+        total = cursor.fetchone()[0]
+        
+        cursor.execute(f'''
+            SELECT {LIBRARY_COLUMNS}
+            FROM {search_from} LEFT JOIN video_metadata vm ON vm.file_path = li.path
+            WHERE library_search MATCH ? AND {type_clause}
+            ORDER BY bm25(library_search, {', '.join(map(str, SEARCH_WEIGHTS))}), li.path
+            LIMIT ? OFFSET ?
+        ''', (match, limit, offset))
+    else:
+        cursor.execute(f'''
+            SELECT COUNT(*) FROM library_index li
+            WHERE {type_clause} AND instr(lower(li.name), ?) > 0
+        ''', (query.lower(),))
+        total = cursor.fetchone()[0]
+        
+        cursor.execute(f'''
+            SELECT {LIBRARY_COLUMNS} FROM {LIBRARY_JOIN}
+            WHERE {type_clause} AND instr(lower(li.name), ?) > 0
+            ORDER BY li.path
+            LIMIT ? OFFSET ?
+        ''', (query.lower(), limit, offset))
+    rows = cursor.fetchall()
+    queue_missing_metadata(rows)
+    
+    results = []
+    for row in rows:
+        item = library_item(row)
+        item['folder'] = row[1] if row[1] else 'Root'
+        results.append(item)
+    return results, total
+
+def get_library_videos():
+    """Return every indexed video file as a flat list"""
+    schedule_library_refresh()
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {LIBRARY_COLUMNS} FROM {LIBRARY_JOIN} WHERE li.item_type = 'video' ORDER BY li.path")
+    rows = cursor.fetchall()
+    queue_missing_metadata(rows)
+    
+    return [library_item(row) for row in rows]
+
+# Response cache
+_response_cache = OrderedDict()  # key -> (library version, JSON body), least recently used first
+_response_cache_lock = threading.Lock()
+_response_cache_stats = {'bytes': 0, 'hits': 0, 'misses': 0}
+_response_cache_salt = os.urandom(4).hex()  # ETags of another process or database never match
+
+def get_library_version():
+    cursor = get_db().cursor()
+    cursor.execute('SELECT version FROM library_state WHERE id = 1')
+    return cursor.fetchone()[0]
+
+def cached_json_response(key, build):
+    """Serve the JSON of build() through the response cache, with an ETag for 304s.
+    
+    Entries and ETags belong to the current library version, so any index or
+    metadata write invalidates them. Callers refresh (or schedule a refresh of) the library index first.
+    """
+    version = get_library_version()
+    etag = hashlib.md5(repr((_response_cache_salt, version, key)).encode()).hexdigest()
+    
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        with _response_cache_lock:
+            entry = _response_cache.get(key)
+            if entry and entry[0] == version:
+                _response_cache.move_to_end(key)
+                _response_cache_stats['hits'] += 1
+                body = entry[1]
+            else:
+                _response_cache_stats['misses'] += 1
+                body = None
+        
+        if body is None:
+            body = app.json.dumps(build()).encode()
+            store_cached_response(key, version, body)
+        response = Response(body, mimetype='application/json')
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def store_cached_response(key, version, body):
+    with _response_cache_lock:
+        previous = _response_cache.pop(key, None)
+        if previous:
+            _response_cache_stats['bytes'] -= len(previous[1])
+        
+        if len(body) <= RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            _response_cache[key] = (version, body)
+            _response_cache_stats['bytes'] += len(body)
+        
+        while _response_cache_stats['bytes'] > RESPONSE_CACHE_MAX_BYTES:
+            _, (_, evicted) = _response_cache.popitem(last=False)
+            _response_cache_stats['bytes'] -= len(evicted)
+
+def get_response_cache_stats():
+    with _response_cache_lock:
+        return dict(_response_cache_stats, entries=len(_response_cache))
+
+# Subtitle index
+_subtitle_lock = threading.Lock()
+_subtitle_folder_state = {'checked': 0.0, 'mtime': None}
+_subtitle_language_codes = {}  # lowercase code or name -> ISO 639-1 code
+for code, (name, *long_codes) in SUBTITLE_LANGUAGES.items():
+    for alias in [code, name.lower()] + long_codes:
+        _subtitle_language_codes[alias] = code
+
+def parse_subtitle_language(token):
+    """Return the BCP 47 tag for a filename token such as 'en', 'eng', 'English' or 'pt-BR'"""
+    token = token.lower()
+    if token in _subtitle_language_codes:
+        return _subtitle_language_codes[token]
+    match = re.fullmatch(r'([a-z]{2,3})[-_]([a-z]{2}|[a-z]{4})', token)
+    if match and match.group(1) in _subtitle_language_codes:
+        region = match.group(2)
+        return f"{_subtitle_language_codes[match.group(1)]}-{region.upper() if len(region) == 2 else region.title()}"
+    return None
+
+def parse_subtitle_filename(filename):
+    """Split 'Movie.en.forced.srt' into ('movie', 'en', 'English (forced)').
+    
+    Trailing language and flag tokens are removed from the stem; what is left,
+    lowercased, is the video name the subtitle belongs to.
+    """
+    parts = os.path.splitext(filename)[0].split('.')
+    language = None
+    flags = []
+    
+    while len(parts) > 1:
+        token = parts[-1].lower()
+        if token in SUBTITLE_FLAGS:
+            flags.insert(0, token)
+        elif language is None and parse_subtitle_language(token):
+            language = parse_subtitle_language(token)
+        else:
+            break
+        parts.pop()
+    
+    return '.'.join(parts).lower(), language or 'und', subtitle_label(language, flags)
+
+def subtitle_label(language, flags, title=None):
+    """Display label such as 'Portuguese (BR) [forced]'; a stream title replaces the language name"""
+    name = title or (SUBTITLE_LANGUAGES[language.split('-')[0]][0] if language else 'Unknown')
+    if not title and language and '-' in language:
+        name += f" ({language.split('-', 1)[1]})"
+    return name + (f" [{', '.join(flags)}]" if flags else '')
+
+def get_subtitle_cache_path(source, path):
+    key = hashlib.md5(f'{source}:{path}'.encode()).hexdigest()
+    return os.path.join(SUBTITLE_CACHE_FOLDER, key + '.vtt')
+
+def delete_subtitle_rows(cursor, where, params):
+    """Delete subtitle_index rows matching where, along with their converted WebVTT files"""
+    cursor.execute(f'SELECT source, path FROM subtitle_index WHERE {where}', params)
+    for source, path in cursor.fetchall():
+        try:
+            os.remove(get_subtitle_cache_path(source, path))
+        except FileNotFoundError:
+            pass
+    cursor.execute(f'DELETE FROM subtitle_index WHERE {where}', params)
+
+def sync_subtitle_rows(cursor, source, parent, files):
+    """Make the index rows of one directory match files, a list of (path, mtime)"""
+    cursor.execute('SELECT path, modified FROM subtitle_index WHERE source = ? AND parent = ?', (source, parent))
+    existing = dict(cursor.fetchall())
+    current = dict(files)
+    
+    for path in existing.keys() - current.keys():
+        delete_subtitle_rows(cursor, 'source = ? AND path = ?', (source, path))
+    
+    rows = []
+    for path, modified in files:
+        if existing.get(path) == modified:
+            continue
+        video_key, language, label = parse_subtitle_filename(os.path.basename(path))
+        if source == 'sidecar':
+            video_key = os.path.join(parent, video_key)
+        rows.append((source, path, parent, video_key, language, label, modified))
+    
+    cursor.executemany('''
+        INSERT INTO subtitle_index (source, path, parent, video_key, language, label, modified)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (source, path) DO UPDATE SET modified = excluded.modified
+    ''', rows)
+
+def refresh_subtitle_index(force=False):
+    """Re-list SUBTITLES_FOLDER when its mtime changed (checked at most every LIBRARY_INDEX_TTL)"""
+    now = time.time()
+    with _subtitle_lock:
+        if not force and now - _subtitle_folder_state['checked'] < LIBRARY_INDEX_TTL:
+            return
+        _subtitle_folder_state['checked'] = now
+        
+        try:
+            folder_mtime = os.stat(SUBTITLES_FOLDER).st_mtime
+        except FileNotFoundError:
+            folder_mtime = None
+        if not force and folder_mtime == _subtitle_folder_state['mtime']:
+            return
+        
+        files = []
+        if folder_mtime is not None:
+            with os.scandir(SUBTITLES_FOLDER) as it:
+                for entry in it:
+                    if allowed_subtitle(entry.name) and entry.is_file():
+                        files.append((entry.name, entry.stat().st_mtime))
+        
+        conn = get_db()
+        sync_subtitle_rows(conn.cursor(), 'folder', '', files)
+        conn.commit()
+        _subtitle_folder_state['mtime'] = folder_mtime
+
+def read_subtitle_text(full_path):
+    with open(full_path, 'rb') as f:
+        data = f.read()
+    if data.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return data.decode('utf-16')
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1252', errors='replace')
+
+def parse_subtitle_timestamp(value):
+    """Seconds from 'H:MM:SS,mmm' (SRT), 'H:MM:SS.cc' (ASS) or 'MM:SS.mmm'"""
+    match = re.fullmatch(r'\s*(?:(\d+):)?(\d+):(\d+)(?:[.,](\d+))?\s*', value)
+    if not match:
+        return None
+    hours, minutes, seconds, fraction = match.groups()
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + (float('0.' + fraction) if fraction else 0)
+
+def srt_to_vtt(text):
+    """Convert SubRip to WebVTT: normalise timing lines, keep cue text (<i>, <b> are valid WebVTT)"""
+    lines = ['WEBVTT', '']
+    for line in text.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        if '-->' in line:
+            start, _, end = line.partition('-->')
+            start = parse_subtitle_timestamp(start)
+            # Anything after the end time (SRT coordinates) is not valid WebVTT
+            end = parse_subtitle_timestamp(end.split()[0]) if end.split() else None
+            if start is not None and end is not None:
+                line = f"{format_vtt_timestamp(start)} --> {format_vtt_timestamp(end)}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+def ass_to_vtt(text):
+    """Convert the Dialogue events of an ASS/SSA script to WebVTT cues (styling is dropped)"""
+    section = None
+    fields = None
+    cues = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            section = line.lower()
+            continue
+        if section != '[events]':
+            continue
+        
+        key, _, value = line.partition(':')
+        if key == 'Format':
+            fields = [field.strip().lower() for field in value.split(',')]
+        elif key == 'Dialogue' and fields and 'text' in fields:
+            values = value.lstrip().split(',', len(fields) - 1)
+            if len(values) != len(fields):
+                continue
+            event = dict(zip(fields, values))
+            start = parse_subtitle_timestamp(event.get('start', ''))
+            end = parse_subtitle_timestamp(event.get('end', ''))
+            cue_text = re.sub(r'\{[^}]*\}', '', event['text'])
+            cue_text = cue_text.replace('\\N', '\n').replace('\\n', '\n').replace('\\h', ' ')
+            cue_text = cue_text.replace('&', '&amp;').replace('<', '&lt;').strip()
+            if start is not None and end is not None and cue_text:
+                cues.append((start, end, cue_text))
+    
+    lines = ['WEBVTT', '']
+    for start, end, cue_text in sorted(cues, key=lambda cue: cue[:2]):
+        lines += [f"{format_vtt_timestamp(start)} --> {format_vtt_timestamp(end)}", cue_text, '']
+    return '\n'.join(lines)
+
+def convert_subtitle_to_vtt(full_path, cache_path):
+    """Write the WebVTT version of an SRT/ASS/SSA file to cache_path"""
+    text = read_subtitle_text(full_path)
+    extension = os.path.splitext(full_path)[1].lower()
+    vtt = ass_to_vtt(text) if extension in ('.ass', '.ssa') else srt_to_vtt(text)
+    
+    fd, temp_path = tempfile.mkstemp(dir=SUBTITLE_CACHE_FOLDER, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(vtt)
+    os.replace(temp_path, cache_path)
+
+_subtitle_jobs = {}  # cache path -> Future of the in-flight extraction
+_subtitle_failed = set()  # cache paths whose extraction failed
+
+def get_embedded_subtitles(file_path):
+    """Return (fingerprint, streams) for the embedded text subtitles of a library file.
+    
+    Streams come from the stored probe data; rows probed before subtitle streams
+    were recorded are probed again once. Files without a row have none yet.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT fingerprint, duration, subtitle_streams FROM video_metadata WHERE file_path = ?',
+                   (file_path,))
+    row = cursor.fetchone()
+    if not row:
+        return None, []
+    
+    fingerprint, duration, streams = row
+    if streams is None:
+        probe = probe_media(file_path) if duration is not None else None
+        if not probe:
+            return fingerprint, []
+        streams = json.dumps(probe['subtitle_streams'])
+        with conn:
+            conn.execute('UPDATE video_metadata SET subtitle_streams = ? WHERE file_path = ?', (streams, file_path))
+            if fingerprint:
+                conn.execute('UPDATE media_artifacts SET subtitle_streams = ? WHERE fingerprint = ?',
+                             (streams, fingerprint))
+    return fingerprint, json.loads(streams)
+
+def get_embedded_subtitle_cache_path(fingerprint, stream_index):
+    return os.path.join(SUBTITLE_CACHE_FOLDER, f'{fingerprint}_{stream_index}.vtt')
+
+def extract_subtitle_stream(full_path, stream_index, cache_path):
+    """Extract one subtitle stream to WebVTT with ffmpeg.
+    
+    ffmpeg writes straight to a temporary file, so memory stays flat however
+    large the container is; cache_path only appears once the track is complete.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=SUBTITLE_CACHE_FOLDER, suffix='.tmp')
+    os.close(fd)
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-i', full_path,
+        '-map', f'0:{stream_index}', '-c:s', 'webvtt', '-f', 'webvtt', temp_path
+    ]
+    
+    try:
+        result = run_media_command(cmd, timeout=SUBTITLE_EXTRACT_TIMEOUT)
+        if result.returncode != 0 or os.path.getsize(temp_path) == 0:
+            print(f"ffmpeg could not extract subtitle stream {stream_index} of {full_path}: {result.stderr.strip()}")
+            return False
+        os.replace(temp_path, cache_path)
+        return True
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _run_subtitle_extraction(full_path, stream_index, cache_path):
+    try:
+        success = extract_subtitle_stream(full_path, stream_index, cache_path)
+    except Exception as e:
+        print(f"Subtitle extraction failed for {cache_path}: {e}")
+        success = False
+    
+    with _metadata_lock:
+        _subtitle_jobs.pop(cache_path, None)
+        if not success:
+            _subtitle_failed.add(cache_path)
+    return success
+
+def queue_subtitle_extraction(full_path, stream_index, cache_path):
+    """Queue an interactive extraction job unless one is already in flight; returns its Future"""
+    with _metadata_lock:
+        future = _subtitle_jobs.get(cache_path)
+        if future is None:
+            future = submit_media_job(MEDIA_PRIORITY_INTERACTIVE, _run_subtitle_extraction,
+                                      full_path, stream_index, cache_path, tag=cache_path)
+            _subtitle_jobs[cache_path] = future
+        return future
+
+# Library watcher
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_WATCH_MASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+_library_watcher = None
+_library_watcher_lock = None  # open lock file, held for the life of the watching process
+_library_watcher_checked = False
+
+def remove_media_artifacts(file_path, thumbnail_url=None):
+    """Delete the generated thumbnail, preview sprite and waveform files of a media file"""
+    artifacts = list(get_preview_paths(file_path)) + [get_waveform_path(file_path)]
+    if thumbnail_url and thumbnail_url.startswith('/static/thumbnails/'):
+        artifacts.append(os.path.join(THUMBNAILS_FOLDER, os.path.basename(thumbnail_url)))
+    
+    for artifact in artifacts:
+        try:
+            os.remove(artifact)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Could not remove {artifact}: {e}")
+
+def sync_video_metadata(rel_dir=''):
+    """Reconcile video_metadata below rel_dir with the library index.
+    
+    Rows of files that are gone are deleted (fingerprinted thumbnails stay in
+    media_artifacts for moved files), rows whose file changed size or mtime are
+    invalidated and regenerated, and files without a row are queued.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    subtree, params = '1', ()
+    if rel_dir:
+        subtree, params = '{column} >= ? AND {column} < ?', _library_subtree_bounds(rel_dir)
+    
+    cursor.execute(f'''
+        SELECT vm.file_path, vm.thumbnail_path, vm.fingerprint, vm.file_size, vm.file_mtime, li.size, li.modified
+        FROM video_metadata vm LEFT JOIN library_index li ON li.path = vm.file_path
+        WHERE {subtree.format(column='vm.file_path')}
+    ''', params)
+    
+    orphaned, stale = [], []
+    for file_path, thumbnail_url, fingerprint, file_size, file_mtime, size, modified in cursor.fetchall():
+        if size is None:
+            orphaned.append((file_path, None if fingerprint else thumbnail_url))
+        elif size != file_size or (file_mtime is not None and modified != file_mtime):
+            stale.append((file_path, thumbnail_url))
+    
+    if orphaned or stale:
+        with conn:
+            conn.executemany('DELETE FROM video_metadata WHERE file_path = ?',
+                             [(file_path,) for file_path, _ in orphaned + stale])
+        for file_path, thumbnail_url in orphaned:
+            remove_media_artifacts(file_path, thumbnail_url)
+        for file_path, _ in stale:
+            remove_media_artifacts(file_path)
+        print(f"Library sync: removed {len(orphaned)} orphaned and invalidated {len(stale)} changed metadata rows")
+    
+    cursor.execute(f'''
+        SELECT {LIBRARY_COLUMNS} FROM {LIBRARY_JOIN}
+        WHERE {subtree.format(column='li.path')} AND li.item_type != 'folder' AND vm.file_path IS NULL
+    ''', params)
+    # Nobody is looking at these yet, so they wait behind thumbnails for open folders
+    queue_missing_metadata(cursor.fetchall(), MEDIA_PRIORITY_BACKGROUND)
+    
+    if not rel_dir:
+        prune_media_artifacts()
+
+def apply_library_changes(changes):
+    """Re-list the changed directories of UPLOAD_FOLDER and reconcile their metadata.
+    
+    changes is a set of (rel_dir, recursive) pairs.
+    """
+    for rel_dir, recursive in sorted(changes):
+        refresh_library_index(rel_dir, recursive=recursive, force=True)
+        sync_video_metadata(rel_dir)
+
+def subtitles_changed(changes):
+    """Re-list SUBTITLES_FOLDER right away instead of on the next TTL check"""
+    print(f"Subtitles changed in: {', '.join(sorted(rel_dir or '/' for rel_dir, _ in changes))}")
+    refresh_subtitle_index(force=True)
+
+def _inotify_add_tree(libc, fd, watches, root, rel_dir):
+    """Watch rel_dir and every directory below it; returns False once the watch limit is hit"""
+    top = os.path.join(root, rel_dir) if rel_dir else root
+    for dir_path, _, _ in os.walk(top):
+        wd = libc.inotify_add_watch(fd, os.fsencode(dir_path), _IN_WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                print("⚠️  inotify watch limit reached (raise fs.inotify.max_user_watches)")
+                return False
+            continue
+        relative = os.path.relpath(dir_path, root)
+        watches[wd] = (root, '' if relative == '.' else relative)
+    return True
+
+def _inotify_open(roots):
+    """Set up recursive inotify watches on every root, or return None if unavailable"""
+    libc_name = ctypes.util.find_library('c')
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        inotify_init1 = libc.inotify_init1
+    except (OSError, AttributeError, TypeError):
+        return None
+    
+    fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    
+    watches = {}  # watch descriptor -> (root, rel_dir)
+    for root in roots:
+        if not _inotify_add_tree(libc, fd, watches, root, ''):
+            os.close(fd)
+            return None
+    return libc, fd, watches
+
+def _inotify_watch_loop(libc, fd, watches, roots):
+    """Collect inotify events into per-root change sets and apply them once things settle"""
+    pending = {}  # root -> {(rel_dir, recursive)}
+    first_event = None
+    
+    while True:
+        readable, _, _ = select.select([fd], [], [], LIBRARY_WATCHER_DEBOUNCE)
+        if readable:
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + _INOTIFY_EVENT.size:offset + _INOTIFY_EVENT.size + length].rstrip(b'\0'))
+                offset += _INOTIFY_EVENT.size + length
+                
+                if mask & _IN_Q_OVERFLOW:
+                    # Events were lost; rescan everything
+                    for root in roots:
+                        pending.setdefault(root, set()).add(('', True))
+                    continue
+                if mask & _IN_IGNORED:
+                    watches.pop(wd, None)
+                    continue
+                if wd not in watches:
+                    continue
+                
+                root, rel_dir = watches[wd]
+                path = os.path.join(rel_dir, name) if rel_dir else name
+                changes = pending.setdefault(root, set())
+                changes.add((rel_dir, False))
+                
+                if mask & _IN_ISDIR and mask & _IN_MOVED_FROM:
+                    # Watches inside a moved-away tree would keep reporting the old paths
+                    for old_wd, (old_root, old_dir) in list(watches.items()):
+                        if old_root == root and (old_dir == path or old_dir.startswith(path + os.sep)):
+                            libc.inotify_rm_watch(fd, old_wd)
+                            watches.pop(old_wd, None)
+                elif mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    _inotify_add_tree(libc, fd, watches, root, path)
+                    changes.add((path, True))
+            
+            first_event = first_event or time.time()
+            if time.time() - first_event < LIBRARY_WATCHER_MAX_DELAY:
+                continue
+        
+        if pending:
+            batch, pending, first_event = pending, {}, None
+            for root, changes in batch.items():
+                try:
+                    roots[root](changes)
+                except Exception as e:
+                    print(f"Library watcher error in {root}: {e}")
+
+def _poll_watch_loop(roots):
+    """Fallback for filesystems without inotify: periodic full rescans"""
+    while True:
+        time.sleep(LIBRARY_WATCHER_POLL_INTERVAL)
+        try:
+            # Forced re-listing also catches files rewritten in place
+            apply_library_changes({('', True)})
+        except Exception as e:
+            print(f"Library watcher error in {UPLOAD_FOLDER}: {e}")
+
+def start_library_watcher():
+    """Start the background watcher thread (inotify when available, polling otherwise)"""
+    global _library_watcher, _library_watcher_lock
+    if _library_watcher is not None:
+        return _library_watcher
+    
+    # Another worker process of the same server already watches
+    if fcntl:
+        lock_file = open(LIBRARY_WATCHER_LOCK, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        _library_watcher_lock = lock_file
+    
+    roots = {UPLOAD_FOLDER: apply_library_changes, SUBTITLES_FOLDER: subtitles_changed}
+    inotify = _inotify_open(roots)
+    if inotify:
+        print("👀 Watching library with inotify")
+        target, args = _inotify_watch_loop, inotify + (roots,)
+    else:
+        print(f"👀 Watching library by polling every {LIBRARY_WATCHER_POLL_INTERVAL} seconds")
+        target, args = _poll_watch_loop, (roots,)
+    
+    _library_watcher = threading.Thread(target=target, args=args, name='library-watcher', daemon=True)
+    _library_watcher.start()
+    return _library_watcher
+
+@app.before_request
+def ensure_library_watcher():
+    """Start the library watcher once per process, from its first request.
+    
+    The reloader's parent process never serves requests, so only the child watches.
+    """
+    global _library_watcher_checked
+    if LIBRARY_WATCHER_ENABLED and not _library_watcher_checked:
+        _library_watcher_checked = True
+        start_library_watcher()
+
+# Media streaming
+def media_etag(stat):
+    """Strong validator built from inode, size and nanosecond mtime"""
+    return f'{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def _resolve_ranges(range_header, size):
+    """Turn a parsed Range header into absolute (start, stop) byte ranges within size"""
+    ranges = []
+    for start, stop in range_header.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+def _if_range_matches(if_range, etag, stat):
+    """Evaluate If-Range against the current representation (strong comparison)"""
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == f'"{etag}"'
+    since = parse_date(if_range)
+    return since is not None and int(stat.st_mtime) <= since.timestamp()
+
+def _read_range(f, start, length):
+    f.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+def _iter_range(f, start, length):
+    try:
+        yield from _read_range(f, start, length)
+    finally:
+        f.close()
+
+def _iter_multipart(f, parts, boundary):
+    try:
+        for header, start, stop in parts:
+            yield header
+            yield from _read_range(f, start, stop - start)
+        yield f'\r\n--{boundary}--\r\n'.encode()
+    finally:
+        f.close()
+
+def stream_media_file(full_path, stat=None):
+    """Serve a media file with Range, multi-range, ETag and conditional GET support.
+    
+    Full responses and ranges running to end of file go through wsgi.file_wrapper
+    so servers with sendfile support (gunicorn, uWSGI) send them without copying
+    through Python; bounded ranges are read in STREAM_CHUNK_SIZE blocks.
+    """
+    stat = stat or os.stat(full_path)
+    size = stat.st_size
+    etag = media_etag(stat)
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    
+    def finish(response):
+        response.set_etag(etag)
+        response.last_modified = int(stat.st_mtime)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Cache-Control'] = f'private, max-age={VIDEO_CACHE_MAX_AGE}'
+        return response
+    
+    # Conditional GET: If-None-Match wins over If-Modified-Since
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            return finish(Response(status=304))
+    elif request.if_modified_since and int(stat.st_mtime) <= request.if_modified_since.timestamp():
+        return finish(Response(status=304))
+    
+    range_header = parse_range_header(request.headers.get('Range'))
+    if range_header and range_header.units == 'bytes' and \
+            _if_range_matches(request.headers.get('If-Range'), etag, stat):
+        ranges = _resolve_ranges(range_header, size)
+        
+        if not ranges:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return finish(response)
+        
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            f = open(full_path, 'rb')
+            if stop == size:
+                f.seek(start)
+                body = wrap_file(request.environ, f, STREAM_CHUNK_SIZE)
+            else:
+                body = _iter_range(f, start, stop - start)
+            response = Response(body, status=206, mimetype=content_type, direct_passthrough=True)
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            response.content_length = stop - start
+            return finish(response)
+        
+        if len(ranges) <= MAX_MULTIPART_RANGES:
+            boundary = hashlib.md5(f'{etag}-{time.time()}'.encode()).hexdigest()
+            parts = [(
+                (f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+                 f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode(),
+                start, stop
+            ) for start, stop in ranges]
+            content_length = sum(len(header) + stop - start for header, start, stop in parts)
+            content_length += len(f'\r\n--{boundary}--\r\n')
+            
+            response = Response(_iter_multipart(open(full_path, 'rb'), parts, boundary), status=206,
+                                content_type=f'multipart/byteranges; boundary={boundary}',
+                                direct_passthrough=True)
+            response.content_length = content_length
+            return finish(response)
+    
+    response = Response(wrap_file(request.environ, open(full_path, 'rb'), STREAM_CHUNK_SIZE),
+                        mimetype=content_type, direct_passthrough=True)
+    response.content_length = size
+    return finish(response)
+
+def offload_response(full_path, as_attachment=False):
+    """Hand the transfer of a file under UPLOAD_FOLDER to the front-end web server.
+    
+    'x-accel' emits X-Accel-Redirect to X_ACCEL_REDIRECT_PREFIX + the path relative
+    to UPLOAD_FOLDER (an nginx 'internal' location aliased to the videos folder);
+    'x-sendfile' emits X-Sendfile with the absolute path (lighttpd, Apache
+    mod_xsendfile). The web server then handles Range requests itself.
+    """
+    relative_path = os.path.relpath(full_path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    response = Response(status=200, mimetype=content_type)
+    
+    if FILE_OFFLOAD_MODE == 'x-accel':
+        response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relative_path)
+    elif FILE_OFFLOAD_MODE == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(full_path)
+    else:
+        raise ValueError(f'Unknown FILE_OFFLOAD_MODE: {FILE_OFFLOAD_MODE}')
+    
+    if as_attachment:
+        set_attachment_filename(response, os.path.basename(full_path))
+    
+    response.headers['Cache-Control'] = f'private, max-age={VIDEO_CACHE_MAX_AGE}'
+    return response
+
+def set_attachment_filename(response, filename):
+    """Content-Disposition: attachment, with an RFC 5987 filename* for non-ASCII names"""
+    try:
+        filename.encode('ascii')
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    except UnicodeEncodeError:
+        response.headers.set('Content-Disposition', 'attachment',
+                             filename=filename.encode('ascii', 'ignore').decode() or 'download',
+                             **{'filename*': f"UTF-8''{quote(filename)}"})
+
+# HLS adaptive streaming
+_hls_lock = threading.Lock()
+_hls_jobs = {}  # segment path -> Future of the in-flight transcode
+_cache_lock = threading.Lock()
+_cache_sizes = {}  # cache folder -> bytes, measured on first use
+
+def resolve_library_video(video_path):
+    """Resolve a request path to (relative_path, full_path), or None if it is not a library video"""
+    relative_path = video_path.replace('\\', '/')
+    full_path = safe_join(app.config['UPLOAD_FOLDER'], relative_path)
+    if not full_path or not os.path.isfile(full_path) or not is_video_file(relative_path):
+        return None
+    return relative_path.replace('/', os.sep), full_path
+
+def get_hls_media_info(relative_path):
+    """Return (duration, resolution, cache_key) for a video, or None without a duration"""
+    metadata = get_video_metadata(relative_path)
+    duration, resolution = metadata[3], metadata[4]
+    if duration is None:
+        probe = probe_media(relative_path)
+        if not probe or not probe['duration']:
+            return None
+        duration, resolution = probe['duration'], probe['resolution']
+    
+    # Keyed on the fingerprint so replaced files never reuse old segments
+    cache_key = get_file_fingerprint(relative_path) or hashlib.md5(relative_path.encode()).hexdigest()
+    return duration, resolution, cache_key
+
+def get_hls_renditions(resolution):
+    """Return (name, width, height, video kbps, audio kbps) for every rung not taller than the source"""
+    try:
+        source_width, source_height = (int(value) for value in resolution.split('x'))
+    except (AttributeError, ValueError):
+        source_width, source_height = 16, 9
+    
+    rungs = [rung for rung in HLS_RENDITIONS if rung[1] <= source_height] or HLS_RENDITIONS[-1:]
+    return [
+        (name, int(round(source_width * height / source_height / 2)) * 2, height, video_kbps, audio_kbps)
+        for name, height, video_kbps, audio_kbps in rungs
+    ]
+
+def build_hls_master_playlist(renditions):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for name, width, height, video_kbps, audio_kbps in renditions:
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={int((video_kbps + audio_kbps) * 1100)},RESOLUTION={width}x{height}')
+        lines.append(f'{name}/index.m3u8')
+    return '\n'.join(lines) + '\n'
+
+def build_hls_media_playlist(duration):
+    """VOD playlist of fixed-length segments covering the whole duration"""
+    segment_count = int(-(-duration // HLS_SEGMENT_DURATION))
+    lines = [
+        '#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{HLS_SEGMENT_DURATION}',
+        '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD'
+    ]
+    for index in range(segment_count):
+        length = min(HLS_SEGMENT_DURATION, duration - index * HLS_SEGMENT_DURATION)
+        lines.append(f'#EXTINF:{length:.3f},')
+        lines.append(f'{index}.ts')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+def build_hls_segment(full_path, rendition, index, duration, segment_path):
+    """Transcode one segment to MPEG-TS; timestamps are offset so segments play back to back"""
+    name, width, height, video_kbps, audio_kbps = rendition
+    start = index * HLS_SEGMENT_DURATION
+    length = min(HLS_SEGMENT_DURATION, duration - start)
+    temp_path = segment_path + '.tmp'
+    cmd = [
+        'ffmpeg', '-v', 'error', '-ss', f'{start:.3f}', '-i', full_path, '-t', f'{length:.3f}',
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-vf', f'scale={width}:{height}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-pix_fmt', 'yuv420p',
+        '-b:v', f'{video_kbps}k', '-maxrate', f'{video_kbps}k', '-bufsize', f'{2 * video_kbps}k',
+        '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-ac', '2',
+        '-output_ts_offset', f'{start:.3f}', '-muxdelay', '0',
+        '-f', 'mpegts', '-y', temp_path
+    ]
+    
+    try:
+        result = run_media_command(cmd, timeout=HLS_SEGMENT_TIMEOUT)
+    except (subprocess.TimeoutExpired, FileNotFoundError) as e:
+        print(f"FFmpeg error while building HLS segment {segment_path}: {e}")
+        result = None
+    
+    if result is None or result.returncode != 0 or not os.path.exists(temp_path):
+        if result is not None:
+            print(f"HLS segment {segment_path} failed: {result.stderr}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    
+    size = os.path.getsize(temp_path)
+    os.replace(temp_path, segment_path)
+    account_cache_usage(HLS_CACHE_FOLDER, HLS_CACHE_MAX_BYTES, size)
+    return True
+
+def touch_cached_file(path):
+    """Mark a cached file as recently used (atime only, so its ETag stays stable)"""
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+        return True
+    except OSError:
+        return False
+
+def _list_cache_files(folder):
+    """(atime, size, path) of every file under folder, skipping files renamed or deleted meanwhile"""
+    cached_files = []
+    for dir_path, _, filenames in os.walk(folder):
+        for filename in filenames:
+            path = os.path.join(dir_path, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            cached_files.append((stat.st_atime, stat.st_size, path))
+    return cached_files
+
+def account_cache_usage(folder, max_bytes, added_bytes):
+    """Track a cache folder's size and evict least recently used files above max_bytes"""
+    with _cache_lock:
+        if folder not in _cache_sizes:
+            _cache_sizes[folder] = sum(size for _, size, _ in _list_cache_files(folder))
+        else:
+            _cache_sizes[folder] += added_bytes
+        
+        if _cache_sizes[folder] <= max_bytes:
+            return
+        
+        cached_files = [entry for entry in _list_cache_files(folder) if not entry[2].endswith('.tmp')]
+        
+        # Re-measure while sweeping, then evict down to 80% so the next file does not sweep again
+        _cache_sizes[folder] = sum(size for _, size, _ in cached_files)
+        cached_files.sort()
+        target = max_bytes * 0.8
+        evicted = 0
+        for _, size, path in cached_files:
+            if _cache_sizes[folder] <= target:
+                break
+            try:
+                os.remove(path)
+                _cache_sizes[folder] -= size
+                evicted += 1
+            except OSError:
+                pass
+        print(f"Cache {folder}: evicted {evicted} files")
+
+def _run_hls_job(full_path, rendition, index, duration, segment_path):
+    try:
+        return build_hls_segment(full_path, rendition, index, duration, segment_path)
+    except Exception as e:
+        print(f"HLS job failed for {segment_path}: {e}")
+        return False
+    finally:
+        with _hls_lock:
+            _hls_jobs.pop(segment_path, None)
+
+def get_hls_segment_path(cache_key, rendition, index):
+    return os.path.join(HLS_CACHE_FOLDER, cache_key, rendition[0], f'{index}.ts')
+
+def queue_hls_segment(full_path, cache_key, rendition, index, duration, owner=None):
+    """Return (segment_path, Future or None if the segment is already cached)"""
+    segment_path = get_hls_segment_path(cache_key, rendition, index)
+    
+    with _hls_lock:
+        # A job cancelled by a seek never runs, so it never removes itself
+        if segment_path in _hls_jobs and add_media_job_owner(_hls_jobs[segment_path], owner):
+            return segment_path, _hls_jobs[segment_path]
+        if os.path.exists(segment_path):
+            return segment_path, None
+        
+        os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+        future = submit_media_job(MEDIA_PRIORITY_INTERACTIVE, _run_hls_job,
+                                  full_path, rendition, index, duration, segment_path,
+                                  owner=owner, tag=segment_path)
+        _hls_jobs[segment_path] = future
+        return segment_path, future
+
+def get_hls_segment(full_path, cache_key, rendition, index, duration, owner=None):
+    """Return the path of a cached or freshly transcoded segment and prefetch the next ones.
+    
+    Segments that owner queued earlier outside the new window (after a seek or
+    a rendition switch) are cancelled.
+    """
+    segment_count = int(-(-duration // HLS_SEGMENT_DURATION))
+    window = range(index, min(index + 1 + HLS_PREFETCH_SEGMENTS, segment_count))
+    if owner is not None:
+        cancel_media_jobs(owner, keep={get_hls_segment_path(cache_key, rendition, i) for i in window})
+    
+    # Another viewer's seek may cancel a job this request shares; queue it once more
+    for attempt in range(2):
+        segment_path, future = queue_hls_segment(full_path, cache_key, rendition, index, duration, owner)
+        if attempt == 0:
+            for ahead in window[1:]:
+                queue_hls_segment(full_path, cache_key, rendition, ahead, duration, owner)
+        if future is None:
+            break
+        
+        try:
+            if not future.result(timeout=HLS_SEGMENT_TIMEOUT):
+                return None
+            break
+        except CancelledError:
+            continue
+        except FutureTimeoutError:
+            # The client has given up on this segment by now
+            if owner is not None:
+                cancel_media_jobs(owner, tags={segment_path})
+            return None
+    else:
+        return None
+    
+    # Serving a segment makes it the most recently used one
+    if not touch_cached_file(segment_path):
+        return None
+    return segment_path
+
+# MP4 remuxing
+def get_stream_codecs(relative_path):
+    """Return (video_codec, audio_codec) from stored metadata, probing if there is no row yet"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT video_codec, audio_codec, duration FROM video_metadata WHERE file_path = ?',
+                   (relative_path,))
+    row = cursor.fetchone()
+    if row and (row[0] or row[2] is not None):
+        return row[0], row[1]
+    
+    probe = probe_media(relative_path)
+    if not probe:
+        return None
+    return probe['video_codec'], probe['audio_codec']
+
+def build_remux_command(full_path, audio_codec):
+    """ffmpeg command copying the video stream into fragmented MP4 on stdout"""
+    if audio_codec is None or audio_codec in REMUX_AUDIO_CODECS:
+        audio_args = ['-c:a', 'copy']
+    else:
+        audio_args = ['-c:a', 'aac', '-b:a', '192k', '-ac', '2']
+    
+    return [
+        'ffmpeg', '-v', 'error', '-fflags', '+genpts', '-i', full_path,
+        '-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy'
+    ] + audio_args + [
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        '-f', 'mp4', 'pipe:1'
+    ]
+
+_remux_lock = threading.Condition()
+_remux_jobs = {}  # cache path -> state of the in-flight remux, shared by its viewers
+
+def _run_remux(process, temp_fd, cache_path, state):
+    """Copy ffmpeg's output into the remux temp file until it completes or every viewer has left"""
+    completed = abandoned = False
+    try:
+        with os.fdopen(temp_fd, 'wb') as cache_file:
+            while True:
+                chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                cache_file.write(chunk)
+                cache_file.flush()
+                with _remux_lock:
+                    state['written'] += len(chunk)
+                    _remux_lock.notify_all()
+                    abandoned = not state['viewers']
+                if abandoned:
+                    break
+        completed = not abandoned and process.wait() == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        release_media_slot()
+        
+        # Under the lock so a joining viewer never opens a temp file that is already gone
+        with _remux_lock:
+            if completed:
+                os.replace(state['temp_path'], cache_path)
+            else:
+                os.remove(state['temp_path'])
+            state['done'] = True
+            state['completed'] = completed
+            _remux_jobs.pop(cache_path, None)
+            _remux_lock.notify_all()
+        if completed:
+            account_cache_usage(REMUX_CACHE_FOLDER, REMUX_CACHE_MAX_BYTES, state['written'])
+        else:
+            print(f"Remux to {cache_path} did not complete (ffmpeg exit {process.returncode})")
+
+def join_remux(cmd, cache_path):
+    """Join the in-flight remux for cache_path, starting it if needed.
+    
+    Returns an open reader on the remux temp file, or None if the cached copy
+    was published meanwhile. Concurrent first views and retries share one ffmpeg.
+    """
+    with _remux_lock:
+        state = _remux_jobs.get(cache_path)
+        if state is None:
+            if os.path.exists(cache_path):
+                return None
+            # Reserve the entry; the slot is acquired outside the lock because
+            # running remuxes need it after every chunk to free theirs
+            state = {'temp_path': None, 'written': 0, 'viewers': 1, 'done': False, 'completed': False}
+            _remux_jobs[cache_path] = state
+        else:
+            state['viewers'] += 1
+            while state['temp_path'] is None and not state['done']:
+                _remux_lock.wait()
+            if state['temp_path'] is None:
+                state['viewers'] -= 1
+                raise OSError(f'Remux to {cache_path} could not start')
+            return state, open(state['temp_path'], 'rb')
+    
+    fd, temp_path = tempfile.mkstemp(dir=REMUX_CACHE_FOLDER, suffix='.tmp')
+    try:
+        process = start_media_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        os.close(fd)
+        os.remove(temp_path)
+        with _remux_lock:
+            state['done'] = True
+            _remux_jobs.pop(cache_path, None)
+            _remux_lock.notify_all()
+        raise
+    
+    temp_file = open(temp_path, 'rb')
+    with _remux_lock:
+        state['temp_path'] = temp_path
+        _remux_lock.notify_all()
+    threading.Thread(target=_run_remux, args=(process, fd, cache_path, state), daemon=True).start()
+    return state, temp_file
+
+def remux_stream(remux, cache_path):
+    """Follow a remux temp file as ffmpeg writes it, from the first byte.
+    
+    ffmpeg runs in its own thread so later viewers can tail the same file; it
+    stops once the last viewer disconnects, and the cache file is only
+    published when the remux completes.
+    """
+    state, temp_file = remux
+    position = 0
+    try:
+        while True:
+            with _remux_lock:
+                while position >= state['written'] and not state['done']:
+                    _remux_lock.wait(5)
+                written, done = state['written'], state['done']
+            if position < written:
+                chunk = temp_file.read(min(written - position, STREAM_CHUNK_SIZE))
+                position += len(chunk)
+                yield chunk
+            elif done:
+                if not state['completed']:
+                    print(f"Remux stream for {cache_path} ended early")
+                break
+    finally:
+        temp_file.close()
+        with _remux_lock:
+            state['viewers'] -= 1
+
+# Archive downloads
+# An archive is a list of parts (length, kind, value): 'bytes' are sent as is, 'file'
+# parts stream an entry's file and 'lazy' parts are built when reached, because ZIP
+# data descriptors and the central directory need the CRC-32 of files sent earlier
+_archive_crc_lock = threading.Lock()
+_archive_crc_cache = OrderedDict()  # (full path, size, mtime_ns) -> CRC-32
+ZIP_FLAGS = 0x0808  # CRC and sizes follow the data in a descriptor; UTF-8 names
+ZIP64_LIMIT = 0xFFFFFFFF
+
+def build_archive_entries(items):
+    """Turn (name in archive, library path) pairs into archive entries, skipping vanished files"""
+    entries = []
+    for name, relative_path in items:
+        full_path = os.path.join(UPLOAD_FOLDER, relative_path)
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            continue
+        if S_ISREG(stat.st_mode):
+            entries.append({
+                'name': name, 'path': full_path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'mtime_ns': stat.st_mtime_ns, 'crc': None, 'offset': 0
+            })
+    return entries
+
+def remember_archive_crc(entry, crc):
+    entry['crc'] = crc
+    with _archive_crc_lock:
+        _archive_crc_cache[(entry['path'], entry['size'], entry['mtime_ns'])] = crc
+        while len(_archive_crc_cache) > ARCHIVE_CRC_CACHE_SIZE:
+            _archive_crc_cache.popitem(last=False)
+
+def get_archive_entry_crc(entry):
+    """CRC-32 of an entry: computed while it was streamed, cached from an earlier download or read now"""
+    if entry['crc'] is None:
+        with _archive_crc_lock:
+            crc = _archive_crc_cache.get((entry['path'], entry['size'], entry['mtime_ns']))
+        if crc is None:
+            # A resumed download skipped this file; read it without sending it
+            crc = 0
+            with open(entry['path'], 'rb') as f:
+                for data in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                    crc = zlib.crc32(data, crc)
+        remember_archive_crc(entry, crc)
+    return entry['crc']
+
+def _dos_datetime(mtime):
+    t = time.localtime(max(mtime, 315619200))  # DOS dates start in 1980
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def _zip_descriptor(entry, zip64):
+    crc = get_archive_entry_crc(entry)
+    return struct.pack('<IIQQ' if zip64 else '<IIII', 0x08074b50, crc, entry['size'], entry['size'])
+
+def _zip_central_directory(entries, directory_offset, crc_of):
+    records = []
+    for entry in entries:
+        name = entry['name'].encode('utf-8', 'surrogateescape')
+        dos_time, dos_date = _dos_datetime(entry['mtime'])
+        size, offset = entry['size'], entry['offset']
+        zip64_fields = ([size, size] if size >= ZIP64_LIMIT else []) + ([offset] if offset >= ZIP64_LIMIT else [])
+        extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+        records.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 45, 45 if zip64_fields else 20, ZIP_FLAGS, 0, dos_time, dos_date,
+            crc_of(entry), min(size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0, 0,
+            min(offset, ZIP64_LIMIT)
+        ) + name + extra)
+    
+    count = len(entries)
+    directory_size = sum(len(record) for record in records)
+    if count >= 0xFFFF or directory_size >= ZIP64_LIMIT or directory_offset >= ZIP64_LIMIT:
+        records.append(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                                   count, count, directory_size, directory_offset))
+        records.append(struct.pack('<IIQI', 0x07064b50, 0, directory_offset + directory_size, 1))
+    records.append(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                               min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0))
+    return b''.join(records)
+
+def build_zip_layout(entries):
+    """Parts of a store-only ZIP (ZIP64 where sizes or offsets need it)"""
+    parts = []
+    offset = 0
+    for entry in entries:
+        name = entry['name'].encode('utf-8', 'surrogateescape')
+        zip64 = entry['size'] >= ZIP64_LIMIT
+        dos_time, dos_date = _dos_datetime(entry['mtime'])
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, ZIP_FLAGS, 0,
+                             dos_time, dos_date, 0, 0, 0, len(name), len(extra)) + name + extra
+        entry['offset'] = offset
+        parts += [
+            (len(header), 'bytes', header),
+            (entry['size'], 'file', entry),
+            (24 if zip64 else 16, 'lazy', lambda entry=entry, zip64=zip64: _zip_descriptor(entry, zip64))
+        ]
+        offset += sum(length for length, _, _ in parts[-3:])
+    
+    directory_length = len(_zip_central_directory(entries, offset, lambda entry: 0))
+    parts.append((directory_length, 'lazy',
+                  lambda: _zip_central_directory(entries, offset, get_archive_entry_crc)))
+    return parts
+
+def build_tar_layout(entries):
+    """Parts of a tar archive (pax headers for long or non-ASCII names and files over 8 GiB)"""
+    parts = []
+    for entry in entries:
+        info = tarfile.TarInfo(entry['name'])
+        info.size = entry['size']
+        info.mtime = int(entry['mtime'])
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+        padding = -entry['size'] % tarfile.BLOCKSIZE
+        parts += [
+            (len(header), 'bytes', header),
+            (entry['size'], 'file', entry),
+            (padding, 'bytes', b'\0' * padding)
+        ]
+    parts.append((2 * tarfile.BLOCKSIZE, 'bytes', b'\0' * (2 * tarfile.BLOCKSIZE)))
+    return parts
+
+def _iter_archive_file(entry, start, stop):
+    """Stream bytes start..stop of an entry's file, computing its CRC-32 when it is sent whole"""
+    whole = start == 0 and stop == entry['size']
+    crc = 0
+    sent = 0
+    with open(entry['path'], 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+            raise OSError(f"{entry['path']} changed while it was being archived")
+        for data in _read_range(f, start, stop - start):
+            if whole:
+                crc = zlib.crc32(data, crc)
+            sent += len(data)
+            yield data
+    
+    # Content-Length is already promised, so a short file can only abort the transfer
+    if sent != stop - start:
+        raise OSError(f"{entry['path']} was truncated while it was being archived")
+    if whole:
+        remember_archive_crc(entry, crc)
+
+def iter_archive(parts, start, stop):
+    """Yield bytes start..stop of an archive layout"""
+    position = 0
+    for length, kind, value in parts:
+        if position >= stop:
+            break
+        part_start, part_stop = max(start - position, 0), min(stop - position, length)
+        position += length
+        if part_start >= part_stop:
+            continue
+        
+        if kind == 'file':
+            yield from _iter_archive_file(value, part_start, part_stop)
+        else:
+            data = value() if kind == 'lazy' else value
+            yield data[part_start:part_stop]
+
+def archive_response(name, entries, archive_format):
+    """Stream entries as one archive with Content-Length, ETag and single-range resume.
+    
+    Memory does not grow with file sizes: files are read in STREAM_CHUNK_SIZE
+    blocks and only headers and CRCs are kept per entry.
+    """
+    parts = build_zip_layout(entries) if archive_format == 'zip' else build_tar_layout(entries)
+    size = sum(length for length, _, _ in parts)
+    
+    # The archive only changes when the set of files, their sizes or mtimes change
+    digest = hashlib.md5(archive_format.encode())
+    for entry in entries:
+        digest.update(f"{entry['name']}\0{entry['size']}\0{entry['mtime_ns']}\0".encode('utf-8', 'surrogateescape'))
+    etag = digest.hexdigest()
+    
+    start, stop, status = 0, size, 200
+    range_header = parse_range_header(request.headers.get('Range'))
+    if_range = request.headers.get('If-Range')
+    # Multiple ranges are not worth supporting here; those clients get the whole archive
+    if range_header and range_header.units == 'bytes' and len(range_header.ranges) == 1 and \
+            (not if_range or if_range == f'"{etag}"'):
+        ranges = _resolve_ranges(range_header, size)
+        if not ranges:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        (start, stop), status = ranges[0], 206
+    
+    response = Response(iter_archive(parts, start, stop), status=status,
+                        mimetype=ARCHIVE_FORMATS[archive_format], direct_passthrough=True)
+    response.content_length = stop - start
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response.set_etag(etag)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    set_attachment_filename(response, f'{name}.{archive_format}')
+    return response
+
+# Resumable uploads
+_upload_lock = threading.Lock()
+_uploads_active = set()  # upload ids with a chunk being written
+_upload_hashes = {}  # upload id -> (bytes hashed, running SHA-256) for uploads with a file checksum
+
+def get_upload_part_path(upload_id):
+    return os.path.join(UPLOAD_TEMP_FOLDER, upload_id + '.part')
+
+def upload_status(upload_id, relative_path, size, received):
+    return {
+        'id': upload_id,
+        'path': relative_path.replace(os.sep, '/'),
+        'size': size,
+        'offset': received,
+        'chunk_size': UPLOAD_CHUNK_MAX_BYTES
+    }
+
+def parse_upload_checksum(header):
+    """Decode an Upload-Checksum header ('sha256 <base64 digest>'); None if absent, False if invalid"""
+    if not header:
+        return None
+    algorithm, _, value = header.strip().partition(' ')
+    if algorithm.lower() != 'sha256':
+        return False
+    try:
+        digest = base64.b64decode(value.strip(), validate=True)
+    except ValueError:
+        return False
+    return digest if len(digest) == 32 else False
+
+def discard_upload(cursor, upload_id):
+    cursor.execute('DELETE FROM uploads WHERE id = ?', (upload_id,))
+    with _upload_lock:
+        _upload_hashes.pop(upload_id, None)
+    try:
+        os.remove(get_upload_part_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+def prune_uploads():
+    """Delete unfinished uploads that received nothing for UPLOAD_EXPIRY seconds"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM uploads WHERE updated_at < ?', (time.time() - UPLOAD_EXPIRY,))
+    expired = [row[0] for row in cursor.fetchall()]
+    with _upload_lock:
+        expired = [upload_id for upload_id in expired if upload_id not in _uploads_active]
+    for upload_id in expired:
+        discard_upload(cursor, upload_id)
+    conn.commit()
+
+def write_upload_chunk(part_path, offset, length, stream, checksum, file_hash=None):
+    """Stream length bytes of a request body into the partial file at offset.
+    
+    The body is hashed while it is written, so memory stays at one read buffer.
+    A short body or a checksum mismatch truncates the file back to offset.
+    Returns an error message, or None once the chunk is on disk.
+    """
+    chunk_hash = hashlib.sha256()
+    remaining = length
+    
+    with open(part_path, 'r+b') as f:
+        # Drop anything a crash left behind after the last acknowledged chunk
+        f.truncate(offset)
+        f.seek(offset)
+        while remaining:
+            try:
+                data = stream.read(min(STREAM_CHUNK_SIZE, remaining))
+            except ClientDisconnected:
+                break
+            if not data:
+                break
+            f.write(data)
+            chunk_hash.update(data)
+            if file_hash is not None:
+                file_hash.update(data)
+            remaining -= len(data)
+        
+        if remaining:
+            error = 'Incomplete chunk'
+        elif checksum is not None and chunk_hash.digest() != checksum:
+            error = 'Chunk checksum mismatch'
+        else:
+            f.flush()
+            os.fsync(f.fileno())
+            return None
+        f.truncate(offset)
+        return error
 
-def search_files_recursive(directory_path, query, search_type='file', base_path=''):
-    """Recursively search for files or folders matching query"""
-    results = []
-    query_lower = query.lower()
+def finish_upload(upload_id, relative_path, expected_sha256, file_hash=None):
+    """Verify the file checksum and move a complete upload into UPLOAD_FOLDER.
     
-    try:
-        if not os.path.exists(directory_path):
-            return results
-            
-        for item in os.listdir(directory_path):
-            item_path = os.path.join(directory_path, item)
-            relative_path = os.path.join(base_path, item) if base_path else item
-            
-            if os.path.isdir(item_path):
-                # Check if folder matches search (for folder search)
-                if search_type == 'folder' and query_lower in item.lower():
-                    folder_info = {
-                        'name': item,
-                        'type': 'folder',
-                        'path': relative_path,
-                        'full_path': item_path,
-                        'folder': os.path.dirname(relative_path) if os.path.dirname(relative_path) else 'Root'
-                    }
-                    results.append(folder_info)
-                
-                # Search in subdirectory
-                results.extend(search_files_recursive(item_path, query, search_type, relative_path))
-                
-            elif search_type == 'file' and allowed_file(item) and query_lower in item.lower():
-                # File matches search query
-                file_size = os.path.getsize(item_path)
-                metadata = get_video_metadata(relative_path)
-                
-                file_info = {
-                    'name': item,
-                    'type': get_file_type(item),
-                    'path': relative_path,
-                    'full_path': item_path,
-                    'url': f'/static/videos/{relative_path.replace(os.sep, "/").replace(chr(92), "/")}',
-                    'size': file_size,
-                    'folder': os.path.dirname(relative_path) if os.path.dirname(relative_path) else 'Root',
-                    'thumbnail': metadata[2] if metadata else None
-                }
-                results.append(file_info)
-    except PermissionError:
-        pass
+    The file is hard-linked into place, so an existing file is never replaced
+    (FileExistsError) and the library never shows a partial file. Returns an
+    error message or None.
+    """
+    part_path = get_upload_part_path(upload_id)
+    if expected_sha256:
+        if file_hash is None:
+            # The running hash is lost after a restart; hash what is on disk instead
+            file_hash = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for data in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                    file_hash.update(data)
+        if file_hash.hexdigest() != expected_sha256:
+            return 'File checksum mismatch'
     
-    return results
+    full_path = os.path.join(UPLOAD_FOLDER, relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    try:
+        os.link(part_path, full_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # UPLOAD_TEMP_FOLDER is on another filesystem: copy next to the destination first
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as dst, open(part_path, 'rb') as src:
+                shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.link(temp_path, full_path)
+        finally:
+            os.remove(temp_path)
+    os.remove(part_path)
+    return None
 
 # Authentication routes
 @app.route('/login')
@@ -512,7 +3419,7 @@ def login():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -525,12 +3432,10 @@ def login():
     if user and check_password_hash(user[1], password):
         # Check if user is active
         if not user[8]:
-            conn.close()
             return jsonify({'error': 'Account is deactivated'}), 401
         
         # Check time access
         if not check_time_access(user[0]):
-            conn.close()
             return jsonify({'error': 'Access denied at this time'}), 401
         
         session['user_id'] = user[0]
@@ -541,7 +3446,6 @@ def login():
             'can_download': bool(user[4]),
             'can_use_subtitles': bool(user[5])
         }
-        conn.close()
         return jsonify({
             'success': True, 
             'message': 'Login successful',
@@ -549,7 +3453,6 @@ def login():
             'permissions': session['permissions']
         })
     
-    conn.close()
     return jsonify({'error': 'Invalid credentials'}), 401
 
 @app.route('/api/register', methods=['POST'])
@@ -562,13 +3465,12 @@ def register():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Check if user exists
     cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
     if cursor.fetchone():
-        conn.close()
         return jsonify({'error': 'Username already exists'}), 400
     
     # Create user
@@ -580,7 +3482,6 @@ def register():
     
     user_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     
     session['user_id'] = user_id
     session['username'] = username
@@ -601,17 +3502,16 @@ def logout():
 # Admin routes
 @app.route('/admin')
 def admin_panel():
-    if 'user_id' not in session or not session.get('is_admin'):
+    access = get_user_access(session['user_id']) if 'user_id' in session else None
+    if not access or not access['is_active'] or not access['is_admin']:
         return redirect(url_for('login_page'))
     return render_template('admin.html', username=session.get('username'))
 
 @app.route('/api/admin/users')
+@requires_access(admin=True)
 def get_all_users():
     """Get all users (admin only)"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'error': 'Admin access required'}), 403
-    
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -637,15 +3537,12 @@ def get_all_users():
             'created_at': row[10]
         })
     
-    conn.close()
     return jsonify({'users': users})
 
 @app.route('/api/admin/create-user', methods=['POST'])
+@requires_access(admin=True)
 def admin_create_user():
     """Create new user (admin only)"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'error': 'Admin access required'}), 403
-    
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
@@ -655,13 +3552,12 @@ def admin_create_user():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Check if user exists
     cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
     if cursor.fetchone():
-        conn.close()
         return jsonify({'error': 'Username already exists'}), 400
     
     # Create user
@@ -672,21 +3568,18 @@ def admin_create_user():
     ''', (username, password_hash, email, is_admin, True, True, True))
     
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True, 'message': 'User created successfully'})
 
 @app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
+@requires_access(admin=True)
 def delete_user(user_id):
     """Delete user (admin only)"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'error': 'Admin access required'}), 403
-    
     # Prevent admin from deleting themselves
     if user_id == session['user_id']:
         return jsonify({'error': 'Cannot delete your own account'}), 400
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Delete user's playlists first
@@ -696,21 +3589,19 @@ def delete_user(user_id):
     cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
     
     conn.commit()
-    conn.close()
+    invalidate_user_access(user_id)
     
     return jsonify({'success': True, 'message': 'User deleted successfully'})
 
 @app.route('/api/admin/users/<int:user_id>/toggle-admin', methods=['POST'])
+@requires_access(admin=True)
 def toggle_admin_status(user_id):
     """Toggle admin status (admin only)"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'error': 'Admin access required'}), 403
-    
     # Prevent admin from removing their own admin status
     if user_id == session['user_id']:
         return jsonify({'error': 'Cannot modify your own admin status'}), 400
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get current admin status
@@ -718,7 +3609,6 @@ def toggle_admin_status(user_id):
     user = cursor.fetchone()
     
     if not user:
-        conn.close()
         return jsonify({'error': 'User not found'}), 404
     
     # Toggle admin status
@@ -726,7 +3616,7 @@ def toggle_admin_status(user_id):
     cursor.execute('UPDATE users SET is_admin = ? WHERE id = ?', (new_admin_status, user_id))
     
     conn.commit()
-    conn.close()
+    invalidate_user_access(user_id)
     
     return jsonify({
         'success': True, 
@@ -735,14 +3625,12 @@ def toggle_admin_status(user_id):
     })
 
 @app.route('/api/admin/users/<int:user_id>/permissions', methods=['POST'])
+@requires_access(admin=True)
 def update_user_permissions(user_id):
     """Update user permissions (admin only)"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'error': 'Admin access required'}), 403
-    
     data = request.get_json()
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Update permissions
@@ -766,17 +3654,15 @@ def update_user_permissions(user_id):
     ))
     
     conn.commit()
-    conn.close()
+    invalidate_user_access(user_id)
     
     return jsonify({'success': True, 'message': 'Permissions updated successfully'})
 
 @app.route('/api/admin/stats')
+@requires_access(admin=True)
 def get_admin_stats():
     """Get system statistics (admin only)"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'error': 'Admin access required'}), 403
-    
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get user count
@@ -810,7 +3696,6 @@ def get_admin_stats():
     ''')
     recent_users = cursor.fetchone()[0]
     
-    conn.close()
     
     return jsonify({
         'total_users': total_users,
@@ -819,15 +3704,16 @@ def get_admin_stats():
         'total_playlists': total_playlists,
         'total_videos': total_videos,
         'storage_used': storage_used,
-        'recent_users': recent_users
+        'recent_users': recent_users,
+        'metadata_queue': get_metadata_queue_stats(),
+        'media_jobs': get_media_job_stats(),
+        'response_cache': get_response_cache_stats()
     })
 
 @app.route('/api/admin/system-info')
+@requires_access(admin=True)
 def get_system_info():
     """Get system information (admin only)"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'error': 'Admin access required'}), 403
-    
     try:
         import psutil
         import platform
@@ -858,6 +3744,192 @@ def get_system_info():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Upload routes
+@app.route('/api/uploads', methods=['GET'])
+@requires_access(admin=True)
+def get_uploads():
+    """List the current user's unfinished uploads so they can be resumed"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, path, size, received FROM uploads WHERE user_id = ? ORDER BY updated_at DESC',
+                   (session['user_id'],))
+    return jsonify({'uploads': [upload_status(*row) for row in cursor.fetchall()]})
+
+@app.route('/api/uploads', methods=['POST'])
+@requires_access(admin=True)
+def create_upload():
+    """Start a resumable upload of 'size' bytes to 'path' below the library, with an optional 'sha256'"""
+    data = request.get_json() or {}
+    relative_path = (data.get('path') or '').replace('\\', '/').strip('/')
+    size = data.get('size')
+    sha256 = (data.get('sha256') or '').lower() or None
+    
+    if not relative_path or not allowed_file(relative_path) or not is_library_path(relative_path) \
+            or any(part.startswith('.') for part in relative_path.split('/')):
+        return jsonify({'error': 'Invalid path'}), 400
+    if not isinstance(size, int) or isinstance(size, bool) or not 0 <= size <= UPLOAD_MAX_BYTES:
+        return jsonify({'error': 'Invalid size'}), 400
+    if sha256 is not None and not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        return jsonify({'error': 'Invalid sha256'}), 400
+    
+    relative_path = relative_path.replace('/', os.sep)
+    if os.path.exists(os.path.join(UPLOAD_FOLDER, relative_path)):
+        return jsonify({'error': 'File already exists'}), 409
+    
+    prune_uploads()
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1 FROM uploads WHERE path = ?', (relative_path,))
+    if cursor.fetchone():
+        return jsonify({'error': 'An upload to this path is already in progress'}), 409
+    
+    upload_id = secrets.token_hex(16)
+    open(get_upload_part_path(upload_id), 'wb').close()
+    cursor.execute('''
+        INSERT INTO uploads (id, user_id, path, size, sha256, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (upload_id, session['user_id'], relative_path, size, sha256, time.time()))
+    conn.commit()
+    
+    if sha256:
+        with _upload_lock:
+            _upload_hashes[upload_id] = (0, hashlib.sha256())
+    
+    return jsonify(upload_status(upload_id, relative_path, size, 0)), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@requires_access(admin=True)
+def get_upload(upload_id):
+    """Get the offset an interrupted upload resumes from"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, path, size, received FROM uploads WHERE id = ? AND user_id = ?',
+                   (upload_id, session['user_id']))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    response = jsonify(upload_status(*row))
+    response.headers['Upload-Offset'] = str(row[3])
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+@requires_access(admin=True)
+def upload_chunk(upload_id):
+    """Write one chunk of an upload.
+    
+    Upload-Offset must equal the bytes received so far and the optional
+    Upload-Checksum is 'sha256 <base64 digest>' of the body. The chunk that
+    completes the file moves it into the library and queues its metadata.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT path, size, sha256 FROM uploads WHERE id = ? AND user_id = ?',
+                   (upload_id, session['user_id']))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({'error': 'Upload not found'}), 404
+    relative_path, size, sha256 = row
+    
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    checksum = parse_upload_checksum(request.headers.get('Upload-Checksum'))
+    if checksum is False:
+        return jsonify({'error': 'Upload-Checksum must be "sha256 <base64 digest>"'}), 400
+    # An empty final chunk (zero-byte file, retried completion) may come without Content-Length
+    length = request.content_length
+    if length is None and 'Transfer-Encoding' in request.headers:
+        return jsonify({'error': 'Content-Length required'}), 411
+    length = length or 0
+    if length > UPLOAD_CHUNK_MAX_BYTES:
+        return jsonify({'error': f'Chunks are limited to {UPLOAD_CHUNK_MAX_BYTES} bytes'}), 413
+    if offset + length > size:
+        return jsonify({'error': 'Chunk exceeds the upload size'}), 400
+    
+    with _upload_lock:
+        if upload_id in _uploads_active:
+            return jsonify({'error': 'Another chunk of this upload is being written'}), 409
+        _uploads_active.add(upload_id)
+    
+    try:
+        # Read the offset only now that no other request can advance it
+        cursor.execute('SELECT received FROM uploads WHERE id = ?', (upload_id,))
+        row = cursor.fetchone()
+        if not row:
+            return jsonify({'error': 'Upload not found'}), 404
+        if offset != row[0]:
+            return jsonify({'error': 'Offset mismatch', 'offset': row[0]}), 409
+        
+        # The running file hash is only usable if it covers exactly the bytes before this chunk
+        with _upload_lock:
+            hashed, running_hash = _upload_hashes.get(upload_id, (None, None))
+        file_hash = running_hash.copy() if sha256 and hashed == offset else None
+        error = write_upload_chunk(get_upload_part_path(upload_id), offset, length, request.stream,
+                                   checksum, file_hash)
+        if error:
+            return jsonify({'error': error, 'offset': offset}), 400
+        
+        received = offset + length
+        cursor.execute('UPDATE uploads SET received = ?, updated_at = ? WHERE id = ?',
+                       (received, time.time(), upload_id))
+        conn.commit()
+        
+        if received < size:
+            if file_hash is not None:
+                with _upload_lock:
+                    _upload_hashes[upload_id] = (received, file_hash)
+            response = jsonify(upload_status(upload_id, relative_path, size, received))
+            response.headers['Upload-Offset'] = str(received)
+            return response
+        
+        try:
+            error = finish_upload(upload_id, relative_path, sha256, file_hash)
+        except FileExistsError:
+            return jsonify({'error': 'File already exists'}), 409
+        except OSError as e:
+            print(f"Error publishing upload {relative_path}: {e}")
+            return jsonify({'error': 'Could not store the uploaded file'}), 500
+        
+        # A corrupt file cannot be repaired chunk by chunk, so the upload starts over
+        discard_upload(cursor, upload_id)
+        conn.commit()
+        if error:
+            return jsonify({'error': error}), 400
+    finally:
+        with _upload_lock:
+            _uploads_active.discard(upload_id)
+    
+    print(f"Upload complete: {relative_path} ({size} bytes)")
+    rel_dir = os.path.dirname(relative_path)
+    while True:
+        refresh_library_index(rel_dir, recursive=False, force=True)
+        if not rel_dir:
+            break
+        rel_dir = os.path.dirname(rel_dir)
+    queue_metadata_job(relative_path)
+    
+    return jsonify({'success': True, 'path': relative_path.replace(os.sep, '/'), 'size': size}), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@requires_access(admin=True)
+def delete_upload(upload_id):
+    """Abort an upload and delete the data received so far"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1 FROM uploads WHERE id = ? AND user_id = ?', (upload_id, session['user_id']))
+    if not cursor.fetchone():
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    with _upload_lock:
+        if upload_id in _uploads_active:
+            return jsonify({'error': 'Another chunk of this upload is being written'}), 409
+    discard_upload(cursor, upload_id)
+    conn.commit()
+    
+    return jsonify({'success': True})
+
 # Main routes
 @app.route('/')
 def index():
@@ -869,57 +3941,86 @@ def index():
         session.clear()
         return redirect(url_for('login_page'))
     
+    access = get_user_access(session['user_id'])
     return render_template('index.html', 
                          username=session.get('username'),
-                         is_admin=session.get('is_admin', False),
-                         permissions=session.get('permissions', {}))
+                         is_admin=access['is_admin'],
+                         permissions=access['permissions'])
 
 @app.route('/api/user/permissions')
+@requires_access()
 def get_user_permissions():
     """Get current user permissions"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
+    access = get_user_access(session['user_id'])
     return jsonify({
-        'permissions': session.get('permissions', {}),
-        'is_admin': session.get('is_admin', False)
+        'permissions': access['permissions'],
+        'is_admin': access['is_admin']
     })
 
 @app.route('/api/browse')
+@requires_access()
 def browse_files():
     """Browse files and folders with sorting"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
     try:
-        path = request.args.get('path', '')
+        path = request.args.get('path', '').strip('/')
         sort_by = request.args.get('sort', 'name')  # name, size, modified, duration, type
         sort_order = request.args.get('order', 'asc')  # asc, desc
         
         full_path = os.path.join(app.config['UPLOAD_FOLDER'], path) if path else app.config['UPLOAD_FOLDER']
         
         # Security check
-        if not os.path.abspath(full_path).startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
+        if not os.path.abspath(full_path).startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])) \
+                or not is_library_path(path):
             return jsonify({'error': 'Invalid path'}), 400
         
-        items = scan_directory_recursive(full_path, path, sort_by, sort_order)
+        if not os.path.isdir(full_path):
+            return jsonify({'error': 'Folder not found'}), 404
         
-        return jsonify({
-            'items': items,
-            'current_path': path,
-            'parent_path': os.path.dirname(path) if path else None,
-            'sort_by': sort_by,
-            'sort_order': sort_order
-        })
+        # Shallow mode returns one paginated level; folders carry child_count/total_size
+        if request.args.get('shallow', '').lower() in ('1', 'true', 'yes'):
+            try:
+                limit = min(max(int(request.args.get('limit', BROWSE_PAGE_SIZE)), 1), BROWSE_MAX_PAGE_SIZE)
+            except ValueError:
+                return jsonify({'error': 'Invalid limit'}), 400
+            
+            page_cursor = request.args.get('cursor') or None
+            
+            def build_page():
+                items, next_cursor, total = get_library_page(path, sort_by, sort_order, limit, page_cursor)
+                return {
+                    'items': items,
+                    'current_path': path,
+                    'parent_path': os.path.dirname(path) if path else None,
+                    'sort_by': sort_by,
+                    'sort_order': sort_order,
+                    'next_cursor': next_cursor,
+                    'total': total
+                }
+            
+            refresh_library_index(path, recursive=False)
+            try:
+                return cached_json_response(('browse', path, sort_by, sort_order, limit, page_cursor), build_page)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+        def build_tree():
+            return {
+                'items': get_library_tree(path, sort_by, sort_order),
+                'current_path': path,
+                'parent_path': os.path.dirname(path) if path else None,
+                'sort_by': sort_by,
+                'sort_order': sort_order
+            }
+        
+        refresh_library_index(path)
+        return cached_json_response(('tree', path, sort_by, sort_order), build_tree)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/search')
+@requires_access()
 def search_files():
     """Search files or folders recursively"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
     try:
         query = request.args.get('q', '').strip()
         search_type = request.args.get('type', 'file')  # 'file' or 'folder'
@@ -927,85 +4028,156 @@ def search_files():
         if not query:
             return jsonify({'results': []})
         
-        results = search_files_recursive(app.config['UPLOAD_FOLDER'], query, search_type)
+        try:
+            limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({'error': 'Invalid limit or offset'}), 400
         
-        return jsonify({
-            'results': results,
-            'query': query,
-            'search_type': search_type,
-            'count': len(results)
-        })
+        def build_results():
+            results, total = search_library(query, search_type, limit, offset)
+            return {
+                'results': results,
+                'query': query,
+                'search_type': search_type,
+                'count': len(results),
+                'total': total,
+                'next_offset': offset + len(results) if offset + len(results) < total else None
+            }
+        
+        schedule_library_refresh()
+        return cached_json_response(('search', query, search_type, limit, offset), build_results)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/videos')
+@requires_access()
 def get_videos():
     """Get list of all videos recursively"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
     try:
-        all_items = scan_directory_recursive(app.config['UPLOAD_FOLDER'])
-        videos = []
-        
-        def extract_videos(items):
-            for item in items:
-                if item['type'] == 'video':
-                    videos.append(item)
-                elif item['type'] == 'folder':
-                    extract_videos(item['children'])
-        
-        extract_videos(all_items)
-        
-        return jsonify({'videos': videos})
+        schedule_library_refresh()
+        return cached_json_response(('videos',), lambda: {'videos': get_library_videos()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Playlist items
+def get_owned_playlist(cursor, playlist_id):
+    """Return the playlist row if it belongs to the session user"""
+    cursor.execute('SELECT id, name, description FROM playlists WHERE id = ? AND user_id = ?',
+                   (playlist_id, session['user_id']))
+    return cursor.fetchone()
+
+def touch_playlist(cursor, playlist_id):
+    cursor.execute('UPDATE playlists SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (playlist_id,))
+
+def set_playlist_items(cursor, playlist_id, video_paths):
+    """Replace the items of a playlist, evenly spaced"""
+    cursor.execute('DELETE FROM playlist_items WHERE playlist_id = ?', (playlist_id,))
+    cursor.executemany('INSERT INTO playlist_items (playlist_id, position, video_path) VALUES (?, ?, ?)',
+                       [(playlist_id, (index + 1) * PLAYLIST_POSITION_STEP, video_path)
+                        for index, video_path in enumerate(video_paths)])
+
+def get_playlist_item(cursor, playlist_id, index):
+    """Return (id, position, video_path) of the item at index, or None"""
+    if index < 0:
+        return None
+    cursor.execute('''
+        SELECT id, position, video_path FROM playlist_items WHERE playlist_id = ?
+        ORDER BY position LIMIT 1 OFFSET ?
+    ''', (playlist_id, index))
+    return cursor.fetchone()
+
+def renumber_playlist_items(cursor, playlist_id, hole_index, hole_size):
+    """Spread positions evenly again, leaving room for hole_size items before hole_index"""
+    cursor.execute('SELECT id, video_path FROM playlist_items WHERE playlist_id = ? ORDER BY position',
+                   (playlist_id,))
+    rows = cursor.fetchall()
+    cursor.execute('DELETE FROM playlist_items WHERE playlist_id = ?', (playlist_id,))
+    cursor.executemany('INSERT INTO playlist_items (id, playlist_id, position, video_path) VALUES (?, ?, ?, ?)',
+                       [(item_id, playlist_id,
+                         (index + 1 + (hole_size if index >= hole_index else 0)) * PLAYLIST_POSITION_STEP,
+                         video_path)
+                        for index, (item_id, video_path) in enumerate(rows)])
+
+def insert_playlist_items(cursor, playlist_id, video_paths, index=None):
+    """Insert video_paths before the item at index (append when index is None or past the end)"""
+    cursor.execute('SELECT COUNT(*) FROM playlist_items WHERE playlist_id = ?', (playlist_id,))
+    count = cursor.fetchone()[0]
+    index = count if index is None else min(max(index, 0), count)
+    
+    def free_range():
+        """Positions (low, high) the new items have to fit strictly between"""
+        before = get_playlist_item(cursor, playlist_id, index - 1)
+        after = get_playlist_item(cursor, playlist_id, index)
+        room = (len(video_paths) + 1) * PLAYLIST_POSITION_STEP
+        if after is None:
+            low = before[1] if before else 0
+            return low, low + room
+        return (before[1] if before else after[1] - room), after[1]
+    
+    low, high = free_range()
+    if high - low <= len(video_paths):
+        renumber_playlist_items(cursor, playlist_id, index, len(video_paths))
+        low, high = free_range()
+    
+    gap = high - low
+    cursor.executemany('INSERT INTO playlist_items (playlist_id, position, video_path) VALUES (?, ?, ?)',
+                       [(playlist_id, low + gap * (offset + 1) // (len(video_paths) + 1), video_path)
+                        for offset, video_path in enumerate(video_paths)])
+    return index
+
+def move_playlist_item(cursor, playlist_id, from_index, to_index):
+    """Move one item so that it ends up at to_index; returns False if from_index is out of range"""
+    item = get_playlist_item(cursor, playlist_id, from_index)
+    if not item:
+        return False
+    
+    cursor.execute('DELETE FROM playlist_items WHERE id = ?', (item[0],))
+    insert_playlist_items(cursor, playlist_id, [item[2]], to_index)
+    return True
+
 # Playlist routes
 @app.route('/api/playlists')
+@requires_access('can_use_playlists')
 def get_playlists():
     """Get user's playlists"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
-    # Check playlist permission
-    if not check_user_permissions(session['user_id'], 'can_use_playlists'):
-        return jsonify({'error': 'Playlist access denied'}), 403
-    
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
-        SELECT id, name, description, videos, created_at, updated_at
+        SELECT id, name, description, created_at, updated_at
         FROM playlists WHERE user_id = ?
         ORDER BY updated_at DESC
     ''', (session['user_id'],))
     
     playlists = []
+    by_id = {}
     for row in cursor.fetchall():
         playlist = {
             'id': row[0],
             'name': row[1],
             'description': row[2],
-            'videos': json.loads(row[3]) if row[3] else [],
-            'created_at': row[4],
-            'updated_at': row[5]
+            'videos': [],
+            'created_at': row[3],
+            'updated_at': row[4]
         }
         playlists.append(playlist)
+        by_id[row[0]] = playlist
+    
+    cursor.execute('''
+        SELECT pi.playlist_id, pi.video_path FROM playlist_items pi
+        JOIN playlists p ON p.id = pi.playlist_id
+        WHERE p.user_id = ? ORDER BY pi.playlist_id, pi.position
+    ''', (session['user_id'],))
+    for playlist_id, video_path in cursor.fetchall():
+        by_id[playlist_id]['videos'].append(video_path)
     
-    conn.close()
     return jsonify({'playlists': playlists})
 
 @app.route('/api/playlists', methods=['POST'])
+@requires_access('can_use_playlists')
 def create_playlist():
     """Create new playlist"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
-    # Check playlist permission
-    if not check_user_permissions(session['user_id'], 'can_use_playlists'):
-        return jsonify({'error': 'Playlist access denied'}), 403
-    
     data = request.get_json()
     name = data.get('name')
     description = data.get('description', '')
@@ -1013,43 +4185,35 @@ def create_playlist():
     if not name:
         return jsonify({'error': 'Playlist name required'}), 400
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
-        INSERT INTO playlists (user_id, name, description, videos)
-        VALUES (?, ?, ?, ?)
-    ''', (session['user_id'], name, description, '[]'))
+        INSERT INTO playlists (user_id, name, description)
+        VALUES (?, ?, ?)
+    ''', (session['user_id'], name, description))
     
     playlist_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True, 'playlist_id': playlist_id})
 
 @app.route('/api/playlists/<int:playlist_id>', methods=['PUT'])
+@requires_access('can_use_playlists')
 def update_playlist(playlist_id):
     """Update playlist"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
-    # Check playlist permission
-    if not check_user_permissions(session['user_id'], 'can_use_playlists'):
-        return jsonify({'error': 'Playlist access denied'}), 403
-    
     data = request.get_json()
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Handle different update types
     if 'videos' in data:
-        # Update video list
-        videos = data.get('videos', [])
-        cursor.execute('''
-            UPDATE playlists SET videos = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ? AND user_id = ?
-        ''', (json.dumps(videos), playlist_id, session['user_id']))
+        # Replace the whole video list (the /items routes change single entries)
+        if not get_owned_playlist(cursor, playlist_id):
+            return jsonify({'error': 'Playlist not found'}), 404
+        set_playlist_items(cursor, playlist_id, data.get('videos') or [])
+        touch_playlist(cursor, playlist_id)
     
     if 'name' in data or 'description' in data:
         # Update playlist info
@@ -1069,76 +4233,127 @@ def update_playlist(playlist_id):
             ''', (description, playlist_id, session['user_id']))
     
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
 @app.route('/api/playlists/<int:playlist_id>', methods=['DELETE'])
+@requires_access('can_use_playlists')
 def delete_playlist(playlist_id):
     """Delete playlist"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
-    # Check playlist permission
-    if not check_user_permissions(session['user_id'], 'can_use_playlists'):
-        return jsonify({'error': 'Playlist access denied'}), 403
-    
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('DELETE FROM playlists WHERE id = ? AND user_id = ?', 
                   (playlist_id, session['user_id']))
     
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
-@app.route('/api/playlists/<int:playlist_id>/play')
-def get_playlist_for_playing(playlist_id):
-    """Get playlist with full video details for playing"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
+@app.route('/api/playlists/<int:playlist_id>/items', methods=['POST'])
+@requires_access('can_use_playlists')
+def add_playlist_items(playlist_id):
+    """Insert videos into a playlist at an index (default: append)"""
+    data = request.get_json() or {}
+    videos = data.get('videos') or ([data['video']] if data.get('video') else [])
+    index = data.get('index')
     
-    if not check_user_permissions(session['user_id'], 'can_use_playlists'):
-        return jsonify({'error': 'Playlist access denied'}), 403
+    if not videos or not all(isinstance(video, str) for video in videos):
+        return jsonify({'error': 'Videos required'}), 400
+    if index is not None and not isinstance(index, int):
+        return jsonify({'error': 'Invalid index'}), 400
     
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT id, name, description, videos
-        FROM playlists WHERE id = ? AND user_id = ?
-    ''', (playlist_id, session['user_id']))
+    if not get_owned_playlist(cursor, playlist_id):
+        return jsonify({'error': 'Playlist not found'}), 404
     
-    playlist = cursor.fetchone()
-    conn.close()
+    index = insert_playlist_items(cursor, playlist_id, videos, index)
+    touch_playlist(cursor, playlist_id)
+    conn.commit()
+    
+    return jsonify({'success': True, 'index': index})
+
+@app.route('/api/playlists/<int:playlist_id>/items/<int:index>', methods=['DELETE'])
+@requires_access('can_use_playlists')
+def remove_playlist_item(playlist_id, index):
+    """Remove the video at index from a playlist"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    if not get_owned_playlist(cursor, playlist_id):
+        return jsonify({'error': 'Playlist not found'}), 404
+    
+    item = get_playlist_item(cursor, playlist_id, index)
+    if not item:
+        return jsonify({'error': 'Playlist item not found'}), 404
+    
+    cursor.execute('DELETE FROM playlist_items WHERE id = ?', (item[0],))
+    touch_playlist(cursor, playlist_id)
+    conn.commit()
+    
+    return jsonify({'success': True})
+
+@app.route('/api/playlists/<int:playlist_id>/items/move', methods=['POST'])
+@requires_access('can_use_playlists')
+def move_playlist_item_route(playlist_id):
+    """Move one video of a playlist from one index to another"""
+    data = request.get_json() or {}
+    from_index = data.get('from')
+    to_index = data.get('to')
+    
+    if not isinstance(from_index, int) or not isinstance(to_index, int):
+        return jsonify({'error': 'from and to indexes required'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    if not get_owned_playlist(cursor, playlist_id):
+        return jsonify({'error': 'Playlist not found'}), 404
+    
+    if not move_playlist_item(cursor, playlist_id, from_index, to_index):
+        return jsonify({'error': 'Playlist item not found'}), 404
+    
+    touch_playlist(cursor, playlist_id)
+    conn.commit()
+    
+    return jsonify({'success': True})
+
+@app.route('/api/playlists/<int:playlist_id>/play')
+@requires_access('can_use_playlists')
+def get_playlist_for_playing(playlist_id):
+    """Get playlist with full video details for playing"""
+    schedule_library_refresh()
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    playlist = get_owned_playlist(cursor, playlist_id)
     
     if not playlist:
         return jsonify({'error': 'Playlist not found'}), 404
     
-    video_paths = json.loads(playlist[3]) if playlist[3] else []
-    detailed_videos = []
+    # Files missing from the library index no longer exist and are skipped
+    cursor.execute('''
+        SELECT pi.video_path, li.size, li.item_type, vm.file_path, vm.thumbnail_path, vm.duration
+        FROM playlist_items pi
+        JOIN library_index li ON li.path = pi.video_path
+        LEFT JOIN video_metadata vm ON vm.file_path = pi.video_path
+        WHERE pi.playlist_id = ? AND li.item_type != 'folder'
+        ORDER BY pi.position
+    ''', (playlist_id,))
+    rows = cursor.fetchall()
+    queue_metadata_jobs([row[0] for row in rows if row[3] is None])
     
-    for video_path in video_paths:
-        try:
-            full_path = os.path.join(app.config['UPLOAD_FOLDER'], video_path)
-            if os.path.exists(full_path):
-                file_size = os.path.getsize(full_path)
-                metadata = get_video_metadata(video_path)
-                
-                video_info = {
-                    'name': os.path.basename(video_path),
-                    'path': video_path,
-                    'url': f'/static/videos/{video_path.replace(os.sep, "/").replace(chr(92), "/")}',
-                    'size': file_size,
-                    'thumbnail': metadata[2] if metadata else None,
-                    'duration': metadata[3] if metadata else None,
-                    'type': get_file_type(video_path)
-                }
-                detailed_videos.append(video_info)
-        except:
-            continue
+    detailed_videos = [{
+        'name': os.path.basename(video_path),
+        'path': video_path,
+        'url': f'/static/videos/{video_path.replace(os.sep, "/").replace(chr(92), "/")}',
+        'size': size,
+        'thumbnail': thumbnail,
+        'duration': duration,
+        'type': item_type
+    } for video_path, size, item_type, _, thumbnail, duration in rows]
     
     return jsonify({
         'playlist': {
@@ -1151,42 +4366,182 @@ def get_playlist_for_playing(playlist_id):
 
 # Subtitle routes
 @app.route('/api/subtitles/<path:video_path>')
+@requires_access('can_use_subtitles')
 def get_subtitles(video_path):
-    """Get available subtitles for a video"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
-    # Check subtitle permission
-    if not check_user_permissions(session['user_id'], 'can_use_subtitles'):
-        return jsonify({'error': 'Subtitle access denied'}), 403
-    
-    # Look for subtitle files with same name as video
-    video_name = os.path.splitext(video_path)[0]
-    subtitles = []
-    
-    # Check in subtitles folder
-    subtitle_dir = os.path.join(app.config['SUBTITLES_FOLDER'])
-    if os.path.exists(subtitle_dir):
-        for file in os.listdir(subtitle_dir):
-            if file.startswith(os.path.basename(video_name)) and allowed_subtitle(file):
-                subtitles.append({
-                    'name': file,
-                    'url': f'/static/subtitles/{file}',
-                    'language': 'en'  # Default, could be parsed from filename
-                })
+    """Get available subtitles for a video: sidecars next to it, SUBTITLES_FOLDER files with its name,
+    then the text subtitle streams embedded in the file"""
+    normalized_path = video_path.replace('/', os.sep).replace('\\', os.sep)
+    if not is_library_path(normalized_path):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    video_name = os.path.splitext(normalized_path)[0]
+    folder_key = os.path.basename(video_name).lower()
+    sidecar_key = os.path.join(os.path.dirname(video_name), folder_key)
+    
+    refresh_subtitle_index()
+    refresh_library_index(os.path.dirname(normalized_path), recursive=False)
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, source, path, language, label FROM subtitle_index
+        WHERE (source = 'folder' AND video_key = ?) OR (source = 'sidecar' AND video_key = ?)
+        ORDER BY source DESC, language, path
+    ''', (folder_key, sidecar_key))
+    
+    subtitles = [{
+        'id': subtitle_id,
+        'name': os.path.basename(path),
+        'label': label,
+        'language': language,
+        'source': source,
+        'url': f'/api/subtitle-tracks/{subtitle_id}.vtt'
+    } for subtitle_id, source, path, language, label in cursor.fetchall()]
+    
+    _, streams = get_embedded_subtitles(normalized_path)
+    url_path = normalized_path.replace(os.sep, '/')
+    for number, stream in enumerate(streams, 1):
+        language = parse_subtitle_language(stream['language'] or '') or 'und'
+        subtitles.append({
+            'id': None,
+            'name': stream['title'] or f"Track {number}",
+            'label': subtitle_label(None if language == 'und' else language, stream['flags'], stream['title']),
+            'language': language,
+            'source': 'embedded',
+            'url': f"/api/embedded-subtitles/{stream['index']}/{quote(url_path)}"
+        })
     
     return jsonify({'subtitles': subtitles})
 
+@app.route('/api/subtitle-tracks/<int:subtitle_id>.vtt')
+@requires_access('can_use_subtitles')
+def get_subtitle_track(subtitle_id):
+    """Serve an indexed subtitle as WebVTT, converting SRT/ASS/SSA on first request"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT source, path FROM subtitle_index WHERE id = ?', (subtitle_id,))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({'error': 'Subtitle not found'}), 404
+    
+    source, path = row
+    root = SUBTITLES_FOLDER if source == 'folder' else UPLOAD_FOLDER
+    full_path = os.path.join(root, path)
+    if not os.path.isfile(full_path):
+        return jsonify({'error': 'Subtitle not found'}), 404
+    
+    if full_path.lower().endswith('.vtt'):
+        directory, filename = os.path.split(full_path)
+    else:
+        cache_path = get_subtitle_cache_path(source, path)
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(full_path):
+            try:
+                convert_subtitle_to_vtt(full_path, cache_path)
+            except (OSError, UnicodeError) as e:
+                print(f"Error converting subtitle {full_path}: {e}")
+                return jsonify({'error': 'Subtitle conversion failed'}), 500
+        directory, filename = os.path.split(cache_path)
+    
+    response = send_from_directory(os.path.abspath(directory), filename, mimetype='text/vtt')
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+@app.route('/api/embedded-subtitles/<int:stream_index>/<path:video_path>')
+@requires_access('can_use_subtitles')
+def get_embedded_subtitle_track(stream_index, video_path):
+    """Serve an embedded subtitle stream as WebVTT, extracting it on first request (202 if that takes long)"""
+    normalized_path = video_path.replace('/', os.sep).replace('\\', os.sep)
+    if not is_library_path(normalized_path):
+        return jsonify({'error': 'Invalid path'}), 400
+    full_path = safe_join(app.config['UPLOAD_FOLDER'], *normalized_path.split(os.sep))
+    
+    if not os.path.isfile(full_path):
+        return jsonify({'error': 'Video not found'}), 404
+    
+    fingerprint, streams = get_embedded_subtitles(normalized_path)
+    if not fingerprint or not any(stream['index'] == stream_index for stream in streams):
+        return jsonify({'error': 'Subtitle not found'}), 404
+    
+    cache_path = get_embedded_subtitle_cache_path(fingerprint, stream_index)
+    if not os.path.exists(cache_path):
+        if cache_path in _subtitle_failed:
+            return jsonify({'error': 'Subtitle not available'}), 404
+        
+        # The media workers read the whole file; this request only waits for them
+        future = queue_subtitle_extraction(full_path, stream_index, cache_path)
+        try:
+            if not future.result(timeout=SUBTITLE_EXTRACT_WAIT):
+                return jsonify({'error': 'Subtitle extraction failed'}), 500
+        except FutureTimeoutError:
+            response = jsonify({'status': 'pending'})
+            response.headers['Retry-After'] = '5'
+            return response, 202
+    
+    response = send_from_directory(os.path.abspath(SUBTITLE_CACHE_FOLDER), os.path.basename(cache_path),
+                                   mimetype='text/vtt')
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+@app.route('/api/previews/<path:video_path>')
+@requires_access()
+def get_previews(video_path):
+    """Get the WebVTT thumbnails track for seek-bar previews (202 while it is generated)"""
+    normalized_path = video_path.replace('/', os.sep).replace('\\', os.sep)
+    full_path = os.path.join(app.config['UPLOAD_FOLDER'], normalized_path)
+    
+    # Security check
+    if not os.path.abspath(full_path).startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.isfile(full_path) or not is_video_file(normalized_path):
+        return jsonify({'error': 'Video not found'}), 404
+    
+    sprite_path, vtt_path = get_preview_paths(normalized_path)
+    if os.path.exists(vtt_path) and os.path.getmtime(vtt_path) >= os.path.getmtime(full_path):
+        response = send_from_directory(SPRITES_FOLDER, os.path.basename(vtt_path), mimetype='text/vtt')
+        response.headers['Cache-Control'] = 'private, max-age=3600'
+        return response
+    
+    # Failed files are only retried once they have been modified
+    if _preview_failed.get(normalized_path) == os.path.getmtime(full_path):
+        return jsonify({'error': 'Preview not available'}), 404
+    
+    queue_preview_job(normalized_path)
+    return jsonify({'status': 'pending'}), 202
+
+@app.route('/api/waveform/<path:audio_path>')
+@requires_access()
+def get_waveform(audio_path):
+    """Get the binary waveform peaks of an audio file (202 while they are generated)"""
+    if np is None:
+        return jsonify({'error': 'Waveforms not available (NumPy is not installed)'}), 503
+    
+    normalized_path = audio_path.replace('/', os.sep).replace('\\', os.sep)
+    if not is_library_path(normalized_path):
+        return jsonify({'error': 'Invalid path'}), 400
+    full_path = safe_join(app.config['UPLOAD_FOLDER'], *normalized_path.split(os.sep))
+    
+    if not os.path.isfile(full_path) or not is_audio_file(normalized_path):
+        return jsonify({'error': 'Audio file not found'}), 404
+    
+    waveform_path = get_waveform_path(normalized_path)
+    if os.path.exists(waveform_path) and os.path.getmtime(waveform_path) >= os.path.getmtime(full_path):
+        response = send_from_directory(WAVEFORMS_FOLDER, os.path.basename(waveform_path),
+                                       mimetype='application/octet-stream')
+        response.headers['Cache-Control'] = 'private, max-age=3600'
+        return response
+    
+    # Failed files are only retried once they have been modified
+    if _waveform_failed.get(normalized_path) == os.path.getmtime(full_path):
+        return jsonify({'error': 'Waveform not available'}), 404
+    
+    queue_waveform_job(normalized_path)
+    return jsonify({'status': 'pending'}), 202
+
 @app.route('/api/download/<path:video_path>')
+@requires_access('can_download')
 def download_video(video_path):
     """Download video file"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Authentication required'}), 401
-    
-    # Check download permission
-    if not check_user_permissions(session['user_id'], 'can_download'):
-        return jsonify({'error': 'Download access denied'}), 403
-    
     try:
         # Normalize path separators
         normalized_path = video_path.replace('/', os.sep).replace('\\', os.sep)
@@ -1198,6 +4553,13 @@ def download_video(video_path):
             print(f"File not found: {full_path}")
             return jsonify({'error': 'File not found'}), 404
             
+        # Let the front-end server stream the bytes once authorization passed
+        if FILE_OFFLOAD_MODE:
+            offload_path = safe_join(app.config['UPLOAD_FOLDER'], video_path.replace('\\', '/'))
+            if not offload_path or not os.path.isfile(offload_path):
+                return jsonify({'error': 'File not found'}), 404
+            return offload_response(offload_path, as_attachment=True)
+        
         return send_from_directory(app.config['UPLOAD_FOLDER'], normalized_path, as_attachment=True)
     except FileNotFoundError:
         print(f"FileNotFoundError for: {video_path}")
@@ -1206,31 +4568,204 @@ def download_video(video_path):
         print(f"Download error: {e}")
         return jsonify({'error': 'Download failed'}), 500
 
+@app.route('/api/archive/folder/', defaults={'folder_path': ''})
+@app.route('/api/archive/folder/<path:folder_path>')
+@requires_access('can_download')
+def download_folder_archive(folder_path):
+    """Download a folder and everything below it as one archive (?format=zip or tar)"""
+    archive_format = request.args.get('format', 'zip')
+    if archive_format not in ARCHIVE_FORMATS:
+        return jsonify({'error': 'Unsupported archive format'}), 400
+    
+    rel_dir = folder_path.replace('\\', '/').strip('/').replace('/', os.sep)
+    if not is_library_path(rel_dir):
+        return jsonify({'error': 'Invalid path'}), 400
+    full_dir = safe_join(app.config['UPLOAD_FOLDER'], *rel_dir.split(os.sep)) if rel_dir else app.config['UPLOAD_FOLDER']
+    
+    if not os.path.isdir(full_dir):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    refresh_library_index(rel_dir)
+    conn = get_db()
+    cursor = conn.cursor()
+    subtree, params = '1', ()
+    if rel_dir:
+        subtree, params = 'path >= ? AND path < ?', _library_subtree_bounds(rel_dir)
+    cursor.execute(f'''
+        SELECT path FROM library_index WHERE {subtree} AND item_type != 'folder'
+        ORDER BY path LIMIT ?
+    ''', params + (ARCHIVE_MAX_FILES + 1,))
+    paths = [row[0] for row in cursor.fetchall()]
+    if len(paths) > ARCHIVE_MAX_FILES:
+        return jsonify({'error': f'Archives are limited to {ARCHIVE_MAX_FILES} files'}), 413
+    
+    name = os.path.basename(rel_dir) or 'library'
+    entries = build_archive_entries(
+        (f"{name}/{path[len(rel_dir) + 1:] if rel_dir else path}".replace(os.sep, '/'), path) for path in paths
+    )
+    return archive_response(name, entries, archive_format)
+
+@app.route('/api/archive/playlist/<int:playlist_id>')
+@requires_access('can_download')
+def download_playlist_archive(playlist_id):
+    """Download a playlist's items in order as one archive (?format=zip or tar)"""
+    if not check_user_permissions(session['user_id'], 'can_use_playlists'):
+        return jsonify({'error': USER_PERMISSIONS['can_use_playlists']}), 403
+    
+    archive_format = request.args.get('format', 'zip')
+    if archive_format not in ARCHIVE_FORMATS:
+        return jsonify({'error': 'Unsupported archive format'}), 400
+    
+    refresh_library_index()
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    playlist = get_owned_playlist(cursor, playlist_id)
+    if not playlist:
+        return jsonify({'error': 'Playlist not found'}), 404
+    
+    cursor.execute('''
+        SELECT pi.video_path FROM playlist_items pi
+        JOIN library_index li ON li.path = pi.video_path
+        WHERE pi.playlist_id = ? AND li.item_type != 'folder'
+        ORDER BY pi.position LIMIT ?
+    ''', (playlist_id, ARCHIVE_MAX_FILES + 1))
+    paths = [row[0] for row in cursor.fetchall()]
+    if len(paths) > ARCHIVE_MAX_FILES:
+        return jsonify({'error': f'Archives are limited to {ARCHIVE_MAX_FILES} files'}), 413
+    
+    # Numbered names keep the playlist order and tell duplicates apart
+    name = re.sub(r'[\\/:*?"<>|]', '_', playlist[1]).strip(' .') or f'playlist-{playlist_id}'
+    width = len(str(len(paths)))
+    entries = build_archive_entries(
+        (f"{name}/{number:0{width}d} - {os.path.basename(path)}", path) for number, path in enumerate(paths, 1)
+    )
+    return archive_response(name, entries, archive_format)
+
 # Add route to serve video files directly
 @app.route('/static/videos/<path:filename>')
+@requires_access()
 def serve_video(filename):
-    """Serve video files with proper headers"""
+    """Serve video files with Range/ETag support"""
     try:
         # Normalize path separators
-        normalized_path = filename.replace('/', os.sep).replace('\\', os.sep)
-        full_path = os.path.join(app.config['UPLOAD_FOLDER'], normalized_path)
+        normalized_path = filename.replace('\\', '/')
+        full_path = safe_join(app.config['UPLOAD_FOLDER'], normalized_path)
         
-        print(f"Serving video: {normalized_path}")
-        print(f"Full path: {full_path}")
-        print(f"File exists: {os.path.exists(full_path)}")
+        try:
+            file_stat = os.stat(full_path) if full_path else None
+        except OSError:
+            file_stat = None
         
-        if not os.path.exists(full_path):
-            print(f"Video file not found: {full_path}")
+        if file_stat is None or not S_ISREG(file_stat.st_mode):
             return "File not found", 404
         
-        # Get file directory and name
-        directory = os.path.dirname(full_path)
-        file_name = os.path.basename(full_path)
+        if FILE_OFFLOAD_MODE:
+            return offload_response(full_path)
         
-        return send_from_directory(directory, file_name)
+        return stream_media_file(full_path, file_stat)
     except Exception as e:
         print(f"Error serving video {filename}: {e}")
         return "Error serving file", 500
+
+@app.route('/api/remux/<path:video_path>')
+@requires_access()
+def remux_video(video_path):
+    """Serve a video as fragmented MP4 by copying its H.264 stream out of the original container"""
+    source = resolve_library_video(video_path)
+    if not source:
+        return jsonify({'error': 'Video not found'}), 404
+    relative_path, full_path = source
+    
+    codecs = get_stream_codecs(relative_path)
+    if not codecs:
+        return jsonify({'error': 'Could not probe video'}), 422
+    video_codec, audio_codec = codecs
+    
+    if video_codec not in REMUX_VIDEO_CODECS:
+        return jsonify({
+            'error': f'Video codec {video_codec} cannot be remuxed for browsers',
+            'hls_url': f'/api/hls/{quote(video_path)}/master.m3u8'
+        }), 415
+    
+    cache_key = get_file_fingerprint(relative_path) or hashlib.md5(relative_path.encode()).hexdigest()
+    cache_path = os.path.join(REMUX_CACHE_FOLDER, cache_key + '.mp4')
+    if touch_cached_file(cache_path):
+        return stream_media_file(cache_path)
+    
+    # First viewing: progressive stream without Range support until the cached copy exists
+    remux = join_remux(build_remux_command(full_path, audio_codec), cache_path)
+    if remux is None:
+        return stream_media_file(cache_path)
+    response = Response(remux_stream(remux, cache_path), mimetype='video/mp4', direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'none'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+@app.route('/api/hls/<path:video_path>/master.m3u8')
+@requires_access()
+def hls_master_playlist(video_path):
+    """HLS master playlist listing the renditions available for a video"""
+    source = resolve_library_video(video_path)
+    if not source:
+        return jsonify({'error': 'Video not found'}), 404
+    
+    media_info = get_hls_media_info(source[0])
+    if not media_info:
+        return jsonify({'error': 'Could not determine video duration'}), 422
+    
+    response = Response(build_hls_master_playlist(get_hls_renditions(media_info[1])),
+                        mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/hls/<path:video_path>/<rendition>/index.m3u8')
+@requires_access()
+def hls_media_playlist(video_path, rendition):
+    """HLS media playlist for one rendition"""
+    source = resolve_library_video(video_path)
+    if not source:
+        return jsonify({'error': 'Video not found'}), 404
+    
+    media_info = get_hls_media_info(source[0])
+    if not media_info:
+        return jsonify({'error': 'Could not determine video duration'}), 422
+    
+    if rendition not in [rung[0] for rung in get_hls_renditions(media_info[1])]:
+        return jsonify({'error': 'Rendition not found'}), 404
+    
+    response = Response(build_hls_media_playlist(media_info[0]), mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/hls/<path:video_path>/<rendition>/<int:index>.ts')
+@requires_access()
+def hls_segment(video_path, rendition, index):
+    """One HLS segment, transcoded on first request and then served from the cache"""
+    source = resolve_library_video(video_path)
+    if not source:
+        return jsonify({'error': 'Video not found'}), 404
+    
+    media_info = get_hls_media_info(source[0])
+    if not media_info:
+        return jsonify({'error': 'Could not determine video duration'}), 422
+    duration, resolution, cache_key = media_info
+    
+    renditions = {rung[0]: rung for rung in get_hls_renditions(resolution)}
+    if rendition not in renditions or index * HLS_SEGMENT_DURATION >= duration:
+        return jsonify({'error': 'Segment not found'}), 404
+    
+    segment_path = get_hls_segment(source[1], cache_key, renditions[rendition], index, duration,
+                                   owner=(session['user_id'], cache_key))
+    if not segment_path:
+        return jsonify({'error': 'Transcoding failed'}), 500
+    
+    response = send_from_directory(os.path.dirname(segment_path), os.path.basename(segment_path),
+                                   mimetype='video/mp2t')
+    response.headers['Cache-Control'] = f'private, max-age={VIDEO_CACHE_MAX_AGE}'
+    return response
+
 if __name__ == '__main__':
     init_database()
+    refresh_library_index()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark thumbnail extraction modes (accurate vs fast vs scene)
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from app import UPLOAD_FOLDER, allowed_file, is_video_file, probe_media, build_thumbnail_command
+
+MODES = ['accurate', 'fast', 'scene']
+
+def children_cpu_time():
+    """CPU seconds (user + system) consumed by finished child processes"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def pick_seek_time(duration):
+    """Same seek point choice as generate_thumbnail"""
+    if duration is None:
+        return '00:00:10'
+    if duration > 55:
+        return '00:00:55'
+    if duration > 10:
+        return '00:00:10'
+    if duration > 5:
+        return '00:00:05'
+    return '00:00:01'
+
+def benchmark_file(relative_path, modes, output_dir):
+    """Run every mode once for a file and return {mode: (wall_s, cpu_s, ok)}"""
+    full_path = os.path.join(UPLOAD_FOLDER, relative_path)
+    probe = probe_media(relative_path)
+    seek_time = pick_seek_time(probe['duration'] if probe else None)
+    results = {}
+
+    for mode in modes:
+        thumbnail_path = os.path.join(output_dir, f"{mode}_{Path(relative_path).stem}.jpg")
+        cmd = build_thumbnail_command(full_path, seek_time, thumbnail_path, mode)
+
+        cpu_before = children_cpu_time()
+        wall_before = time.perf_counter()
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            ok = result.returncode == 0 and os.path.exists(thumbnail_path)
+        except subprocess.TimeoutExpired:
+            ok = False
+        results[mode] = (time.perf_counter() - wall_before, children_cpu_time() - cpu_before, ok)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare wall time and CPU per file for thumbnail modes')
+    parser.add_argument('--limit', type=int, default=10, help='number of videos to benchmark (default: 10)')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated modes (default: all)')
+    args = parser.parse_args()
+
+    modes = [mode for mode in args.modes.split(',') if mode in MODES]
+
+    print("🎬 XPlayer Thumbnail Benchmark")
+    print("=" * 40)
+
+    videos = []
+    for file_path in sorted(Path(UPLOAD_FOLDER).rglob('*')):
+        if file_path.is_file() and allowed_file(file_path.name) and is_video_file(file_path.name):
+            videos.append(str(file_path.relative_to(UPLOAD_FOLDER)))
+        if len(videos) >= args.limit:
+            break
+
+    if not videos:
+        print(f"\n⚠️  No video files found in {UPLOAD_FOLDER}/")
+        sys.exit(1)
+
+    totals = {mode: [0.0, 0.0, 0] for mode in modes}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for relative_path in videos:
+            print(f"\n📹 {relative_path}")
+            for mode, (wall, cpu, ok) in benchmark_file(relative_path, modes, output_dir).items():
+                status = '✅' if ok else '❌'
+                print(f"   {status} {mode:<9} wall {wall:7.3f}s   cpu {cpu:7.3f}s")
+                totals[mode][0] += wall
+                totals[mode][1] += cpu
+                totals[mode][2] += ok
+
+    print(f"\n📊 Averages over {len(videos)} files:")
+    for mode, (wall, cpu, ok_count) in totals.items():
+        print(f"   {mode:<9} wall {wall / len(videos):7.3f}s/file   cpu {cpu / len(videos):7.3f}s/file   "
+              f"ok {ok_count}/{len(videos)}")
+
+    if resource is None:
+        print("\n⚠️  CPU time is not available on this platform")
+
+if __name__ == "__main__":
+    main()
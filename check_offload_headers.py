@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Check the headers emitted by the X-Accel-Redirect / X-Sendfile offload modes
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+import app as xplayer
+
+SAMPLE_FILES = ['sample.mp4', 'Season 1/Épisode 01.mkv']
+
+def configure(workdir):
+    """Point the app at a throwaway database and videos folder"""
+    videos = os.path.join(workdir, 'videos')
+    xplayer.DATABASE_FILE = os.path.join(workdir, 'xplayer.db')
+    xplayer.UPLOAD_FOLDER = videos
+    xplayer.app.config['UPLOAD_FOLDER'] = videos
+
+    for relative_path in SAMPLE_FILES:
+        full_path = os.path.join(videos, relative_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(b'\0' * 1024)
+
+    xplayer.init_database()
+
+def login(client):
+    response = client.post('/api/login', json={
+        'username': xplayer.DEFAULT_ADMIN_USERNAME,
+        'password': xplayer.DEFAULT_ADMIN_PASSWORD
+    })
+    return response.status_code == 200
+
+def check(label, condition, detail=''):
+    print(f"   {'✅' if condition else '❌'} {label}{f' ({detail})' if detail and not condition else ''}")
+    return condition
+
+def check_mode(mode, client, videos):
+    print(f"\n🔀 Mode: {mode}")
+    xplayer.FILE_OFFLOAD_MODE = mode
+    ok = True
+
+    for relative_path in SAMPLE_FILES:
+        url_path = relative_path.replace(os.sep, '/')
+        full_path = os.path.abspath(os.path.join(videos, relative_path))
+
+        for route, attachment in [('/static/videos/', False), ('/api/download/', True)]:
+            response = client.get(route + url_path)
+            print(f"   {route}{url_path}")
+            ok &= check('status 200', response.status_code == 200, response.status_code)
+            ok &= check('empty body', response.data == b'', f'{len(response.data)} bytes')
+
+            if mode == 'x-accel':
+                expected = xplayer.X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + xplayer.quote(url_path)
+                ok &= check('X-Accel-Redirect', response.headers.get('X-Accel-Redirect') == expected,
+                            response.headers.get('X-Accel-Redirect'))
+                ok &= check('no X-Sendfile', 'X-Sendfile' not in response.headers)
+            else:
+                ok &= check('X-Sendfile', response.headers.get('X-Sendfile') == full_path,
+                            response.headers.get('X-Sendfile'))
+                ok &= check('no X-Accel-Redirect', 'X-Accel-Redirect' not in response.headers)
+
+            disposition = response.headers.get('Content-Disposition', '')
+            if attachment:
+                ok &= check('Content-Disposition attachment', disposition.startswith('attachment'), disposition)
+            else:
+                ok &= check('no Content-Disposition', not disposition, disposition)
+
+    # Authorization still happens in Flask
+    anonymous = xplayer.app.test_client()
+    for route, label in [('/api/download/', 'download'), ('/static/videos/', 'stream')]:
+        response = anonymous.get(route + SAMPLE_FILES[0])
+        ok &= check(f'{label} without session is refused', response.status_code == 401, response.status_code)
+        ok &= check('refusal carries no offload header',
+                    'X-Accel-Redirect' not in response.headers and 'X-Sendfile' not in response.headers)
+
+    response = client.get('/api/download/../app.py')
+    ok &= check('path traversal is refused', response.status_code in (400, 404), response.status_code)
+
+    return ok
+
+def main():
+    print("🎬 XPlayer Offload Header Check")
+    print("=" * 40)
+
+    workdir = tempfile.mkdtemp(prefix='xplayer-offload-')
+    try:
+        configure(workdir)
+        client = xplayer.app.test_client()
+        if not login(client):
+            print("❌ Could not log in as the default admin")
+            sys.exit(1)
+
+        results = [check_mode(mode, client, xplayer.UPLOAD_FOLDER) for mode in ['x-accel', 'x-sendfile']]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if all(results):
+        print("\n✅ All offload headers look correct.")
+    else:
+        print("\n⚠️  Some checks failed. See the messages above.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Bulk ingest: probe and thumbnail a library tree ahead of time using worker processes
+"""
+
+import os
+import sys
+import time
+import signal
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import app as xplayer
+
+def cpu_time():
+    """CPU seconds (user + system) of this process and its finished children (ffprobe/ffmpeg)"""
+    if resource is None:
+        return 0.0
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+def init_worker(verbose):
+    """Worker process setup: Ctrl+C is handled by the parent, per-file logs are hidden.
+    
+    Workers run at the background nice level (inherited by ffprobe/ffmpeg) so a
+    running server keeps serving playback first.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    xplayer.limit_media_process(os.getpid(), xplayer.MEDIA_PRIORITY_BACKGROUND)
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+def fingerprint_file(relative_path):
+    """Worker body for the first pass: fingerprint one file"""
+    return relative_path, xplayer.get_file_fingerprint(relative_path)
+
+def process_file(relative_path, fingerprint):
+    """Worker body: build one video_metadata row and measure the CPU it cost"""
+    cpu_before = cpu_time()
+    try:
+        row, success = xplayer.build_video_metadata_row(relative_path, fingerprint)
+    except Exception as e:
+        row, success = None, False
+        print(f"Error processing {relative_path}: {e}", file=sys.stderr)
+    return relative_path, row, success, cpu_time() - cpu_before
+
+def find_pending_files(rel_dir, force):
+    """Index the tree and return the files whose metadata is missing or out of date"""
+    xplayer.refresh_library_index(rel_dir, force=True)
+
+    conn = xplayer.get_db()
+    cursor = conn.cursor()
+    subtree, params = '1', ()
+    if rel_dir:
+        subtree, params = 'li.path >= ? AND li.path < ?', xplayer._library_subtree_bounds(rel_dir)
+
+    # Unchanged size and mtime means the stored row is still valid, which also makes
+    # an interrupted run resumable: everything already written is skipped
+    stale = '' if force else '''AND (vm.file_path IS NULL OR vm.file_mtime IS NULL
+                                     OR vm.file_size != li.size OR vm.file_mtime != li.modified)'''
+    cursor.execute(f'''
+        SELECT li.path FROM library_index li
+        LEFT JOIN video_metadata vm ON vm.file_path = li.path
+        WHERE {subtree} AND li.item_type != 'folder' {stale}
+        ORDER BY li.path
+    ''', params)
+    return [row[0] for row in cursor.fetchall()]
+
+def copy_row(row, relative_path):
+    """Reuse a freshly built row for an identical file at another path"""
+    try:
+        file_mtime = os.path.getmtime(os.path.join(xplayer.UPLOAD_FOLDER, relative_path))
+    except OSError:
+        file_mtime = None
+    return (relative_path,) + tuple(row[1:-2]) + (file_mtime, row[-1])
+
+def print_progress(done, total, failed, started, worker_cpu):
+    elapsed = time.time() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    cpu_per_file = worker_cpu / done if done else 0.0
+    print(f"   [{done}/{total}] {rate:6.2f} files/s   {cpu_per_file:6.2f} CPU s/file   "
+          f"{failed} failed   {elapsed:7.1f}s elapsed", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Probe and thumbnail a library tree into video_metadata')
+    parser.add_argument('path', nargs='?', default='',
+                        help=f'folder below {xplayer.UPLOAD_FOLDER} to ingest (default: everything)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help='rows written per database transaction (default: 50)')
+    parser.add_argument('--progress-interval', type=float, default=5,
+                        help='seconds between progress lines (default: 5)')
+    parser.add_argument('--force', action='store_true', help='reprocess files even if unchanged')
+    parser.add_argument('--verbose', action='store_true', help='show the per-file log of the workers')
+    args = parser.parse_args()
+
+    rel_dir = args.path.strip('/').replace('/', os.sep)
+    if not os.path.isdir(os.path.join(xplayer.UPLOAD_FOLDER, rel_dir)):
+        print(f"❌ Folder not found: {os.path.join(xplayer.UPLOAD_FOLDER, rel_dir)}")
+        sys.exit(1)
+
+    print("🎬 XPlayer Library Ingest")
+    print("=" * 40)
+
+    xplayer.init_database()
+    pending = find_pending_files(rel_dir, args.force)
+    if not pending:
+        print("✅ Everything is up to date.")
+        return
+
+    print(f"\n📹 {len(pending)} files to check with {args.workers} workers")
+
+    done = failed = reused = 0
+    worker_cpu = 0.0
+    batch = []
+    started = last_report = time.time()
+    interrupted = False
+
+    executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.verbose,))
+    try:
+        # Files whose fingerprint is already known (moved or duplicated) skip ffprobe/ffmpeg;
+        # identical new files are only processed once
+        to_build = {}  # fingerprint (or path) -> paths sharing it
+        for relative_path, fingerprint in executor.map(fingerprint_file, pending, chunksize=16):
+            row = xplayer.find_cached_metadata_row(relative_path, fingerprint)
+            if row:
+                batch.append(row)
+                done += 1
+                reused += 1
+            else:
+                to_build.setdefault(fingerprint or relative_path, []).append(relative_path)
+
+        print(f"   ♻️  {reused} files reused cached metadata, {len(to_build)} to probe")
+
+        futures = {
+            executor.submit(process_file, paths[0], None if key == paths[0] else key): paths
+            for key, paths in to_build.items()
+        }
+        for future in as_completed(futures):
+            relative_path, row, success, cpu = future.result()
+            duplicates = futures[future][1:]
+            done += 1 + len(duplicates)
+            worker_cpu += cpu
+            if row is not None:
+                batch.append(row)
+                batch.extend(copy_row(row, duplicate) for duplicate in duplicates)
+            if not success:
+                failed += 1
+                print(f"   ⚠️  {relative_path}: no probe data or thumbnail")
+
+            if len(batch) >= args.batch_size:
+                xplayer.store_video_metadata(batch)
+                batch = []
+
+            if time.time() - last_report >= args.progress_interval:
+                print_progress(done, len(pending), failed, started, worker_cpu)
+                last_report = time.time()
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\n⏹  Interrupted, saving finished files...")
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        # Finished rows are always kept so the next run resumes where this one stopped
+        xplayer.store_video_metadata(batch)
+        executor.shutdown(wait=not interrupted)
+
+    print(f"\n📊 Processed {done}/{len(pending)} files:")
+    print_progress(done, len(pending), failed, started, worker_cpu)
+    if resource is None:
+        print("\n⚠️  CPU time is not available on this platform")
+
+    if interrupted:
+        print("   Run the same command again to continue.")
+        sys.exit(130)
+
+if __name__ == "__main__":
+    main()
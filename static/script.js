@@ -5,10 +5,17 @@ let currentPlaylistIndex = -1;
 let allVideos = [];
 let playlists = [];
 let currentPath = '';
+let currentItems = [];
+let nextCursor = null;
+let searchResultItems = [];
+let searchNextOffset = null;
 let isSearching = false;
 let controlsTimeout;
 let isControlsVisible = true;
 let currentSort = { by: 'name', order: 'asc' };
+let seekPreviews = [];
+let waveform = null;
+let hlsPlayer = null;
 
 // User permissions (set from template)
 const permissions = window.userPermissions || {
@@ -25,6 +32,10 @@ const playPauseBtn = document.getElementById('playPauseBtn');
 const progressBar = document.getElementById('progressBar');
 const progressFilled = document.getElementById('progressFilled');
 const progressHandle = document.getElementById('progressHandle');
+const seekPreview = document.getElementById('seekPreview');
+const seekPreviewImage = document.getElementById('seekPreviewImage');
+const seekPreviewTime = document.getElementById('seekPreviewTime');
+const waveformCanvas = document.getElementById('waveformCanvas');
 const volumeSlider = document.getElementById('volumeSlider');
 const currentTimeSpan = document.getElementById('currentTime');
 const durationSpan = document.getElementById('duration');
@@ -61,6 +72,7 @@ function initializePlayer() {
     videoPlayer.addEventListener('pause', () => updatePlayPauseButton(false));
     videoPlayer.addEventListener('waiting', () => showLoading(true));
     videoPlayer.addEventListener('canplay', () => showLoading(false));
+    window.addEventListener('resize', () => waveform && drawWaveform());
     
     // Container events for controls
     videoContainer.addEventListener('mousemove', showControls);
@@ -94,6 +106,8 @@ function initializeControls() {
     // Progress bar
     progressBar.addEventListener('click', seekVideo);
     progressBar.addEventListener('mousedown', startProgressDrag);
+    progressBar.addEventListener('mousemove', showSeekPreview);
+    progressBar.addEventListener('mouseleave', hideSeekPreview);
     
     // Volume control
     volumeSlider.addEventListener('input', changeVolume);
@@ -202,6 +216,155 @@ function startProgressDrag(e) {
     document.addEventListener('mouseup', onMouseUp);
 }
 
+// Seek-bar previews
+async function loadSeekPreviews(path, attempt = 0) {
+    try {
+        const response = await fetch(getMediaApiUrl('previews', path));
+        
+        // Previews are generated in the background; poll a few times while pending
+        if (response.status === 202) {
+            if (attempt < 6 && currentVideo?.path === path) {
+                setTimeout(() => loadSeekPreviews(path, attempt + 1), 5000);
+            }
+            return;
+        }
+        
+        if (response.ok && currentVideo?.path === path) {
+            seekPreviews = parseThumbnailTrack(await response.text());
+        }
+    } catch (error) {
+        console.error('Failed to load seek previews:', error);
+    }
+}
+
+function parseThumbnailTrack(text) {
+    const cues = [];
+    const blocks = text.split(/\r?\n\r?\n/);
+    
+    blocks.forEach(block => {
+        const lines = block.trim().split(/\r?\n/);
+        const timing = lines.findIndex(line => line.includes('-->'));
+        if (timing === -1 || !lines[timing + 1]) return;
+        
+        const [start, end] = lines[timing].split('-->').map(parseVttTime);
+        const [url, fragment] = lines[timing + 1].split('#xywh=');
+        const [x, y, w, h] = (fragment || '0,0,0,0').split(',').map(Number);
+        cues.push({ start, end, url, x, y, w, h });
+    });
+    
+    return cues;
+}
+
+function parseVttTime(value) {
+    const parts = value.trim().split(':').map(parseFloat);
+    return parts.reduce((total, part) => total * 60 + part, 0);
+}
+
+function showSeekPreview(e) {
+    if (!videoPlayer.duration) return;
+    
+    const rect = progressBar.getBoundingClientRect();
+    const percent = Math.max(0, Math.min(1, (e.clientX - rect.left) / rect.width));
+    const time = percent * videoPlayer.duration;
+    const cue = seekPreviews.find(c => time >= c.start && time < c.end);
+    
+    if (cue) {
+        seekPreviewImage.style.width = `${cue.w}px`;
+        seekPreviewImage.style.height = `${cue.h}px`;
+        seekPreviewImage.style.backgroundImage = `url("${cue.url}")`;
+        seekPreviewImage.style.backgroundPosition = `-${cue.x}px -${cue.y}px`;
+        seekPreviewImage.style.display = 'block';
+    } else {
+        seekPreviewImage.style.display = 'none';
+    }
+    
+    seekPreviewTime.textContent = formatTime(time);
+    seekPreview.style.left = `${percent * 100}%`;
+    seekPreview.classList.add('show');
+}
+
+function hideSeekPreview() {
+    seekPreview.classList.remove('show');
+}
+
+// Audio waveforms
+async function loadWaveform(path, attempt = 0) {
+    try {
+        const response = await fetch(getMediaApiUrl('waveform', path));
+        
+        // Peaks are generated in the background; poll a few times while pending
+        if (response.status === 202) {
+            if (attempt < 6 && currentVideo?.path === path) {
+                setTimeout(() => loadWaveform(path, attempt + 1), 5000);
+            }
+            return;
+        }
+        
+        if (response.ok && currentVideo?.path === path) {
+            waveform = parseWaveform(await response.arrayBuffer());
+            waveformCanvas.style.display = 'block';
+            drawWaveform();
+        }
+    } catch (error) {
+        console.error('Failed to load waveform:', error);
+    }
+}
+
+function parseWaveform(buffer) {
+    // Layout written by generate_waveform() in app.py
+    const view = new DataView(buffer);
+    const bits = view.getUint8(5);
+    const levelCount = view.getUint16(6, true);
+    const PeakArray = bits === 8 ? Int8Array : Int16Array;
+    const headers = [];
+    let offset = 12;
+    
+    for (let i = 0; i < levelCount; i++) {
+        headers.push({ samplesPerBucket: view.getUint32(offset, true), length: view.getUint32(offset + 4, true) });
+        offset += 8;
+    }
+    
+    const levels = headers.map(header => {
+        const bytes = header.length * 2 * PeakArray.BYTES_PER_ELEMENT;
+        const peaks = new PeakArray(buffer.slice(offset, offset + bytes));
+        offset += bytes;
+        return { ...header, peaks };
+    });
+    
+    return { scale: bits === 8 ? 128 : 32768, levels };
+}
+
+function drawWaveform() {
+    const width = waveformCanvas.clientWidth * window.devicePixelRatio;
+    const height = waveformCanvas.clientHeight * window.devicePixelRatio;
+    if (!width || !height) return;
+    
+    waveformCanvas.width = width;
+    waveformCanvas.height = height;
+    const context = waveformCanvas.getContext('2d');
+    
+    // Coarsest zoom level that still has a bucket for every pixel column
+    const level = [...waveform.levels].reverse().find(l => l.length >= width) || waveform.levels[0];
+    const played = videoPlayer.duration ? videoPlayer.currentTime / videoPlayer.duration : 0;
+    const accent = getComputedStyle(document.documentElement).getPropertyValue('--accent-color');
+    const middle = height / 2;
+    
+    for (let x = 0; x < width; x++) {
+        const start = Math.floor(x * level.length / width);
+        const end = Math.max(start + 1, Math.floor((x + 1) * level.length / width));
+        let min = 0, max = 0;
+        for (let i = start; i < end && i < level.length; i++) {
+            min = Math.min(min, level.peaks[2 * i]);
+            max = Math.max(max, level.peaks[2 * i + 1]);
+        }
+        
+        context.fillStyle = x / width < played ? accent : 'rgba(255, 255, 255, 0.4)';
+        const top = middle - (max / waveform.scale) * middle * 0.9;
+        const bottom = middle - (min / waveform.scale) * middle * 0.9;
+        context.fillRect(x, top, 1, Math.max(1, bottom - top));
+    }
+}
+
 function updateProgress() {
     if (videoPlayer.duration) {
         const percent = (videoPlayer.currentTime / videoPlayer.duration) * 100;
@@ -209,6 +372,10 @@ function updateProgress() {
         progressHandle.style.left = percent + '%';
         
         currentTimeSpan.textContent = formatTime(videoPlayer.currentTime);
+        
+        if (waveform) {
+            drawWaveform();
+        }
     }
 }
 
@@ -267,6 +434,10 @@ function loadVideo(videoInfo, playlistInfo = null, playlistIndex = -1) {
     console.log('Video URL:', videoInfo.url);
     
     // Clear any existing video source
+    if (hlsPlayer) {
+        hlsPlayer.destroy();
+        hlsPlayer = null;
+    }
     videoPlayer.src = '';
     
     // Set new video source
@@ -275,7 +446,24 @@ function loadVideo(videoInfo, playlistInfo = null, playlistIndex = -1) {
     videoPath.textContent = videoInfo.path;
     
     // Add error handling for video loading
+    let triedRemux = false;
+    let triedHls = false;
     videoPlayer.onerror = function(e) {
+        // Containers the browser cannot open are remuxed to MP4, other codecs fall back to HLS
+        if (videoInfo.type === 'video' && !triedRemux) {
+            triedRemux = true;
+            console.log('Falling back to MP4 remux:', getMediaApiUrl('remux', videoInfo.path));
+            videoPlayer.src = getMediaApiUrl('remux', videoInfo.path);
+            videoPlayer.play().catch(() => {});
+            return;
+        }
+        if (videoInfo.type === 'video' && !triedHls) {
+            triedHls = true;
+            if (playHls(videoInfo)) {
+                return;
+            }
+        }
+        
         console.error('Video loading error:', e);
         console.error('Failed to load:', videoInfo.url);
         showNotification('Failed to load video: ' + videoInfo.name, 'error');
@@ -303,6 +491,49 @@ function loadVideo(videoInfo, playlistInfo = null, playlistIndex = -1) {
     if (permissions.can_use_subtitles) {
         loadSubtitles(videoInfo.path);
     }
+    
+    // Load seek-bar previews (videos only)
+    seekPreviews = [];
+    if (videoInfo.type === 'video') {
+        loadSeekPreviews(videoInfo.path);
+    }
+    
+    // Load the waveform (audio only)
+    waveform = null;
+    waveformCanvas.style.display = 'none';
+    if (videoInfo.type === 'audio') {
+        loadWaveform(videoInfo.path);
+    }
+}
+
+function getMediaApiUrl(endpoint, path) {
+    return `/api/${endpoint}/${path.split('/').map(encodeURIComponent).join('/')}`;
+}
+
+// Adaptive streaming (HLS): native on Safari, hls.js elsewhere
+function playHls(videoInfo) {
+    const url = getMediaApiUrl('hls', videoInfo.path) + '/master.m3u8';
+    
+    if (videoPlayer.canPlayType('application/vnd.apple.mpegurl')) {
+        videoPlayer.src = url;
+    } else if (window.Hls && Hls.isSupported()) {
+        hlsPlayer = new Hls();
+        hlsPlayer.on(Hls.Events.ERROR, (event, data) => {
+            if (data.fatal) {
+                console.error('HLS error:', data);
+                showNotification('Failed to load video: ' + videoInfo.name, 'error');
+            }
+        });
+        hlsPlayer.loadSource(url);
+        hlsPlayer.attachMedia(videoPlayer);
+    } else {
+        return false;
+    }
+    
+    console.log('Falling back to HLS:', url);
+    showNotification('Switching to adaptive streaming', 'info');
+    videoPlayer.play().catch(() => {});
+    return true;
 }
 
 function updateActiveFile(filePath) {
@@ -358,7 +589,7 @@ function downloadCurrentVideo() {
 }
 
 // File browser
-async function loadFiles(path = '', sortBy = null, sortOrder = null) {
+async function loadFiles(path = '', sortBy = null, sortOrder = null, cursor = null) {
     try {
         showLoading(true);
         console.log('Loading files from path:', path);
@@ -367,24 +598,34 @@ async function loadFiles(path = '', sortBy = null, sortOrder = null) {
         if (sortBy) currentSort.by = sortBy;
         if (sortOrder) currentSort.order = sortOrder;
         
+        // Only the current folder level is fetched; subfolders load when opened
         const params = new URLSearchParams({
             path: path,
             sort: currentSort.by,
-            order: currentSort.order
+            order: currentSort.order,
+            shallow: '1'
         });
+        if (cursor) params.set('cursor', cursor);
         
         const response = await fetch(`/api/browse?${params}`);
         const data = await response.json();
         
         if (response.ok) {
             currentPath = data.current_path;
+            nextCursor = data.next_cursor;
             console.log('Loaded items:', data.items);
-            renderFiles(data.items);
-            updateBreadcrumb(data.current_path, data.parent_path);
+            
+            if (cursor) {
+                currentItems = currentItems.concat(data.items);
+            } else {
+                currentItems = data.items;
+                updateBreadcrumb(data.current_path, data.parent_path);
+            }
+            renderFiles(currentItems);
             
             // Update all videos list for navigation
             allVideos = [];
-            extractVideos(data.items, allVideos);
+            extractVideos(currentItems, allVideos);
         } else {
             showNotification(data.error || 'Failed to load files', 'error');
         }
@@ -395,6 +636,12 @@ async function loadFiles(path = '', sortBy = null, sortOrder = null) {
     }
 }
 
+function loadMoreFiles() {
+    if (nextCursor) {
+        loadFiles(currentPath, null, null, nextCursor);
+    }
+}
+
 function extractVideos(items, videoList) {
     items.forEach(item => {
         if (item.type === 'video' || item.type === 'audio') {
@@ -442,12 +689,17 @@ function renderFiles(items) {
                 <div class="file-info">
                     <div class="file-name">${item.name}</div>
                     <div class="file-meta">
-                        ${formatFileSize(item.size)}
+                        ${formatFileSize(item.type === 'folder' ? item.total_size || 0 : item.size)}
                         ${item.duration ? ` • ${formatTime(item.duration)}` : ''}
-                        ${item.type === 'folder' ? ` • ${item.children?.length || 0} items` : ''}
+                        ${item.type === 'folder' ? ` • ${item.child_count ?? item.children?.length ?? 0} items` : ''}
                     </div>
                 </div>
                 <div class="file-actions">
+                    ${item.type === 'folder' && permissions.can_download ? `
+                        <button class="file-action-btn" onclick="event.stopPropagation(); downloadFolder('${item.path.replace(/'/g, "\\'")}');" title="Download as ZIP">
+                            <i class="fas fa-file-archive"></i>
+                        </button>
+                    ` : ''}
                     ${isVideo && permissions.can_download ? `
                         <button class="file-action-btn" onclick="event.stopPropagation(); downloadFile('${item.path.replace(/'/g, "\\'")}');" title="Download">
                             <i class="fas fa-download"></i>
@@ -461,7 +713,14 @@ function renderFiles(items) {
                 </div>
             </div>
         `;
-    }).join('');
+    }).join('') + (nextCursor ? `
+        <div class="file-item load-more" onclick="loadMoreFiles()">
+            <div class="file-icon"><i class="fas fa-ellipsis-h"></i></div>
+            <div class="file-info">
+                <div class="file-name">Load more</div>
+            </div>
+        </div>
+    ` : '');
 }
 
 function downloadFile(filePath) {
@@ -471,6 +730,18 @@ function downloadFile(filePath) {
     }
 }
 
+function downloadFolder(folderPath) {
+    if (permissions.can_download) {
+        window.open(getMediaApiUrl('archive/folder', folderPath), '_blank');
+    }
+}
+
+function downloadPlaylist(playlistId) {
+    if (permissions.can_download) {
+        window.open(`/api/archive/playlist/${playlistId}`, '_blank');
+    }
+}
+
 // File sorting
 function addSortControls() {
     const browserHeader = document.querySelector('.file-browser-header');
@@ -588,13 +859,24 @@ async function handleSearch() {
         return;
     }
     
+    await fetchSearchResults(query, searchType, 0);
+}
+
+async function fetchSearchResults(query, searchType, offset) {
+    const searchResultsDiv = document.getElementById('searchResults');
+    
     try {
         isSearching = true;
-        const response = await fetch(`/api/search?q=${encodeURIComponent(query)}&type=${searchType}`);
+        const response = await fetch(`/api/search?q=${encodeURIComponent(query)}&type=${searchType}&offset=${offset}`);
         const data = await response.json();
         
+        // Drop responses for a query the user has already changed
+        if (searchInput.value.trim() !== query) return;
+        
         if (response.ok) {
-            renderSearchResults(data.results);
+            searchResultItems = offset ? searchResultItems.concat(data.results) : data.results;
+            searchNextOffset = data.next_offset;
+            renderSearchResults(searchResultItems);
             searchResultsDiv.style.display = 'block';
         } else {
             showNotification(data.error || 'Search failed', 'error');
@@ -604,6 +886,13 @@ async function handleSearch() {
     }
 }
 
+function loadMoreSearchResults() {
+    if (searchNextOffset !== null) {
+        const searchType = document.querySelector('.search-type-btn.active').id === 'searchTypeFile' ? 'file' : 'folder';
+        fetchSearchResults(searchInput.value.trim(), searchType, searchNextOffset);
+    }
+}
+
 function renderSearchResults(results) {
     const searchResultsDiv = document.getElementById('searchResults');
     
@@ -630,7 +919,14 @@ function renderSearchResults(results) {
                 </div>
             </div>
         </div>
-    `).join('');
+    `).join('') + (searchNextOffset !== null ? `
+        <div class="search-result-item load-more" onclick="event.stopPropagation(); loadMoreSearchResults()">
+            <div class="search-result-icon"><i class="fas fa-ellipsis-h"></i></div>
+            <div class="search-result-content">
+                <div class="search-result-name">Load more</div>
+            </div>
+        </div>
+    ` : '');
 }
 
 function clearSearch() {
@@ -752,6 +1048,11 @@ function renderPlaylists() {
                     <button class="playlist-action" onclick="playPlaylist(${playlist.id})" title="Play">
                         <i class="fas fa-play"></i>
                     </button>
+                    ${permissions.can_download ? `
+                        <button class="playlist-action" onclick="downloadPlaylist(${playlist.id})" title="Download as ZIP">
+                            <i class="fas fa-file-archive"></i>
+                        </button>
+                    ` : ''}
                     <button class="playlist-action" onclick="deletePlaylist(${playlist.id})" title="Delete">
                         <i class="fas fa-trash"></i>
                     </button>
@@ -839,15 +1140,13 @@ async function addVideoToPlaylist(playlistId) {
         const playlist = playlists.find(p => p.id === playlistId);
         if (!playlist) return;
         
-        // Add video to playlist
-        const updatedVideos = [...playlist.videos, currentVideo.path];
-        
-        const response = await fetch(`/api/playlists/${playlistId}`, {
-            method: 'PUT',
+        // Append the video to the playlist
+        const response = await fetch(`/api/playlists/${playlistId}/items`, {
+            method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ videos: updatedVideos })
+            body: JSON.stringify({ videos: [currentVideo.path] })
         });
         
         if (response.ok) {
@@ -966,12 +1265,11 @@ async function loadSubtitles(videoPath) {
         if (response.ok && data.subtitles.length > 0) {
             // Add subtitles to video player
             data.subtitles.forEach(subtitle => {
-                const track = document.createElement('track');
-                track.kind = 'subtitles';
-                track.src = subtitle.url;
-                track.srclang = subtitle.language;
-                track.label = subtitle.name;
-                videoPlayer.appendChild(track);
+                if (subtitle.source === 'embedded') {
+                    loadEmbeddedSubtitle(videoPath, subtitle);
+                } else {
+                    addSubtitleTrack(subtitle);
+                }
             });
         }
     } catch (error) {
@@ -979,6 +1277,35 @@ async function loadSubtitles(videoPath) {
     }
 }
 
+async function loadEmbeddedSubtitle(videoPath, subtitle, attempt = 0) {
+    try {
+        const response = await fetch(subtitle.url);
+        
+        // Embedded tracks are extracted in the background; poll a few times while pending
+        if (response.status === 202) {
+            if (attempt < 6 && currentVideo?.path === videoPath) {
+                setTimeout(() => loadEmbeddedSubtitle(videoPath, subtitle, attempt + 1), 5000);
+            }
+            return;
+        }
+        
+        if (response.ok && currentVideo?.path === videoPath) {
+            addSubtitleTrack(subtitle);
+        }
+    } catch (error) {
+        console.error('Failed to load embedded subtitle:', error);
+    }
+}
+
+function addSubtitleTrack(subtitle) {
+    const track = document.createElement('track');
+    track.kind = 'subtitles';
+    track.src = subtitle.url;
+    track.srclang = subtitle.language;
+    track.label = subtitle.label || subtitle.name;
+    videoPlayer.appendChild(track);
+}
+
 // Utility functions
 function formatTime(seconds) {
     if (!seconds || isNaN(seconds)) return '0:00';
@@ -1046,8 +1373,9 @@ function playFile(path) {
     console.log('Attempting to play file:', path);
     console.log('All videos:', allVideos);
     
-    // Find video info
-    const videoInfo = allVideos.find(v => v.path === path);
+    // Find video info (search results may point outside the loaded folder)
+    const videoInfo = allVideos.find(v => v.path === path) ||
+        searchResultItems.find(v => v.path === path);
     console.log('Found video info:', videoInfo);
     
     if (videoInfo) {
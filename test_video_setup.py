@@ -148,6 +148,7 @@ def main():
     
     if success_count == test_count:
         print("✅ All tests passed! Video detection and thumbnail generation should work.")
+        print("   Run 'python ingest_library.py' to pre-generate metadata for the whole library.")
     else:
         print("⚠️  Some tests failed. Check the error messages above.")
 